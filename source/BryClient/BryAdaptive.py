@@ -0,0 +1,274 @@
+'''
+====================================================
+BryAdaptive: adaptive sample period
+====================================================
+
+PeriodController watches the decoded stream and picks the Arduino's sample
+period ([Per=N]) between the bounds of PyBry.AdaptivePeriod: the fastest one as
+soon as a display moves, and one step slower after every QuietTime seconds in
+which nothing did. Long quiet stretches then cost a fraction of the samples,
+while a transient is sampled at full rate from the batch that shows it on
+
+A display is active in a batch when, relative to its threshold (ChangeBand of
+the reading, at least ChangeCounts display counts)
+    step     //two consecutive readings differ by more
+    spread   //the standard deviation of the batch's readings is larger
+or when its unit, range or source changes or it goes to or leaves overload. A
+trigger rule firing, a pending trigger event or a triggered recording count as
+activity too. Hysteresis: active takes a score of 1 (the threshold), quiet one
+below QuietRatio, in between the controller keeps its state. A quiet reading
+that drifts steadily sets the period in which it moves one threshold, and the
+period only steps slower while that stays well below it
+
+Every change is logged with the timecode and host time of the last sample
+before it, in changes and, with PyBry.PeriodLogFile, in a text file
+    # pctimestamp, timecode, previous (ms), period (ms), reason
+
+Usage
+    PyBry.AdaptivePeriod = (0, 5000)        //every Connection adds a controller
+    controller = PeriodController(0, 5000, apply=conn.ApplyPeriod)
+    controller.Process(columns)             //e.g. DecodeBatch output with pctimestamp
+'''
+
+import math
+import threading
+from collections import deque
+import numpy as np
+
+import PyBry
+from BrySinks import Sink, HistoryPeriod
+
+
+FramePeriod   = 50 #ms the Arduino takes per sample (request pulse and 160 bits), shorter periods sample as fast as that
+PeriodFactor  = 2 #each step slower multiplies the period by this
+ChangeBand    = 0.001 #relative change of a reading that is activity
+ChangeCounts  = 3 #display counts of flicker that are not
+QuietRatio    = 0.5 #fraction of the threshold a display has to stay below to be quiet
+QuietTime     = 10.0 #seconds of quiet before each step slower
+MaxChanges    = 100000 #period changes kept in PeriodController.changes
+
+Channels      = ["Lower", "Upper"]
+LogHeader     = "# pctimestamp, timecode, previous (ms), period (ms), reason\n"
+
+
+def Ladder(fastest, slowest, factor=PeriodFactor):
+    '''the periods the controller steps through, fastest first'''
+    periods = [fastest]
+    period = max(fastest, FramePeriod) * factor
+    while period < slowest:
+        periods.append(period)
+        period *= factor
+    if slowest > fastest:
+        periods.append(slowest)
+    return periods
+
+def Resolution(values):
+    '''the display's resolution, from the decimals of the readings shown'''
+    finest = 1.0
+    for value in values[np.isfinite(values)][-16:].tolist():
+        for decimals in range(7):
+            scaled = value * 10**decimals
+            if abs(scaled - round(scaled)) <= 1e-6 * max(abs(scaled), 1.0):
+                break
+        finest = min(finest, 10.0**-decimals)
+    return finest
+
+def ParsePeriod(period):
+    '''a [Per=] argument as the sketch reads it, toInt() gives 0 for garbage'''
+    try:
+        return max(int(period), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class PeriodController:
+    '''
+    ====================================================================================
+    PeriodController: decides the sample period from batches of SampleColumns. apply
+    is called with the new period in ms and returns False if it could not send it
+    (the port is closed); only periods sent are taken and logged. engine is a
+    BryTrigger.TriggerEngine whose activity holds the fastest period. Process runs on
+    the sink's thread and Manual on the UI's, lock serializes them
+    ====================================================================================
+    '''
+    def __init__(self, fastest, slowest, apply=None, engine=None, logFile=None, quietTime=QuietTime):
+        self.periods = Ladder(fastest, max(fastest, slowest))
+        self.apply = apply
+        self.engine = engine
+        self.quietTime = quietTime
+        self.lock = threading.Lock()
+        self.changes = deque(maxlen=MaxChanges)
+        self.file = None
+        if logFile:
+            self.file = open(logFile, "a", encoding="utf-8")
+            if self.file.tell() == 0:
+                self.file.write(LogHeader)
+        self.Reset()
+
+    def Reset(self):
+        '''starts over, e.g. for a new stream. The first batch sets the fastest period,
+        the board comes up with its own'''
+        with self.lock:
+            self.period = None
+            self.active = True
+            self.quietSince = math.nan
+            self.last = {} #channel -> (value, unit, unitOrg, source) of the previous sample
+            self.reference = {} #channel -> value when it went quiet or last drifted
+            self.referenceTime = math.nan
+            self.fired = self.engine.fired if self.engine is not None else 0
+            self.timecode = 0
+            self.pctimestamp = math.nan
+
+    def Change(self, period, reason, send=True):
+        '''takes and logs period unless apply could not send it. The caller holds lock'''
+        previous = self.period
+        if period == previous:
+            return
+        if send and self.apply is not None and self.apply(period) is False:
+            return
+        self.period = period
+        change = {"pctimestamp":self.pctimestamp, "timecode":self.timecode, "previous":previous, "period":period, "reason":reason}
+        self.changes.append(change)
+        if self.file is not None:
+            self.file.write(FormatChange(change))
+            self.file.flush()
+        if PyBry.DebugOn:
+            print("sample period {} ms: {}".format(period, reason))
+
+    def Manual(self, period):
+        '''records a period set by hand, the controller goes on from there'''
+        with self.lock:
+            self.Change(ParsePeriod(period), "manual", send=False)
+
+    def Score(self, columns, channel):
+        '''(activity, reason, drift) of a display in the batch, relative to its threshold'''
+        values = columns["valueOrg" + channel]
+        keys = [columns[name + channel] for name in ["unit", "unitOrg", "source"]]
+        last = self.last.get(channel)
+        self.last[channel] = (float(values[-1]),) + tuple(int(key[-1]) for key in keys)
+        if last is None:
+            return 0.0, "", 0.0
+        for key, previous in zip(keys, last[1:]):
+            if np.any(key != np.concatenate(([previous], key[:-1]))):
+                return math.inf, "range", 0.0
+        overload = np.isnan(values)
+        if np.any(overload != np.concatenate(([math.isnan(last[0])], overload[:-1]))):
+            return math.inf, "overload", 0.0
+        finite = values[~overload]
+        if len(finite) == 0:
+            return 0.0, "", 0.0
+
+        threshold = max(ChangeBand * float(np.median(np.abs(finite))), ChangeCounts * Resolution(values))
+        steps = np.abs(np.diff(np.concatenate(([last[0]], values))))
+        step = float(np.nanmax(steps)) if np.any(np.isfinite(steps)) else 0.0
+        score, reason = max((step, "step"), (float(np.std(finite)), "spread"))
+        reference = self.reference.get(channel, math.nan)
+        drift = 0.0 if math.isnan(reference) else abs(float(finite[-1]) - reference)
+        return score / threshold, reason, drift / threshold
+
+    def Triggered(self):
+        '''a trigger fired since the last batch, or an event or a recording is under way'''
+        engine = self.engine
+        if engine is None:
+            return False
+        fired, last = engine.fired, self.fired
+        self.fired = fired
+        recorder = engine.recorder
+        return fired != last or bool(engine.pending) or (recorder is not None and recorder.recording)
+
+    def Process(self, columns):
+        if len(columns["timecode"]) == 0:
+            return
+        with self.lock:
+            self.Decide(columns)
+
+    def Decide(self, columns):
+        self.timecode = int(columns["timecode"][-1])
+        self.pctimestamp = float(columns["pctimestamp"][-1]) if "pctimestamp" in columns else math.nan
+        if self.period is None:
+            self.Change(self.periods[0], "start")
+            if self.period is None:
+                return
+
+        score, reason, drift, drifting = 0.0, "", 0.0, ""
+        for channel in Channels:
+            channelScore, channelReason, channelDrift = self.Score(columns, channel)
+            if channelScore > score:
+                score, reason = channelScore, channel.lower() + " " + channelReason
+            if channelDrift > drift:
+                drift, drifting = channelDrift, channel.lower() + " drift"
+        if self.Triggered():
+            score, reason = math.inf, "trigger"
+
+        now = self.pctimestamp
+        if score >= 1.0:
+            self.active = True
+            self.Change(self.periods[0], reason)
+        elif score < QuietRatio and self.active:
+            self.active = False
+            self.quietSince = now
+            self.SetReference(now)
+        if self.active:
+            return
+
+        #quiet. A reading moving steadily is sampled at the period in which it moves
+        #one threshold, the one a step slower has to stay below QuietRatio of it
+        elapsed = now - self.referenceTime
+        target = elapsed / drift * 1000 if drift > 0 else math.inf
+        if drift >= 1.0:
+            fitting = [period for period in self.periods if period <= target] or self.periods[:1]
+            if fitting[-1] < self.period:
+                self.Change(fitting[-1], drifting)
+                self.quietSince = now
+            self.SetReference(now)
+        elif now - self.quietSince >= self.quietTime:
+            self.quietSince = now
+            slower = [period for period in self.periods if period > self.period]
+            if slower and slower[0] <= QuietRatio * target:
+                self.Change(slower[0], "quiet {:g} s".format(self.quietTime))
+
+    def SetReference(self, now):
+        '''the levels the displays drift from'''
+        self.reference = {channel: last[0] for channel, last in self.last.items()}
+        self.referenceTime = now
+
+    def GetStats(self):
+        return {"period":self.period, "active":self.active, "changes":len(self.changes), "periods":self.periods}
+
+    def Close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def FormatChange(change):
+    return "{:.6f}, {}, {}, {}, {}\n".format(change["pctimestamp"], change["timecode"],
+                                           "" if change["previous"] is None else change["previous"], change["period"], change["reason"])
+
+
+class PeriodSink(Sink):
+    '''runs a PeriodController on every sample, losslessly. A new stream starts it over'''
+    def __init__(self, controller, period=HistoryPeriod):
+        Sink.__init__(self, "period", period, None)
+        self.controller = controller
+
+    def Start(self):
+        self.controller.Reset()
+        Sink.Start(self)
+
+    def Write(self, batch):
+        self.controller.Process(batch.Columns())
+
+    def Close(self):
+        self.controller.Close()
+
+
+def AddController(connection, bounds):
+    '''adds a PeriodSink to a connection's pipeline that sets its period through
+    ApplyPeriod, watching the pipeline's trigger engine if it has one, and returns the
+    controller'''
+    engine = next((sink.engine for sink in connection.sinks.sinks if hasattr(sink, "engine")), None)
+    fastest, slowest = bounds
+    controller = PeriodController(fastest, slowest, connection.ApplyPeriod, engine, PyBry.PeriodLogFile)
+    connection.sinks.Add(PeriodSink(controller))
+    return controller
@@ -0,0 +1,431 @@
+'''
+====================================================
+BryArchive: compressed archive of raw packet captures
+====================================================
+
+Long-term storage of packets with their host timestamps, lossless and typically
+a few percent of the journal's size. Packets are collected in blocks; each block
+is transformed into redundancy-friendly columns and compressed with a stdlib
+codec (zlib, lzma or bz2)
+    payload     //runs of identical 20-byte payloads: the run lengths and each run's
+                //payload once, marker bytes left out when they are all 0x86
+    timecode    //difference to the previous packet's timecode (mod 2^32)
+    pctimestamp //float64 bits XOR the previous stamp's bits
+Every column is stored byte plane by byte plane (all first bytes, then all
+second bytes, ...), which turns the small differences into long zero runs
+
+file layout (<name>.brya)
+    header (32 bytes)
+        magic        //b'BRYA'
+        version      //format version (uint16)
+        headerSize   //uint16
+        blockRecords //packets per block the writer used (uint32)
+        created      //host time the archive was created (float64)
+    blocks
+        block header (64 bytes)
+            magic      //b'BRYB'
+            count      //packets (uint32)
+            runs       //payload runs (uint32)
+            tcMin/Max  //timecode range (uint32 each)
+            tMin/Max   //pctimestamp range, nan if unknown (float64 each)
+            codec      //Codecs id (uint8)
+            flags      //FlagNoMarkers (uint8)
+            size       //compressed body bytes (uint32)
+            bodyCRC    //crc32 of the compressed body (uint32)
+            dataCRC    //crc32 of the uncompressed body (uint32)
+        body (size bytes)
+    index (one IndexDtype entry per block) and trailer
+        indexOffset, blocks, indexCRC, magic b'BRYI'
+
+The block headers are the index too: a time range only decodes the blocks whose
+ranges overlap it. The index at the end saves reading them one by one; without
+it (the writer didn't get to Close) the reader walks the block headers and
+recovers every complete block
+
+Usage
+    with ArchiveWriter("capture.brya") as archive:
+        archive.AppendBatch(packets, stamps)
+    reader = ArchiveReader("capture.brya")
+    for packets, stamps in reader.ReadBlocks(t0=60000, t1=120000):
+        columns = decoder.DecodeBatch(packets)
+    python BryArchive.py logs/bench -o bench.brya      //converts any BryReplay capture
+    python BryArchive.py bench.brya --info             //block statistics and checksums
+'''
+
+import bz2
+import lzma
+import os
+import struct
+import sys
+import time
+import zlib
+import numpy as np
+
+from BryJournal import RecordDtype
+from PyBry import Nread
+
+
+ArchiveMagic     = b'BRYA'
+ArchiveVersion   = 1
+ArchiveExtension = '.brya'
+HeaderFormat     = '<4sHHId12x'
+HeaderSize       = 32
+BlockMagic       = b'BRYB'
+BlockFormat      = '<4sIIIIddBBxxIII12x'
+BlockHeaderSize  = 64
+TrailerMagic     = b'BRYI'
+TrailerFormat    = '<QII4s'
+TrailerSize      = 20
+IndexDtype       = np.dtype([("offset", '<u8'), ("first", '<u8'), ("count", '<u4'), ("tcMin", '<u4'), ("tcMax", '<u4'),
+                             ("tMin", '<f8'), ("tMax", '<f8')])
+
+PayloadBytes     = 20 #packet bytes before the timecode
+MarkerSlice      = slice(15, 19)
+MarkerByte       = 0x86
+FlagNoMarkers    = 1
+
+BlockRecords     = 65536 #packets per block (1.5 MB before compression)
+DefaultCodec     = "zlib"
+Codecs           = {
+    #name: (id, compress(data, level), decompress(data), default level)
+    "zlib": (1, lambda data, level: zlib.compress(data, level), zlib.decompress, 6),
+    "lzma": (2, lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 6),
+    "bz2":  (3, lambda data, level: bz2.compress(data, level), bz2.decompress, 9),
+    }
+CodecNames       = {codec[0]: name for name, codec in Codecs.items()}
+
+assert struct.calcsize(HeaderFormat) == HeaderSize and struct.calcsize(BlockFormat) == BlockHeaderSize
+assert struct.calcsize(TrailerFormat) == TrailerSize
+
+
+def ShuffleBytes(values):
+    '''the bytes of an array of fixed size items, plane by plane'''
+    n = len(values)
+    return np.ascontiguousarray(values).view(np.uint8).reshape(n, -1).T.tobytes()
+
+def UnshuffleBytes(data, offset, n, dtype):
+    '''inverse of ShuffleBytes for n items of dtype (or of raw rows, dtype an int width)
+    starting at offset. Returns the array and the offset after it'''
+    width = dtype if isinstance(dtype, int) else np.dtype(dtype).itemsize
+    planes = np.frombuffer(data, dtype=np.uint8, count=n * width, offset=offset).reshape(width, n)
+    rows = np.ascontiguousarray(planes.T)
+    return (rows if isinstance(dtype, int) else rows.view(dtype).reshape(n)), offset + n * width
+
+def EncodeBlock(packets, stamps):
+    '''the uncompressed body of a block, its number of payload runs and flags'''
+    n = len(packets)
+    payload = packets[:, :PayloadBytes]
+    flags = 0
+    starts = np.flatnonzero(np.concatenate(([True], np.any(payload[1:] != payload[:-1], axis=1))))
+    runs = np.diff(np.append(starts, n)).astype('<u4')
+    unique = payload[starts]
+    if np.all(unique[:, MarkerSlice] == MarkerByte):
+        unique = np.delete(unique, np.r_[MarkerSlice], axis=1)
+        flags |= FlagNoMarkers
+    timecodes = np.ascontiguousarray(packets[:, PayloadBytes:]).view('<u4').reshape(n)
+    deltas = np.diff(timecodes, prepend=np.uint32(0)).astype('<u4')
+    bits = np.asarray(stamps, dtype='<f8').view('<u8')
+    xored = bits ^ np.concatenate((np.zeros(1, dtype='<u8'), bits[:-1]))
+    body = b''.join([ShuffleBytes(runs), ShuffleBytes(unique), ShuffleBytes(deltas), ShuffleBytes(xored)])
+    return body, len(runs), flags
+
+def DecodeBlock(body, count, runs, flags):
+    '''(packets Nx24, pctimestamps) from the uncompressed body of a block'''
+    width = PayloadBytes - (MarkerSlice.stop - MarkerSlice.start if flags & FlagNoMarkers else 0)
+    runLengths, offset = UnshuffleBytes(body, 0, runs, '<u4')
+    unique, offset = UnshuffleBytes(body, offset, runs, width)
+    deltas, offset = UnshuffleBytes(body, offset, count, '<u4')
+    xored, offset = UnshuffleBytes(body, offset, count, '<u8')
+    if offset != len(body) or int(runLengths.sum()) != count:
+        raise ValueError("block body doesn't match its header")
+    packets = np.empty((count, Nread), dtype=np.uint8)
+    if flags & FlagNoMarkers:
+        unique = np.insert(unique, [MarkerSlice.start] * (MarkerSlice.stop - MarkerSlice.start), MarkerByte, axis=1)
+    packets[:, :PayloadBytes] = np.repeat(unique, runLengths, axis=0)
+    packets[:, PayloadBytes:] = np.cumsum(deltas, dtype='<u4').view(np.uint8).reshape(count, 4)
+    stamps = np.bitwise_xor.accumulate(xored).view('<f8')
+    return packets, stamps
+
+
+class ArchiveWriter:
+    '''
+    ====================================================================================
+    Writes an archive. Packets are collected in preallocated arrays and compressed a
+    block at a time, so Append is two copies and the codec runs once per blockRecords
+    packets. Close writes the last block and the index
+    ====================================================================================
+    '''
+    def __init__(self, path, blockRecords=BlockRecords, codec=DefaultCodec, level=None):
+        if codec not in Codecs:
+            raise ValueError("unknown codec {}, use one of {}".format(codec, ", ".join(Codecs)))
+        self.path = path
+        self.blockRecords = blockRecords
+        self.codecId, self.compress, decompress, defaultLevel = Codecs[codec]
+        self.level = defaultLevel if level is None else level
+        self.packets = np.empty((blockRecords, Nread), dtype=np.uint8)
+        self.stamps = np.empty(blockRecords)
+        self.fill = 0
+        self.index = []
+        self.written = 0 #packets in the written blocks
+        self.file = open(path, "wb")
+        self.file.write(struct.pack(HeaderFormat, ArchiveMagic, ArchiveVersion, HeaderSize, blockRecords, time.time()))
+
+    def Append(self, packet, pctimestamp):
+        self.packets[self.fill] = np.frombuffer(packet, dtype=np.uint8, count=Nread)
+        self.stamps[self.fill] = pctimestamp
+        self.fill += 1
+        if self.fill == self.blockRecords:
+            self.WriteBlock()
+
+    def AppendBatch(self, packets, stamps):
+        '''packets Nx24 uint8 (see PyBry.AsPacketArray) and their N pctimestamps'''
+        done = 0
+        while done < len(packets):
+            chunk = min(len(packets) - done, self.blockRecords - self.fill)
+            self.packets[self.fill:self.fill+chunk] = packets[done:done+chunk]
+            self.stamps[self.fill:self.fill+chunk] = stamps[done:done+chunk]
+            self.fill += chunk
+            done += chunk
+            if self.fill == self.blockRecords:
+                self.WriteBlock()
+
+    def WriteBlock(self):
+        if self.fill == 0:
+            return
+        packets, stamps = self.packets[:self.fill], self.stamps[:self.fill]
+        body, runs, flags = EncodeBlock(packets, stamps)
+        compressed = self.compress(body, self.level)
+        timecodes = np.ascontiguousarray(packets[:, PayloadBytes:]).view('<u4')
+        known = stamps[np.isfinite(stamps)]
+        entry = (self.file.tell(), self.written, self.fill, int(timecodes.min()), int(timecodes.max()),
+                 known.min() if len(known) else np.nan, known.max() if len(known) else np.nan)
+        self.file.write(struct.pack(BlockFormat, BlockMagic, self.fill, runs, entry[3], entry[4], entry[5], entry[6],
+                                    self.codecId, flags, len(compressed), zlib.crc32(compressed), zlib.crc32(body)))
+        self.file.write(compressed)
+        self.index.append(entry)
+        self.written += self.fill
+        self.fill = 0
+
+    def Close(self):
+        if self.file is None:
+            return
+        self.WriteBlock()
+        indexOffset = self.file.tell()
+        index = np.array(self.index, dtype=IndexDtype).tobytes()
+        self.file.write(index)
+        self.file.write(struct.pack(TrailerFormat, indexOffset, len(self.index), zlib.crc32(index), TrailerMagic))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+class ArchiveReader:
+    '''
+    ====================================================================================
+    Reads an archive. Blocks are decoded on demand and their checksums verified; a
+    damaged block raises ValueError. Records are addressed by index over all blocks
+    like in BryJournal.JournalReader, or selected by a timecode or pctimestamp range
+    ====================================================================================
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        header = self.file.read(HeaderSize)
+        if len(header) < HeaderSize or header[:4] != ArchiveMagic:
+            raise ValueError("not a packet archive: " + path)
+        magic, version, headerSize, self.blockRecords, self.created = struct.unpack(HeaderFormat, header)
+        if version > ArchiveVersion:
+            raise ValueError("unsupported archive version {} in {}".format(version, path))
+        self.headerSize = headerSize
+        self.recovered = False
+        self.blocks = self.ReadIndex()
+        if self.blocks is None:
+            self.blocks = self.ScanBlocks()
+            self.recovered = True
+        self.starts = np.append(self.blocks["first"], self.blocks["first"][-1] + self.blocks["count"][-1] if len(self.blocks) else 0)
+        self.cached = (None, None) #last decoded block: (number, (packets, stamps))
+
+    def ReadIndex(self):
+        '''the index at the end of the file, None if it is missing or damaged'''
+        size = self.file.seek(0, os.SEEK_END)
+        if size < self.headerSize + TrailerSize:
+            return None
+        self.file.seek(size - TrailerSize)
+        indexOffset, blocks, crc, magic = struct.unpack(TrailerFormat, self.file.read(TrailerSize))
+        if magic != TrailerMagic or indexOffset + blocks * IndexDtype.itemsize != size - TrailerSize:
+            return None
+        self.file.seek(indexOffset)
+        data = self.file.read(blocks * IndexDtype.itemsize)
+        if zlib.crc32(data) != crc:
+            return None
+        return np.frombuffer(data, dtype=IndexDtype)
+
+    def ScanBlocks(self):
+        '''rebuilds the index from the block headers, up to the first incomplete block'''
+        size = self.file.seek(0, os.SEEK_END)
+        entries, offset, first = [], self.headerSize, 0
+        while offset + BlockHeaderSize <= size:
+            self.file.seek(offset)
+            fields = struct.unpack(BlockFormat, self.file.read(BlockHeaderSize))
+            magic, count, runs, tcMin, tcMax, tMin, tMax, codec, flags, compressedSize = fields[:10]
+            if magic != BlockMagic or offset + BlockHeaderSize + compressedSize > size:
+                break
+            entries.append((offset, first, count, tcMin, tcMax, tMin, tMax))
+            offset += BlockHeaderSize + compressedSize
+            first += count
+        return np.array(entries, dtype=IndexDtype)
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def Close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+    def ReadBlock(self, number):
+        '''(packets Nx24, pctimestamps) of a block, its checksums verified'''
+        if self.cached[0] == number:
+            return self.cached[1]
+        self.file.seek(int(self.blocks["offset"][number]))
+        magic, count, runs, tcMin, tcMax, tMin, tMax, codec, flags, compressedSize, bodyCRC, dataCRC = struct.unpack(BlockFormat, self.file.read(BlockHeaderSize))
+        if magic != BlockMagic:
+            raise ValueError("block {} of {} is damaged".format(number, self.path))
+        compressed = self.file.read(compressedSize)
+        if len(compressed) != compressedSize or zlib.crc32(compressed) != bodyCRC:
+            raise ValueError("checksum error in block {} of {}".format(number, self.path))
+        if codec not in CodecNames:
+            raise ValueError("unknown codec {} in block {} of {}".format(codec, number, self.path))
+        body = Codecs[CodecNames[codec]][2](compressed)
+        if zlib.crc32(body) != dataCRC:
+            raise ValueError("checksum error in decompressed block {} of {}".format(number, self.path))
+        block = DecodeBlock(body, count, runs, flags)
+        self.cached = (number, block)
+        return block
+
+    def Read(self, start, stop):
+        '''(packets Nx24, pctimestamps) of records [start, stop)'''
+        start, stop = max(start, 0), min(stop, len(self))
+        packets, stamps = [], []
+        number = int(np.searchsorted(self.starts, start, side='right')) - 1
+        while start < stop:
+            blockPackets, blockStamps = self.ReadBlock(number)
+            i0 = start - int(self.starts[number])
+            i1 = min(stop - int(self.starts[number]), len(blockPackets))
+            packets.append(blockPackets[i0:i1])
+            stamps.append(blockStamps[i0:i1])
+            start += i1 - i0
+            number += 1
+        if not packets:
+            return np.empty((0, Nread), dtype=np.uint8), np.empty(0)
+        return (packets[0], stamps[0]) if len(packets) == 1 else (np.concatenate(packets), np.concatenate(stamps))
+
+    def BlocksInRange(self, t0=None, t1=None, key="timecode"):
+        '''numbers of the blocks that may hold records with t0 <= key < t1'''
+        low, high = (self.blocks["tcMin"], self.blocks["tcMax"]) if key == "timecode" else (self.blocks["tMin"], self.blocks["tMax"])
+        keep = np.ones(len(self.blocks), dtype=bool)
+        if t0 is not None: keep &= high >= t0
+        if t1 is not None: keep &= low < t1
+        return np.flatnonzero(keep)
+
+    def ReadBlocks(self, t0=None, t1=None, key="timecode"):
+        '''yields (packets, pctimestamps) block by block, only the records with t0 <= key < t1
+        (key "timecode" in ms or "pctimestamp" in seconds, None meaning open). Blocks
+        outside the range are not read'''
+        for number in self.BlocksInRange(t0, t1, key):
+            packets, stamps = self.ReadBlock(number)
+            if t0 is None and t1 is None:
+                yield packets, stamps
+                continue
+            values = np.ascontiguousarray(packets[:, PayloadBytes:]).view('<u4').reshape(-1) if key == "timecode" else stamps
+            keep = np.ones(len(packets), dtype=bool)
+            if t0 is not None: keep &= values >= t0
+            if t1 is not None: keep &= values < t1
+            if np.any(keep):
+                yield packets[keep], stamps[keep]
+
+    def Packets(self, t0=None, t1=None, key="timecode"):
+        '''yields (packet bytes, pctimestamp) one at a time for BrymenDecoder.DecodePacket'''
+        for packets, stamps in self.ReadBlocks(t0, t1, key):
+            for packet, stamp in zip(packets, stamps.tolist()):
+                yield packet.tobytes(), stamp
+
+    def LoadHistory(self, history, decoder, t0=None, t1=None, key="timecode"):
+        '''decodes the archive, or a range of it, into a SampleHistory with the batch decoder'''
+        for packets, stamps in self.ReadBlocks(t0, t1, key):
+            columns = decoder.DecodeBatch(packets)
+            columns["pctimestamp"] = stamps
+            history.AddBatchToHistory(columns)
+
+    def Verify(self):
+        '''decodes every block. Returns a list of (block number, error) of the damaged ones'''
+        errors = []
+        for number in range(len(self.blocks)):
+            try:
+                self.ReadBlock(number)
+            except (ValueError, zlib.error, lzma.LZMAError, OSError, EOFError) as ex:
+                errors.append((number, str(ex)))
+        return errors
+
+
+def Convert(capture, outFile, kind=None, codec=DefaultCodec, level=None, blockRecords=BlockRecords):
+    '''archives any capture BryReplay reads. Returns the number of packets'''
+    import BryReplay
+    count = 0
+    with ArchiveWriter(outFile, blockRecords, codec, level) as archive:
+        for packets, stamps, skipped in BryReplay.ReadCaptureBlocks(capture, kind):
+            archive.AppendBatch(packets, stamps)
+            count += len(packets)
+    return count
+
+def PrintInfo(path):
+    with ArchiveReader(path) as reader:
+        size = os.path.getsize(path)
+        print("{}: {} packets in {} blocks, {} bytes ({:.1f} bytes/packet, {:.1f}x smaller than a journal){}".format(
+            path, len(reader), len(reader.blocks), size, size / max(len(reader), 1),
+            len(reader) * RecordDtype.itemsize / max(size, 1), ", index recovered from block headers" if reader.recovered else ""))
+        if len(reader.blocks):
+            print("timecode {} .. {} ms, pctimestamp {:.3f} .. {:.3f}".format(
+                reader.blocks["tcMin"].min(), reader.blocks["tcMax"].max(), np.nanmin(reader.blocks["tMin"]) if np.any(np.isfinite(reader.blocks["tMin"])) else np.nan,
+                np.nanmax(reader.blocks["tMax"]) if np.any(np.isfinite(reader.blocks["tMax"])) else np.nan))
+        errors = reader.Verify()
+        for number, error in errors:
+            print("block {}: {}".format(number, error))
+        print("checksums", "ok" if not errors else "{} damaged blocks".format(len(errors)))
+        return len(errors) == 0
+
+def Main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Write or inspect compressed Brymen packet archives")
+    parser.add_argument("capture", help="capture to archive (see BryReplay), or an archive with --info")
+    parser.add_argument("-o", "--output", help="archive to write")
+    parser.add_argument("--kind", choices=["raw", "journal", "hex", "archive"], help="capture type (detected by default)")
+    parser.add_argument("--codec", choices=list(Codecs), default=DefaultCodec, help="block compression")
+    parser.add_argument("--level", type=int, help="compression level of the codec")
+    parser.add_argument("--block", type=int, default=BlockRecords, help="packets per block")
+    parser.add_argument("--info", action="store_true", help="print an archive's blocks and verify its checksums")
+    args = parser.parse_args(argv)
+
+    if args.info:
+        return 0 if PrintInfo(args.capture) else 1
+    if not args.output:
+        parser.error("give the archive to write with -o, or --info")
+    began = time.perf_counter()
+    count = Convert(args.capture, args.output, args.kind, args.codec, args.level, args.block)
+    seconds = time.perf_counter() - began
+    size = os.path.getsize(args.output)
+    print("{} packets in {:.3f} s, {} bytes ({:.1f} bytes/packet)".format(count, seconds, size, size / max(count, 1)), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
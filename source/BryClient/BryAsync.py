@@ -0,0 +1,146 @@
+'''
+====================================================
+BryAsync: asyncio variant of the serial Connection
+====================================================
+
+Packets are framed and recorded from the event loop as the bytes arrive, the
+watchdog reset is a loop timer and commands are written through the transport.
+Needs the optional pyserial-asyncio package
+
+Usage
+    connection = AsyncConnection()
+    await connection.Open("/dev/ttyUSB0")
+    ...
+    await connection.Close()
+'''
+
+import asyncio
+import time
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+import PyBry
+from PyBry import Connection, PacketFramer, JournalWriter, WatchdogResetPeriod
+
+
+class BrymenProtocol(asyncio.Protocol):
+    '''forwards the transport callbacks to an AsyncConnection'''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def connection_made(self, transport):
+        self.connection.ConnectionMade(transport)
+
+    def data_received(self, data):
+        self.connection.DataReceived(data)
+
+    def connection_lost(self, exc):
+        self.connection.ConnectionLost(exc)
+
+
+class AsyncConnection(Connection):
+    '''
+    ====================================================================================
+    Connection driven by an asyncio serial transport instead of a sampling thread.
+    All methods must be called from the event loop
+    ====================================================================================
+    '''
+    def __init__(self, journalBase=PyBry.JournalBase, history=None, clock=time.time, serverAddress=PyBry.ServerAddress, sinks=None, model=None):
+        Connection.__init__(self, journalBase, history, clock, serverAddress, sinks, model)
+        self.transport = None
+        self.loop = None
+        self.framer = PacketFramer()
+        self.closed = None
+
+    async def Open(self, portName, baudrate=9600):
+        if serial_asyncio is None:
+            raise ImportError("AsyncConnection needs the pyserial-asyncio package")
+        self.portName = portName
+        self.loop = asyncio.get_running_loop()
+        self.closed = self.loop.create_future()
+        await serial_asyncio.create_serial_connection(self.loop, lambda: BrymenProtocol(self), portName, baudrate=baudrate)
+
+    async def Close(self):
+        if self.transport is not None:
+            self.Stop()
+            self.transport.close()
+            await self.closed
+        Connection.Close(self)
+
+    def ConnectionMade(self, transport):
+        self.transport = transport
+        self.ser = getattr(transport, "serial", None)
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        if self.journalBase:
+            self.journal = JournalWriter(self.journalBase)
+        self.threadRunning = True
+        self.sinks.Start()
+        #the Arduino resets on connect and starts sampling by itself
+        self.Go()
+
+    def DataReceived(self, data):
+        framer = self.framer
+        while data:
+            taken = framer.Feed(data)
+            data = data[taken:]
+            skipped = framer.bytesSkipped
+            for frame in framer.Frames():
+                #the sample outlives the framer's buffer, so keep a copy of the bytes
+                self.ProcessPacket(bytes(frame), self.clock())
+            if PyBry.DebugOn and framer.bytesSkipped != skipped:
+                print("invalid data stream: skipped {} bytes".format(framer.bytesSkipped - skipped))
+
+    def ConnectionLost(self, exc):
+        if exc is not None:
+            print("Serial port Exception " + self.portName)
+        self.StopWatchdog()
+        self.sinks.Stop()
+        if self.journal is not None:
+            self.journal.Close()
+            self.journal = None
+        self.transport = None
+        self.ser = None
+        self.threadRunning = False
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+
+    def SendCommand(self, cmd):
+        if self.transport is not None:
+            self.transport.write(cmd.encode())
+
+    def StartWatchdog(self):
+        self.StopWatchdog()
+        self.ResetWatchdog()
+        self.watchdogTimer = self.loop.call_later(WatchdogResetPeriod, self.StartWatchdog)
+
+    def Go(self):
+        '''starts sampling. Unlike Connection.Start this doesn't open the port'''
+        self.SendCommand("[Go]")
+        self.framer.Reset()
+        self.runEvent.set()
+        self.StartWatchdog()
+
+    def Stop(self):
+        self.StopWatchdog()
+        self.SendCommand("[Stop]")
+        self.runEvent.clear()
+
+    def SetPeriod(self, period):
+        '''period in ms, or a text control holding it'''
+        if hasattr(period, "text"):
+            period = period.text()
+        self.SendCommand("[Per={}]".format(period))
+        if self.periodController is not None and self.transport is not None:
+            self.periodController.Manual(period)
+
+    def ApplyPeriod(self, period):
+        '''called from the period controller's sink thread, the command goes through the
+        loop. Tells if the port was open'''
+        if self.loop is not None and self.transport is not None:
+            self.loop.call_soon_threadsafe(self.SendCommand, "[Per={}]".format(period))
+            return True
+        return False
@@ -0,0 +1,271 @@
+'''
+====================================================
+BryBench: benchmark suite
+====================================================
+
+Times the decoder, framing, history, export and graph data paths on a synthetic
+corpus (BryCorpus) and reports ops/sec and peak traced memory per case. Results
+are written to a JSON baseline; --compare checks a run against one and exits with
+1 if a case got slower than the tolerance allows
+
+Before timing anything it checks that the decoder paths agree on the corpus
+(CheckDecoders), for every meter model of BryLayout: DecodeBatch against
+DecodePacket of every packet, and DecodePacket's compiled decoder against
+UnpackBytes and DecodeUnpackedData. Any mismatch is printed and the exit code is 1
+
+Usage
+    python BryBench.py --full -o BryBench.json           //run and save a baseline, as committed
+    python BryBench.py --compare BryBench.json           //run and compare
+    python BryBench.py --sizes 1e5,1e6 -k History
+    python BryBench.py --check                           //only the decoder check
+'''
+
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Mapping
+import numpy as np
+
+import PyBry
+import BryLayout
+from PyBry import BrymenDecoder, PacketFramer, SampleHistory, EncodeSample
+import BryCorpus
+from BryReplay import FramePackets
+
+
+DefaultSizes   = [1000, 10000, 100000, 1000000]
+FullSizes      = DefaultSizes + [10000000] #--full, a few GB of RAM at the largest size
+CorpusSize     = 20000
+Repeats        = 3
+Tolerance      = 0.25 #allowed ops/sec loss against the baseline
+AppendSamples  = 10000 #AddSampleToHistory calls timed on a prefilled history
+PlotPixels     = 1000
+ShowMismatches = 10 #mismatches CheckDecoders prints per check
+
+
+def TileColumns(columns, n, period=200):
+    '''repeats decoded columns to n rows with increasing timecodes'''
+    tiled = {name: np.resize(col, (n,) + col.shape[1:]) for name, col in columns.items()}
+    tiled["timecode"] = (np.arange(n, dtype=np.uint64) * period).astype(np.uint32)
+    tiled["pctimestamp"] = 1.7e9 + np.arange(n) * (period / 1000.0)
+    return tiled
+
+def Samples(decoder, packets, n):
+    '''sample dicts as the decoder's DecodePacket fills them'''
+    samples = []
+    for i in range(n):
+        inbytes = packets[i % len(packets)].tobytes()
+        sample = {"inbytes":inbytes, "pctimestamp":1.7e9 + i}
+        sample["timecode"], sample["state"], sample["measureUpper"], sample["measureLower"], unpacked = decoder.DecodePacket(inbytes)
+        samples.append(sample)
+    return samples
+
+def SameValue(a, b):
+    '''equality with nan equal to nan, through mappings, lists and tuples'''
+    if isinstance(a, Mapping) and isinstance(b, Mapping):
+        return a.keys() == b.keys() and all(SameValue(a[key], b[key]) for key in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(SameValue(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) and isinstance(b, float) and a != a and b != b:
+        return True
+    return a == b
+
+def CheckDecoders(n=CorpusSize, out=sys.stdout):
+    '''decodes the corpus with every model of BryLayout.Models, with DecodeBatch, with
+    DecodePacket (the compiled decoder) and with UnpackBytes and DecodeUnpackedData,
+    and compares the results. Prints the mismatches and returns how many there were'''
+    packets, modes = BryCorpus.GenerateCorpus(n, seed=1)
+    mismatches = 0
+    for model in BryLayout.Models:
+        decoder = BrymenDecoder(cacheSize=0, model=model)
+        columns = decoder.DecodeBatch(packets)
+        found = 0
+        for i, packet in enumerate(packets):
+            inbytes = packet.tobytes()
+            decoded = decoder.DecodePacket(inbytes)
+            unpacked = decoder.UnpackBytes(inbytes)
+            differ = [] if SameValue(decoded, decoder.DecodeUnpackedData(unpacked) + (unpacked,)) else ["compiled decoder != UnpackBytes+DecodeUnpackedData"]
+            sample = {"inbytes":inbytes, "pctimestamp":0.0}
+            sample["timecode"], sample["state"], sample["measureUpper"], sample["measureLower"], unpacked = decoded
+            row = EncodeSample(sample)
+            columnsDiffer = [name for name, col in columns.items() if not np.array_equal(col[i], row[name], equal_nan=col.dtype.kind == "f")]
+            if columnsDiffer:
+                differ.append("DecodeBatch != DecodePacket in " + ", ".join(columnsDiffer))
+            if differ:
+                if found < ShowMismatches:
+                    print("{} packet {} ({}): {}".format(model, i, modes[i], "; ".join(differ)), file=out)
+                found += 1
+        print("decoder check {}: {} packets, {} mismatches".format(model, len(packets), found), file=out)
+        mismatches += found
+    return mismatches
+
+def BuildCases(sizes):
+    '''yields (name, ops, run) per case. Setup happens before the yield so it isn't timed'''
+    packets, modes = BryCorpus.GenerateCorpus(CorpusSize, seed=1)
+    packetBytes = [packet.tobytes() for packet in packets]
+    decoder = BrymenDecoder(cacheSize=0)
+
+    #decoder
+    yield "UnpackBytes", len(packetBytes), lambda: [decoder.UnpackBytes(b) for b in packetBytes]
+    unpacked = [decoder.UnpackBytes(b) for b in packetBytes]
+    yield "DecodeMeasurement", len(unpacked), lambda: [decoder.DecodeMeasurement(u["lower"]) for u in unpacked]
+    yield "DecodeUnpackedData", len(unpacked), lambda: [decoder.DecodeUnpackedData(u) for u in unpacked]
+    yield "DecodeCompiled", len(packetBytes), lambda: [decoder.compiled(b) for b in packetBytes]
+    steady = [packetBytes[0][:20] + i.to_bytes(4, 'little') for i in range(len(packetBytes))]
+    cached = BrymenDecoder()
+    yield "DecodePacket steady", len(steady), lambda: [cached.DecodePacket(b) for b in steady]
+    yield "DecodeBatch", len(packets), lambda: decoder.DecodeBatch(packets)
+    columns = decoder.DecodeBatch(packets)
+    samples = Samples(decoder, packets, AppendSamples)
+    yield "EncodeSample", len(samples), lambda: [EncodeSample(s) for s in samples]
+
+    #framing and resync on a misaligned stream with garbage and truncated frames
+    stream = BryCorpus.CorruptStream(packets, seed=1)
+    def Frame():
+        framer = PacketFramer()
+        count = 0
+        for start in range(0, len(stream), 4096):
+            framer.Feed(stream[start:start+4096])
+            for frame in framer.Frames():
+                count += 1
+        return count
+    yield "PacketFramer corrupt", len(packets), Frame
+    yield "FramePackets corrupt", len(packets), lambda: FramePackets(stream)
+
+    #history, export and graph data at each size
+    for size in sizes:
+        yield from HistoryCases(columns, samples, size)
+
+def HistoryCases(columns, samples, size):
+    '''the history cases of BuildCases at one size. Their histories are freed when the
+    generator moves on to the next size'''
+    tiled = TileColumns(columns, size)
+    appended = SampleHistory(capacity=size)
+    appended.AddBatchToHistory(tiled)
+    yield "AddSampleToHistory @{:.0e}".format(size), len(samples), lambda: [appended.AddSampleToHistory(s) for s in samples]
+    appended = None #freed before the next histories of this size
+
+    def AddBatch():
+        target = SampleHistory(capacity=size)
+        for start in range(0, size, 65536):
+            target.AddBatchToHistory({name: col[start:start+65536] for name, col in tiled.items()})
+    yield "AddBatchToHistory @{:.0e}".format(size), size, AddBatch
+
+    history = SampleHistory(capacity=size)
+    history.AddBatchToHistory(tiled)
+    first, last = float(tiled["timecode"][0]), float(tiled["timecode"][-1])
+    def Plot():
+        for channel in ["valueLower", "valueUpper"]:
+            history.GetPlotData(channel, None, None, PlotPixels)
+        history.GetLabels()
+        history.GetLatestSample()
+    yield "GraphData full @{:.0e}".format(size), 1, Plot
+    def Zoom():
+        #ten views across the history, a tenth of it wide each
+        width = (last - first) / 10
+        for i in range(10):
+            history.GetPlotData("valueLower", first + i*width, first + (i+1)*width, PlotPixels)
+    yield "GraphData zoom @{:.0e}".format(size), 10, Zoom
+
+    fileName = os.path.join(tempfile.gettempdir(), "BryBench.csv")
+    def Export():
+        history.exportCSV(fileName)
+        os.remove(fileName)
+    yield "exportCSV @{:.0e}".format(size), size, Export
+
+def TimeImport(module="PyBry"):
+    '''cold import time of a module in a fresh interpreter, best of Repeats'''
+    code = "import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)".format(module)
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = [float(subprocess.check_output([sys.executable, "-c", code], cwd=here)) for i in range(Repeats)]
+    return min(times)
+
+def RunCase(ops, run, repeats):
+    best = float('inf')
+    for i in range(repeats):
+        t = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - t)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"ops":ops, "seconds":best, "opsPerSec":ops / best if best > 0 else float('inf'), "peakBytes":peak}
+
+def RunSuite(sizes=DefaultSizes, pattern=None, repeats=Repeats, out=sys.stdout):
+    results = {}
+    print("{:<32} {:>14} {:>12} {:>12}".format("case", "ops/sec", "seconds", "peak MB"), file=out)
+    for name, ops, run in BuildCases(sizes):
+        if pattern and not re.search(pattern, name):
+            continue
+        result = RunCase(ops, run, repeats if ops < 1000000 else 1)
+        results[name] = result
+        print("{:<32} {:>14.1f} {:>12.4f} {:>12.2f}".format(name, result["opsPerSec"], result["seconds"], result["peakBytes"] / 2**20), file=out)
+    if not pattern or re.search(pattern, "import PyBry"):
+        seconds = TimeImport()
+        results["import PyBry"] = {"ops":1, "seconds":seconds, "opsPerSec":1 / seconds, "peakBytes":0}
+        print("{:<32} {:>14.1f} {:>12.4f}".format("import PyBry", 1 / seconds, seconds), file=out)
+    return results
+
+def Compare(results, baseline, tolerance=Tolerance, out=sys.stdout):
+    '''prints the ops/sec ratio of each case against the baseline and returns the names
+    of the cases slower than the tolerance allows'''
+    regressions = []
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        ratio = result["opsPerSec"] / old["opsPerSec"]
+        flag = ""
+        if ratio < 1 - tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("{:<32} {:>8.2f}x{}".format(name, ratio, flag), file=out)
+    return regressions
+
+def Main(argv=None):
+    parser = argparse.ArgumentParser(description="PyBry benchmark suite")
+    parser.add_argument("-o", "--output", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=Tolerance, help="allowed relative ops/sec loss")
+    parser.add_argument("--sizes", help="history sizes, comma separated (default {})".format(",".join(str(size) for size in DefaultSizes)))
+    parser.add_argument("--full", action="store_true", help="history sizes up to 1e7 ({})".format(",".join(str(size) for size in FullSizes)))
+    parser.add_argument("-k", "--filter", help="only run cases matching this regular expression")
+    parser.add_argument("--repeats", type=int, default=Repeats)
+    parser.add_argument("--check", action="store_true", help="only check that the decoder paths agree")
+    args = parser.parse_args(argv)
+
+    PyBry.DebugOn = False
+    if CheckDecoders():
+        return 1
+    if args.check:
+        return 0
+    if args.sizes:
+        sizes = [int(float(size)) for size in args.sizes.split(",")]
+    else:
+        sizes = FullSizes if args.full else DefaultSizes
+    results = RunSuite(sizes, args.filter, args.repeats)
+
+    if args.output:
+        baseline = {"python":platform.python_version(), "numpy":np.__version__, "machine":platform.machine(),
+                    "platform":platform.platform(), "created":time.strftime("%Y-%m-%d %H:%M:%S"), "results":results}
+        with open(args.output, "w") as f:
+            json.dump(baseline, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("\nagainst " + args.compare, file=sys.stdout)
+        if Compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -0,0 +1,160 @@
+'''
+====================================================
+BryCorpus: synthetic Brymen packet corpus
+====================================================
+
+Builds valid 24-byte frames from display text and annunciator flags, the inverse
+of BrymenDecoder, and generates corpora covering every mode the decoder handles:
+V/A/Ω/Hz/F/S/dBm/duty, temperatures T1/T2/diff, diode, nS conductance, overload,
+negative values and every decimal point position. CorruptStream turns a corpus
+into a misaligned byte stream with garbage, truncated frames and bit errors
+
+Usage
+    packets, modes = GenerateCorpus(100000, seed=1)
+    stream = CorruptStream(packets, seed=1)
+'''
+
+import numpy as np
+
+from PyBry import BrymenDecoder, Nread
+
+
+MarkerBytes = slice(15, 19)
+MarkerByte  = 0x86
+
+SegmentBytes = {char: byte for byte, char in BrymenDecoder.segments.items()}
+
+#lower display modes: (name, annunciator flags, value prefixes to pick from, temperature unit character)
+LowerModes = [
+    ("DC V",        ["DC", "V"],      ["", "m"],           None),
+    ("AC V",        ["AC", "V"],      ["", "m"],           None),
+    ("DC+AC V",     ["DC", "AC", "V"], [""],               None),
+    ("DC A",        ["DC", "A"],      ["", "m", "µ"],      None),
+    ("AC A",        ["AC", "A"],      ["", "m", "µ"],      None),
+    ("Resistance",  ["Ohm"],          ["", "k", "M"],      None),
+    ("Frequency",   ["Hz"],           ["", "k", "M"],      None),
+    ("Capacitance", ["F"],            ["n", "µ", "m"],     None),
+    ("Conductance", ["S"],            ["n"],               None),
+    ("dBm",         ["dB"],           [""],                None),
+    ("Duty",        ["Duty"],         [""],                None),
+    ("T1",          ["T1"],           [""],                "C"),
+    ("T2",          ["T2"],           [""],                "F"),
+    ("TempDiff",    ["TempDiff"],     [""],                "C"),
+    ("Diode",       ["DC", "V"],      [""],                None),
+    ("Overload",    ["Ohm"],          ["M"],               None),
+    ]
+
+#upper display modes: (name, flags, prefixes)
+UpperModes = [
+    ("Blank",     [],           [""]),
+    ("Hz",        ["Hz"],       ["", "k"]),
+    ("AC V",      ["AC", "V"],  ["", "m"]),
+    ("A",         ["A"],        ["m", "µ"]),
+    ("T2",        ["T2"],       [""]),
+    ]
+
+
+def EncodeDisplay(packet, layout, text, flags):
+    '''writes a display into packet. text holds the shown characters with an optional
+    leading '-' (the Neg annunciator) and '.' (a decimal point)'''
+    first, count = layout["digits"]
+    if text.startswith('-'):
+        flags = list(flags) + ["Neg"]
+        text = text[1:]
+    dotPos = text.find('.')
+    chars = text.replace('.', '')
+    if len(chars) != count:
+        raise ValueError("display text '{}' needs {} characters".format(text, count))
+    for i, char in enumerate(chars):
+        packet[first + i] = SegmentBytes[char]
+    if dotPos > 0:
+        packet[layout["dec"][dotPos - 1]] |= 1
+    for flag in flags:
+        byte, bit = layout["flags"][flag]
+        packet[byte] |= 1 << bit
+
+def MakePacket(lowerText, lowerFlags=(), upperText="    ", upperFlags=(), state=(), timecode=0):
+    '''builds a 24-byte frame. state holds names of BrymenDecoder.batchStateBits'''
+    packet = bytearray(Nread)
+    layout = BrymenDecoder.batchLayout
+    EncodeDisplay(packet, layout["lower"], lowerText, lowerFlags)
+    EncodeDisplay(packet, layout["upper"], upperText, upperFlags)
+    for name in state:
+        byte, bit = BrymenDecoder.batchStateBits[name]
+        packet[byte] |= 1 << bit
+    packet[MarkerBytes] = bytes([MarkerByte]) * 4
+    packet[20:24] = (timecode & 0xFFFFFFFF).to_bytes(4, 'little')
+    return bytes(packet)
+
+def RandomText(rng, count, decimals, negative, suffix=None):
+    '''random digits with a decimal point at a random position (or none) and an optional
+    sign and trailing temperature character. Unsigned values are sometimes shown with
+    leading blanks instead of zeros'''
+    room = count - (1 if suffix else 0)
+    text = ''.join(str(d) for d in rng.integers(0, 10, room))
+    dotPos = int(rng.integers(0, min(decimals, room - 1) + 1))
+    if not negative and rng.random() < 0.2:
+        blanks = int(rng.integers(1, room))
+        dotPos = dotPos if dotPos > blanks else 0
+        text = ' ' * blanks + text[blanks:]
+    if dotPos > 0:
+        text = text[:dotPos] + '.' + text[dotPos:]
+    if suffix:
+        text += suffix
+    return ("-" + text) if negative else text
+
+def GenerateCorpus(n, seed=1, period=200, lowerModes=None):
+    '''returns (packets Nx24 uint8, mode names) cycling through the lower display modes
+    with random values, decimal points, signs, upper displays and state flags'''
+    rng = np.random.default_rng(seed)
+    lowerModes = lowerModes or LowerModes
+    layout = BrymenDecoder.batchLayout
+    lowerDecimals = len(layout["lower"]["dec"])
+    upperDecimals = len(layout["upper"]["dec"])
+    states = [(), (), (), ("Hold",), ("Min",), ("Max",), ("Avg",), ("Record",), ("Crest",)]
+
+    packets = np.empty((n, Nread), dtype=np.uint8)
+    names = []
+    for i in range(n):
+        name, flags, prefixes, tempChar = lowerModes[i % len(lowerModes)]
+        flags = list(flags) + [prefixes[int(rng.integers(0, len(prefixes)))]]
+        flags = [flag for flag in flags if flag]
+        negative = ("DC" in flags or "dB" in flags or tempChar is not None) and rng.random() < 0.3
+
+        upperName, upperFlags, upperPrefixes = UpperModes[int(rng.integers(0, len(UpperModes)))]
+        upperText = "    "
+        if name == "Diode":
+            upperText, upperFlags = "diod", []
+        elif name == "Overload":
+            lowerText = "  0L  "
+        elif upperName != "Blank":
+            upperFlags = list(upperFlags) + [upperPrefixes[int(rng.integers(0, len(upperPrefixes)))]]
+            upperFlags = [flag for flag in upperFlags if flag]
+            upperText = RandomText(rng, 4, upperDecimals, False)
+        if name != "Overload":
+            lowerText = RandomText(rng, 6, lowerDecimals, negative, tempChar)
+
+        state = states[int(rng.integers(0, len(states)))]
+        packets[i] = np.frombuffer(MakePacket(lowerText, flags, upperText, upperFlags, state, i * period), dtype=np.uint8)
+        names.append(name)
+    return packets, names
+
+def CorruptStream(packets, seed=1, garbage=0.02, truncated=0.01, bitErrors=0.0, offset=7):
+    '''returns the packets as one byte stream that starts misaligned (offset garbage
+    bytes), has garbage runs between frames and truncated frames, and optionally
+    flipped bits. Rates are per frame'''
+    rng = np.random.default_rng(seed)
+    chunks = [rng.integers(0, 256, offset, dtype=np.uint8).tobytes()]
+    for packet in packets:
+        roll = rng.random()
+        if roll < garbage:
+            chunks.append(rng.integers(0, 256, int(rng.integers(1, 2 * Nread)), dtype=np.uint8).tobytes())
+        elif roll < garbage + truncated:
+            chunks.append(bytes(packet[:int(rng.integers(1, Nread))]))
+        chunks.append(bytes(packet))
+    stream = bytearray(b''.join(chunks))
+    if bitErrors > 0:
+        flips = rng.random(len(stream) * 8) < bitErrors / (Nread * 8)
+        for position in np.flatnonzero(flips).tolist():
+            stream[position >> 3] ^= 1 << (position & 7)
+    return bytes(stream)
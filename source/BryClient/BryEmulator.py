@@ -0,0 +1,471 @@
+'''
+====================================================
+BryEmulator: software stand-in for the BryArduino bridge
+====================================================
+
+Bryduino implements the protocol of BryArduino.ino: [Stop], [Go], [Rst] and
+[Per=N] commands, the watchdog that stops sampling when nobody resets it, 24-byte
+frames (20 payload bytes, little-endian millis timecode) and the reset on connect.
+Payloads come from a script of packets (BryCorpus.MakePacket) or a random corpus.
+Sample periods can be divided by a speedup factor and the baud limit lifted, to
+run far above what 9600 baud allows, and Faults injects byte loss, garbage,
+truncated frames, bit errors and a misaligned start
+
+Links
+    LoopPort    //in-process: duck-types serial.Serial for Connection.OpenPort
+    PtyLink     //a pseudo-terminal (POSIX) any serial client can open by name
+
+Usage
+    python BryEmulator.py --pty --speedup 10                  //serve until Ctrl-C
+    python BryEmulator.py --stress 1000,10000,100000 --loss 0.001
+
+    device = Bryduino(speedup=100)
+    conn = Connection()
+    conn.OpenPort = lambda: LoopPort(device)
+'''
+
+import argparse
+import contextlib
+import errno
+import os
+import sys
+import threading
+import time
+from array import array
+import numpy as np
+
+import PyBry
+from PyBry import Nread, ReadTimeout
+import BryCorpus
+
+
+#constants of BryArduino.ino
+SamplePeriod     = 200 #ms
+TimeoutWatchdog  = 5 * 60 * 1000 #ms
+Baud             = 9600 #bits/s, 10 bits per byte on the wire
+TxBufferSize     = 64 #bytes, the Arduino serial transmit buffer
+
+TickPeriod       = 0.001 #seconds between device loop iterations
+MaxBurst         = 1000 #frames per tick, the schedule restarts when it falls further behind
+HostBufferSize   = 4096 #bytes the host side of a LoopPort buffers, like an OS serial buffer
+CorpusSize       = 1000 #random packets played back when no script is given
+
+
+class Faults:
+    '''
+    ====================================================================================
+    Faults: damages outgoing frames. Rates are per frame: loss drops one byte of it,
+    garbage sends a run of random bytes before it, truncated sends a partial copy
+    before it and bitErrors is the expected number of flipped bits. offset garbage
+    bytes are sent after each reset, so the stream starts misaligned
+    ====================================================================================
+    '''
+    def __init__(self, loss=0.0, garbage=0.0, truncated=0.0, bitErrors=0.0, offset=0, seed=1):
+        self.loss = loss
+        self.garbage = garbage
+        self.truncated = truncated
+        self.bitErrors = bitErrors
+        self.offset = offset
+        self.rng = np.random.default_rng(seed)
+
+    def Start(self):
+        return self.rng.integers(0, 256, self.offset, dtype=np.uint8).tobytes()
+
+    def Apply(self, frame):
+        '''returns (bytes to send, True if the frame itself arrives undamaged)'''
+        rng = self.rng
+        prefix = b''
+        if self.garbage and rng.random() < self.garbage:
+            prefix += rng.integers(0, 256, int(rng.integers(1, 2 * Nread)), dtype=np.uint8).tobytes()
+        if self.truncated and rng.random() < self.truncated:
+            prefix += frame[:int(rng.integers(1, Nread))]
+        intact = True
+        if self.bitErrors and rng.random() < self.bitErrors:
+            frame = bytearray(frame)
+            position = int(rng.integers(0, Nread * 8))
+            frame[position >> 3] ^= 1 << (position & 7)
+            intact = False
+        if self.loss and rng.random() < self.loss:
+            position = int(rng.integers(0, Nread))
+            frame = frame[:position] + frame[position+1:]
+            intact = False
+        return prefix + bytes(frame), intact
+
+
+class Bryduino:
+    '''
+    ====================================================================================
+    Bryduino: the state machine of BryArduino.ino. A link calls Reset when a client
+    connects, Receive with the bytes the client wrote and Tick about every TickPeriod
+    for the bytes to send. Time is the host's perf_counter, millis count from the
+    last reset. speedup divides the sample period, [Per=0] samples as fast as the
+    baud limit allows (baud=None: MaxBurst frames per tick). sentTimecodes holds the
+    timecodes of the frames sent undamaged since the last reset
+    ====================================================================================
+    '''
+    def __init__(self, script=None, speedup=1.0, baud=Baud, faults=None, watchdogTimeout=TimeoutWatchdog, seed=1, clock=time.perf_counter):
+        if script is None:
+            script, modes = BryCorpus.GenerateCorpus(CorpusSize, seed=seed)
+        self.script = [bytes(packet[:20]) for packet in script]
+        self.speedup = speedup
+        self.baud = baud
+        self.faults = faults or Faults()
+        self.watchdogTimeout = watchdogTimeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.resets = 0
+        self.Reset()
+
+    def Reset(self):
+        '''what the board does when the serial port is opened: reboot with sampling on'''
+        with self.lock:
+            self.bootTime = self.clock()
+            self.bRun = True
+            self.samplePeriod = SamplePeriod
+            self.nextSampleTime = 0.0
+            self.clientCmd = ""
+            self.commands = []
+            self.scriptPos = 0
+            self.txCredit = TxBufferSize
+            self.lastTick = self.bootTime
+            self.pending = self.faults.Start()
+            self.sentTimecodes = array('I')
+            self.framesSent = 0
+            self.resets += 1
+            self.ResetWatchdog()
+
+    def Millis(self):
+        return int((self.clock() - self.bootTime) * 1000) & 0xFFFFFFFF
+
+    def ResetWatchdog(self):
+        self.watchdogDeadline = self.Millis() + self.watchdogTimeout
+
+    def Receive(self, data):
+        '''parses commands like the sketch: '[' starts one, ']' executes it'''
+        with self.lock:
+            for inChar in data.decode('latin-1'):
+                if inChar == '[':
+                    self.clientCmd = ""
+                self.clientCmd += inChar
+                if inChar == ']':
+                    self.ExecuteCmd(self.clientCmd)
+
+    def ExecuteCmd(self, cmd):
+        self.commands.append((self.Millis(), cmd))
+        if cmd == "[Rst]":
+            #the sketch's schedule doesn't advance while stopped, so resuming samples at once
+            if not self.bRun:
+                self.nextSampleTime = 0.0
+            self.bRun = True
+            self.ResetWatchdog()
+        elif cmd == "[Go]":
+            self.bRun = True
+            self.nextSampleTime = 0.0
+            self.ResetWatchdog()
+        elif cmd == "[Stop]":
+            self.bRun = False
+        elif cmd.startswith("[Per="):
+            #toInt() gives 0 for garbage
+            try:
+                self.samplePeriod = max(int(cmd[5:-1]), 0)
+            except ValueError:
+                self.samplePeriod = 0
+            self.nextSampleTime = 0.0
+
+    def NextFrame(self):
+        payload = self.script[self.scriptPos]
+        self.scriptPos = (self.scriptPos + 1) % len(self.script)
+        return payload + self.Millis().to_bytes(4, 'little')
+
+    def Tick(self):
+        '''returns the bytes due since the last tick'''
+        with self.lock:
+            now = self.clock()
+            out = [self.pending]
+            self.pending = b''
+            if self.baud:
+                self.txCredit = min(self.txCredit + (now - self.lastTick) * self.baud / 10, TxBufferSize + Nread)
+            self.lastTick = now
+
+            interval = self.samplePeriod / 1000 / self.speedup
+            count = 0
+            while self.bRun and now >= self.nextSampleTime and count < MaxBurst:
+                if self.baud and self.txCredit < Nread:
+                    break
+                frame = self.NextFrame()
+                data, intact = self.faults.Apply(frame)
+                out.append(data)
+                self.txCredit -= len(data)
+                self.framesSent += 1
+                if intact:
+                    self.sentTimecodes.append(int.from_bytes(frame[20:24], 'little'))
+                count += 1
+                if self.nextSampleTime == 0.0 or now - self.nextSampleTime > MaxBurst * interval:
+                    self.nextSampleTime = now
+                self.nextSampleTime += interval
+
+            #nobody has been listening
+            if self.Millis() > self.watchdogDeadline:
+                self.bRun = False
+            return b''.join(out)
+
+
+class DeviceThread:
+    '''runs a link's device loop: take commands, send due bytes, sleep a tick'''
+    def StartDevice(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.Serve, name="Bryduino", daemon=True)
+        self.thread.start()
+
+    def StopDevice(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def Serve(self):
+        while self.running:
+            self.Poll()
+            time.sleep(TickPeriod)
+
+
+class LoopPort(DeviceThread):
+    '''
+    ====================================================================================
+    LoopPort: the host end of an in-process link to a Bryduino, with the parts of
+    serial.Serial that Connection uses. Opening it resets the device. Bytes arriving
+    while the host buffer is full are lost and counted in overrun, like an OS serial
+    buffer that isn't read fast enough
+    ====================================================================================
+    '''
+    def __init__(self, device, timeout=ReadTimeout, bufferSize=HostBufferSize):
+        self.device = device
+        self.timeout = timeout
+        self.bufferSize = bufferSize
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+        self.overrun = 0
+        self.port = "loop://"
+        self.is_open = False
+        self.thread = None
+        self.open()
+
+    def open(self):
+        self.device.Reset()
+        self.is_open = True
+        self.StartDevice()
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            self.StopDevice()
+            with self.condition:
+                self.condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def Poll(self):
+        data = self.device.Tick()
+        if data:
+            with self.condition:
+                room = self.bufferSize - len(self.buffer)
+                self.overrun += max(len(data) - room, 0)
+                self.buffer += data[:room]
+                self.condition.notify_all()
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def readinto(self, view):
+        with self.condition:
+            if not self.buffer and self.is_open:
+                self.condition.wait(self.timeout)
+            n = min(len(view), len(self.buffer))
+            view[:n] = self.buffer[:n]
+            del self.buffer[:n]
+            return n
+
+    def read(self, size=1):
+        data = bytearray(size)
+        return bytes(data[:self.readinto(memoryview(data))])
+
+    def write(self, data):
+        self.device.Receive(bytes(data))
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self.condition:
+            self.buffer.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    flushInput = reset_input_buffer
+    flushOutput = reset_output_buffer
+
+
+class PtyLink(DeviceThread):
+    '''
+    ====================================================================================
+    PtyLink: serves a Bryduino on a pseudo-terminal (POSIX only). Clients open
+    portName like a serial port. The master reports EIO while no client has the port
+    open; the device is reset when one opens it. Bytes the pty can't take are lost
+    and counted in overrun
+    ====================================================================================
+    '''
+    def __init__(self, device):
+        import pty
+        import tty
+        self.device = device
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.portName = os.ttyname(slave)
+        os.close(slave)
+        os.set_blocking(self.master, False)
+        self.connected = False
+        self.overrun = 0
+        self.thread = None
+
+    def Start(self):
+        self.StartDevice()
+        return self
+
+    def Close(self):
+        self.StopDevice()
+        os.close(self.master)
+
+    def Poll(self):
+        try:
+            data = os.read(self.master, 4096)
+        except BlockingIOError:
+            data = b''
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise
+            self.connected = False
+            return
+        if not self.connected:
+            self.connected = True
+            self.device.Reset()
+        if data:
+            self.device.Receive(data)
+        out = self.device.Tick()
+        while out:
+            try:
+                n = os.write(self.master, out)
+            except BlockingIOError:
+                n = 0
+            except OSError:
+                return
+            if n == 0:
+                self.overrun += len(out)
+                break
+            out = out[n:]
+
+
+def Stress(rate, seconds=5.0, faults=None, baud=None):
+    '''runs a Connection against a Bryduino on a LoopPort at about rate frames/s for
+    seconds. Returns a dict with the frames sent, the ones sent undamaged, the ones
+    recorded and the undamaged ones missing from the history'''
+    device = Bryduino(speedup=rate * SamplePeriod / 1000, baud=baud, faults=faults)
+    ports = []
+    def OpenPort():
+        ports.append(LoopPort(device))
+        return ports[-1]
+
+    conn = PyBry.Connection(None, PyBry.SampleHistory(max(int(rate * seconds * 2), 1000)), serverAddress=None)
+    conn.OpenPort = OpenPort
+    conn.portName = "loop://"
+    conn.runEvent.set()
+    thread = threading.Thread(target=conn.OpenAndSample)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        thread.start()
+        try:
+            while not ports:
+                time.sleep(0.01)
+            #the Connection stops the device and flushes what it sent, then resets the
+            #watchdog, which restarts the sampling. Count from there
+            while not any(cmd == "[Rst]" for millis, cmd in device.commands):
+                time.sleep(0.01)
+            start = time.perf_counter()
+            time.sleep(seconds)
+            #stop without flushing and let the Connection drain its buffer
+            conn.SendCommand("[Stop]")
+            while ports[-1].in_waiting > 0:
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - start
+            time.sleep(0.2)
+        finally:
+            conn.killThread = True
+            conn.runEvent.set()
+            thread.join()
+
+    cursor, rows = conn.history.GetRowsSince(None, ["timecode"])
+    rstMillis = next(millis for millis, cmd in device.commands if cmd == "[Rst]")
+    sent = np.frombuffer(device.sentTimecodes, dtype=np.uint32)
+    sent = sent[sent >= rstMillis]
+    received = rows["timecode"]
+    #several frames share a millisecond at high rates, so compare counts per timecode
+    codes, sentCounts = np.unique(sent, return_counts=True)
+    receivedCounts = np.zeros_like(sentCounts)
+    found, counts = np.unique(received, return_counts=True)
+    position = np.searchsorted(codes, found)
+    known = (position < len(codes)) & (codes[np.minimum(position, len(codes) - 1)] == found)
+    receivedCounts[position[known]] = counts[known]
+    missing = int(np.maximum(sentCounts - receivedCounts, 0).sum())
+    return {"rate":rate, "seconds":elapsed, "sent":device.framesSent, "intact":len(sent), "recorded":len(received),
+            "missing":missing, "overrun":ports[-1].overrun, "achieved":len(received) / elapsed}
+
+def Main(argv=None):
+    parser = argparse.ArgumentParser(description="BryArduino emulator")
+    parser.add_argument("--pty", action="store_true", help="serve on a pseudo-terminal until interrupted")
+    parser.add_argument("--stress", help="frame rates per second to run a Connection at, comma separated")
+    parser.add_argument("--seconds", type=float, default=5.0, help="duration of each stress run")
+    parser.add_argument("--speedup", type=float, default=1.0, help="divides the sample period (--pty)")
+    parser.add_argument("--baud", type=int, default=None, help="limit the output rate like a serial line")
+    parser.add_argument("--script", help="capture or journal to play back instead of a random corpus (--pty)")
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--garbage", type=float, default=0.0)
+    parser.add_argument("--truncated", type=float, default=0.0)
+    parser.add_argument("--bit-errors", type=float, default=0.0)
+    parser.add_argument("--offset", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    faults = Faults(args.loss, args.garbage, args.truncated, args.bit_errors, args.offset, args.seed)
+    if args.stress:
+        print("{:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12}".format("rate", "sent", "intact", "recorded", "missing", "overrun", "achieved/s"))
+        for rate in args.stress.split(","):
+            result = Stress(float(rate), args.seconds, faults, args.baud)
+            print("{rate:>10.0f} {sent:>10} {intact:>10} {recorded:>10} {missing:>10} {overrun:>10} {achieved:>12.1f}".format(**result))
+        return 0
+
+    if args.pty:
+        script = None
+        if args.script:
+            from BryReplay import ReadCaptureBlocks
+            script = np.concatenate([packets for packets, stamps, skipped in ReadCaptureBlocks(args.script)])
+        device = Bryduino(script, args.speedup, args.baud, faults, seed=args.seed)
+        link = PtyLink(device).Start()
+        print("serving on " + link.portName)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            link.Close()
+        return 0
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -0,0 +1,204 @@
+'''
+====================================================
+BryJournal: append-only raw packet journal
+====================================================
+
+Every validated 24-byte packet is stored with its host timestamp in fixed size
+records of memory-mapped segment files named <base>.<segment>.bryj
+
+segment file layout
+    header (64 bytes)
+        magic       //b'BRYJ'
+        version     //format version (uint16)
+        headerSize  //uint16
+        recordSize  //uint32
+        capacity    //records per segment (uint32)
+        segment     //segment number (uint32)
+        created     //host time the segment was created (float64)
+        count       //committed records (uint64, at offset 32)
+    records (recordSize bytes each)
+        packet      //raw packet bytes as received
+        pctimestamp //received time wall clock (float64)
+
+Records are self validating (packet marker bytes), so after a crash the reader
+recovers records written after the last committed count
+'''
+
+import glob
+import mmap
+import os
+import struct
+import time
+import numpy as np
+
+
+JournalMagic     = b'BRYJ'
+JournalVersion   = 1
+JournalExtension = '.bryj'
+HeaderSize       = 64
+HeaderFormat     = '<4sHHIIId'
+CountOffset      = 32
+PacketBytes      = 24
+RecordDtype      = np.dtype([("packet", np.uint8, (PacketBytes,)), ("pctimestamp", '<f8')])
+MarkerSlice      = slice(15, 19)
+MarkerByte       = 0x86
+
+SegmentRecords   = 1 << 20 #records per segment (32 MB)
+FlushPeriod      = 5       #seconds between explicit flushes of the mapped pages
+
+
+def SegmentPath(base, segment):
+    return "{}.{:06d}{}".format(base, segment, JournalExtension)
+
+def ListSegments(path):
+    '''returns the segment files of a journal given its base path or one of its segment files'''
+    if path.endswith(JournalExtension):
+        if os.path.isfile(path):
+            return [path]
+        raise FileNotFoundError(path)
+    segments = sorted(glob.glob(glob.escape(path) + ".[0-9]*" + JournalExtension))
+    if not segments:
+        raise FileNotFoundError("no journal segments found for " + path)
+    return segments
+
+
+class JournalWriter:
+    '''
+    ====================================================================================
+    Appends packets to the journal. Segments are preallocated and memory-mapped, so an
+    append is two slice copies. A full segment is closed and the next one started
+    ====================================================================================
+    '''
+    def __init__(self, base, segmentRecords=SegmentRecords):
+        self.base = base
+        self.segmentRecords = segmentRecords
+        self.segment = self.NextFreeSegment()
+        self.file = None
+        self.mm = None
+        self.OpenSegment()
+
+    def NextFreeSegment(self):
+        '''continues after the segments of an earlier session with the same base path'''
+        try:
+            last = ListSegments(self.base)[-1]
+            return int(last[len(self.base)+1:-len(JournalExtension)]) + 1
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def OpenSegment(self):
+        path = SegmentPath(self.base, self.segment)
+        self.file = open(path, "w+b")
+        self.file.truncate(HeaderSize + self.segmentRecords * RecordDtype.itemsize)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        struct.pack_into(HeaderFormat, self.mm, 0, JournalMagic, JournalVersion, HeaderSize, RecordDtype.itemsize, self.segmentRecords, self.segment, time.time())
+        self.count = 0
+        self.nextFlush = time.time() + FlushPeriod
+
+    def CloseSegment(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
+            self.mm = None
+            self.file = None
+
+    def Append(self, packet, pctimestamp):
+        if self.count >= self.segmentRecords:
+            self.CloseSegment()
+            self.segment += 1
+            self.OpenSegment()
+
+        offset = HeaderSize + self.count * RecordDtype.itemsize
+        self.mm[offset:offset+PacketBytes] = packet
+        struct.pack_into('<d', self.mm, offset+PacketBytes, pctimestamp)
+        self.count += 1
+        struct.pack_into('<Q', self.mm, CountOffset, self.count)
+
+        if pctimestamp > self.nextFlush:
+            self.Flush()
+
+    def Flush(self):
+        if self.mm is not None:
+            self.mm.flush()
+        self.nextFlush = time.time() + FlushPeriod
+
+    def Close(self):
+        self.CloseSegment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+class JournalReader:
+    '''
+    ====================================================================================
+    Memory-maps the segments of a journal. Records are addressed by index over all
+    segments, in O(1), and read without copying
+    ====================================================================================
+    '''
+    def __init__(self, path):
+        self.segments = []
+        for segPath in ListSegments(path):
+            with open(segPath, "rb") as f:
+                header = f.read(HeaderSize)
+            if len(header) < HeaderSize:
+                continue
+            magic, version, headerSize, recordSize, capacity, segment, created = struct.unpack_from(HeaderFormat, header)
+            count, = struct.unpack_from('<Q', header, CountOffset)
+            if magic != JournalMagic:
+                raise ValueError("not a journal segment: " + segPath)
+            if version > JournalVersion or recordSize != RecordDtype.itemsize:
+                raise ValueError("unsupported journal version {} in {}".format(version, segPath))
+            records = np.memmap(segPath, dtype=RecordDtype, mode='r', offset=headerSize, shape=(capacity,))
+            self.segments.append({"path":segPath, "created":created, "records":records[:self.RecoverCount(records, count)]})
+        self.starts = np.cumsum([0] + [len(seg["records"]) for seg in self.segments])
+
+    @staticmethod
+    def RecoverCount(records, count):
+        '''number of valid records: the committed count plus any complete records written
+        after it that didn't make it into the header before a crash'''
+        count = min(count, len(records))
+        while count < len(records):
+            record = records[count]
+            if record["pctimestamp"] == 0 or not np.all(record["packet"][MarkerSlice] == MarkerByte):
+                break
+            count += 1
+        return count
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def Read(self, start, stop):
+        '''returns (packets Nx24, pctimestamps) of records [start, stop). Views into the
+        mapped file unless the range spans segments'''
+        start, stop = max(start, 0), min(stop, len(self))
+        packets, stamps = [], []
+        seg = int(np.searchsorted(self.starts, start, side='right')) - 1
+        while start < stop:
+            records = self.segments[seg]["records"]
+            i0 = start - self.starts[seg]
+            i1 = min(stop - self.starts[seg], len(records))
+            packets.append(records["packet"][i0:i1])
+            stamps.append(records["pctimestamp"][i0:i1])
+            start += i1 - i0
+            seg += 1
+        if len(packets) == 1:
+            return packets[0], stamps[0]
+        if not packets:
+            return np.empty((0, PacketBytes), dtype=np.uint8), np.empty(0)
+        return np.concatenate(packets), np.concatenate(stamps)
+
+    def ReadBlocks(self, blockSize=65536):
+        '''yields (packets, pctimestamps) blocks over the whole journal'''
+        for start in range(0, len(self), blockSize):
+            yield self.Read(start, start + blockSize)
+
+    def LoadHistory(self, history, decoder, blockSize=65536):
+        '''decodes the whole journal into a SampleHistory with the batch decoder'''
+        for packets, stamps in self.ReadBlocks(blockSize):
+            columns = decoder.DecodeBatch(packets)
+            columns["pctimestamp"] = stamps
+            history.AddBatchToHistory(columns)
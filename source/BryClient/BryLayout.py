@@ -0,0 +1,283 @@
+'''
+====================================================
+BryLayout: bit layouts of the Brymen meter models
+====================================================
+
+A meter model is described as data: which frame bit lights which annunciator,
+where the 7-segment digit bytes and the decimal points are, and the rules that
+turn lit annunciators into units, prefixes and sources. BrymenDecoder reads the
+description of the model it is made for (PyBry.MeterModel by default): the
+batch decoder takes its layout and rules from it, and for single packets it is
+compiled into a Python function with one local per bit and if-chains for the
+rules, so decoding a packet has no per-bit calls and no dict lookups
+
+A new model is a new description in Models, usually a copy with other bytes
+and bits. Flag names are the ones the rules use; a display without a flag just
+never has it lit
+
+model description
+    segments  //7-segment byte (masked with segmentMask) -> character
+    digits    //display -> (first byte, number of digit bytes), left to right
+    flags     //(byte, bit, section, name) in the order UnpackBytes returns them; section
+              //"common" or a display. Decimal points are flags Dec1.. of their display
+    rules     //units, prefixes, sources and state flags, see BrymenRules
+
+Usage
+    decode = CompileDecoder("BM869")
+    timecode, state, measureUpper, measureLower, unpackedData = decode(inbytes)
+'''
+
+import math
+
+
+Segments = {
+    0b10111110:"0",
+    0b10100000:"1",
+    0b11011010:"2",
+    0b11111000:"3",
+    0b11100100:"4",
+    0b01111100:"5",
+    0b01111110:"6",
+    0b10101000:"7",
+    0b11111110:"8",
+    0b11111100:"9",
+    0b00000000:" ",
+    0b01000000:"-",
+    0b01001110:"F",
+    0b00011110:"C",
+    0b00010110:"L",
+    0b11110010:"d",
+    0b00100000:"i",
+    0b01110010:"o",
+    0b01011110:"E",
+    0b01000010:"r",
+    0b01100010:"n",
+    }
+
+#how lit annunciators read, common to the Brymen dual display meters
+BrymenRules = {
+    #(flag, unit), the first lit one wins. A trailing F or C digit makes it °F or °C
+    "units": [("A", "A"), ("V", "V"), ("Ohm", "Ω"), ("Hz", "Hz"), ("F", "F"), ("S", "S"), ("Duty", "%"), ("dB", "dBm")],
+    #(flag, multiplier), the flag is the unit prefix too. The last lit one wins, none if noPrefix is lit
+    "prefixes": [("n", 1e-9), ("µ", 1e-6), ("m", 1e-3), ("k", 1e3), ("M", 1e6)],
+    "noPrefix": "dB",
+    #(flags all lit, source), the first match wins; then the temperature ones override it
+    "sources": [(("DC", "AC"), "DC+AC"), (("DC",), "DC"), (("AC",), "AC"), (("F",), "Capacitance"), (("Ohm",), "Resistance"),
+                (("S",), "Conductance"), (("Hz",), "Frequency"), (("Duty",), "Duty")],
+    "temperatureSources": [("TempDiff", "Temperature Diff"), ("T1", "Temperature 1"), ("T2", "Temperature 2")],
+    #(unit, source suffix)
+    "unitSources": [("A", " Current"), ("V", " Voltage")],
+    #(state, common flag lit, common flag not lit or None). Delta is a flag of the lower
+    #display, so Relative is never set
+    "state": [("Holding", "Hold", None), ("Relative", "Delta", None), ("Recording", "Record", None), ("Crest", "Crest", None),
+              ("Min", "Min", "Max"), ("Max", "Max", "Min"), ("Avg", "Avg", "Min")],
+    }
+
+BM869 = {
+    "segments": Segments,
+    "segmentMask": 0b11111110,
+    "digits": {"upper": (9, 4), "lower": (2, 6)},
+    "flags": [
+        (0, 0, "common", "Auto"), (0, 1, "common", "Record"), (0, 2, "common", "Crest"), (0, 3, "common", "Hold"),
+        (0, 4, "lower", "DC"), (0, 5, "common", "Max"), (0, 6, "common", "Min"), (0, 7, "common", "Avg"),
+        (1, 0, "lower", "AC"), (1, 1, "lower", "T1"), (1, 2, "lower", "TempDiff"), (1, 3, "lower", "T2"),
+        (1, 4, "common", "BarScale"), (1, 5, "common", "BarNeg"), (1, 6, "lower", "VFD"), (1, 7, "lower", "Neg"),
+        (2, 0, "lower", "Delta"),
+        (7, 0, "lower", "V"),
+        (8, 0, "upper", "µ"), (8, 1, "upper", "m"), (8, 2, "upper", "A"), (8, 3, "upper", "system"),
+        (8, 4, "upper", "Neg"), (8, 5, "upper", "AC"), (8, 6, "upper", "T2"), (8, 7, "common", "Batt"),
+        (9, 0, "common", "Cont"),
+        (13, 0, "upper", "M"), (13, 1, "upper", "k"), (13, 2, "upper", "Hz"), (13, 3, "upper", "V"),
+        (13, 4, "lower", "S"), (13, 5, "lower", "F"), (13, 6, "lower", "n"), (13, 7, "lower", "A"),
+        (14, 0, "lower", "Hz"), (14, 1, "lower", "dB"), (14, 2, "lower", "m"), (14, 3, "lower", "µ"),
+        (14, 4, "lower", "Ohm"), (14, 5, "lower", "M"), (14, 6, "lower", "k"), (14, 7, "lower", "Duty"),
+        (3, 0, "lower", "Dec1"), (4, 0, "lower", "Dec2"), (5, 0, "lower", "Dec3"), (6, 0, "lower", "Dec4"),
+        (10, 0, "upper", "Dec1"), (11, 0, "upper", "Dec2"), (12, 0, "upper", "Dec3"),
+        ],
+    "rules": BrymenRules,
+    }
+
+Models = {
+    "BM869": BM869,
+    "BM867": BM869, #same frames
+    }
+DefaultModel = "BM869"
+
+
+def GetModel(model):
+    '''a model description, given as one or by its name in Models'''
+    if isinstance(model, dict):
+        return model
+    if model not in Models:
+        raise ValueError("unknown meter model {}, use one of {}".format(model, ", ".join(Models)))
+    return Models[model]
+
+def DisplayFlags(model, section):
+    '''{name: (byte, bit)} of a section, decimal points included'''
+    return {name: (byte, bit) for byte, bit, flagSection, name in model["flags"] if flagSection == section}
+
+def Decimals(model, display):
+    '''bytes whose bit 0 is decimal point 1, 2, ... of a display'''
+    flags = DisplayFlags(model, display)
+    return tuple(flags["Dec{}".format(i)][0] for i in range(1, len(flags) + 1) if "Dec{}".format(i) in flags)
+
+def BatchLayout(model):
+    '''the layout of each display the batch decoder reads: digits, decimal point bytes
+    and flags as (byte, bit), and the common state flags'''
+    model = GetModel(model)
+    layout = {}
+    for display, digits in model["digits"].items():
+        flags = DisplayFlags(model, display)
+        layout[display] = {"digits": digits, "dec": Decimals(model, display),
+                           "flags": {name: bit for name, bit in flags.items() if not name.startswith("Dec")}}
+    return layout, DisplayFlags(model, "common")
+
+def SegmentTable(model):
+    '''character of each of the 256 byte values'''
+    model = GetModel(model)
+    return tuple(model["segments"].get(byte & model["segmentMask"], '?') for byte in range(256))
+
+
+#------------------------------------------------------------------------------
+# compiler
+#------------------------------------------------------------------------------
+Compiled = {} #id of a model description -> (description, decode function)
+BitTable = tuple(tuple((byte & (1 << bit)) != 0 for bit in range(8)) for byte in range(256)) #byte -> its bits, LSB first
+
+def MeasurementLines(display, model, flag):
+    '''statements computing the measurement of a display into locals <display>Text,
+    Value, Unit, ValueOrg, UnitOrg and Source. flag(name) is the local holding a lit
+    flag of the display, None if it has no such flag'''
+    rules = model["rules"]
+    p = display
+    lines = ["{p}Text = ''.join({p}Segs)".format(p=p)]
+
+    #decimal point, the last lit one wins
+    decimals = Decimals(model, display)
+    keyword = "if"
+    for position in range(len(decimals), 0, -1):
+        lines.append("{k} {f}: {p}Text = {p}Text[:{i}] + '.' + {p}Text[{i}:]".format(k=keyword, f=flag("Dec{}".format(position)), p=p, i=position))
+        keyword = "elif"
+
+    lines.append("{p}Unit = ''".format(p=p))
+    keyword = "if"
+    for name, unit in rules["units"]:
+        if flag(name):
+            lines.append("{k} {f}: {p}Unit = {u!r}".format(k=keyword, f=flag(name), p=p, u=unit))
+            keyword = "elif"
+    lines += ["{p}Last = {p}Text[-1:]".format(p=p),
+              "if {p}Last == 'F' or {p}Last == 'C':".format(p=p),
+              "    {p}Unit = '°' + {p}Last".format(p=p),
+              "    {p}Text = {p}Text[:-1]".format(p=p)]
+    if flag("Neg"):
+        lines.append("if {f}: {p}Text = '-' + {p}Text".format(f=flag("Neg"), p=p))
+
+    lines += ["{p}UnitOrg = {p}Unit".format(p=p), "{p}Mult = 1.0".format(p=p)]
+    indent = ""
+    if flag(rules["noPrefix"]):
+        lines.append("if not {f}:".format(f=flag(rules["noPrefix"])))
+        indent = "    "
+    prefixes = [(name, mult) for name, mult in rules["prefixes"] if flag(name)]
+    for name, mult in prefixes:
+        lines += [indent + "if {f}:".format(f=flag(name)),
+                  indent + "    {p}Mult = {m!r}".format(p=p, m=mult),
+                  indent + "    {p}UnitOrg = {n!r} + {p}Unit".format(p=p, n=name)]
+    if indent and not prefixes:
+        lines.append(indent + "pass")
+
+    lines += ["try:",
+              "    {p}ValueOrg = float({p}Text)".format(p=p),
+              "except ValueError:",
+              "    {p}ValueOrg = nan".format(p=p)]
+
+    lines.append("{p}Source = ''".format(p=p))
+    keyword = "if"
+    for names, source in rules["sources"]:
+        if all(flag(name) for name in names):
+            lines.append("{k} {c}: {p}Source = {s!r}".format(k=keyword, c=" and ".join(flag(name) for name in names), p=p, s=source))
+            keyword = "elif"
+    keyword = "if"
+    for name, source in rules["temperatureSources"]:
+        if flag(name):
+            lines.append("{k} {f}: {p}Source = {s!r}".format(k=keyword, f=flag(name), p=p, s=source))
+            keyword = "elif"
+    for unit, suffix in rules["unitSources"]:
+        lines.append("if {p}Unit == {u!r}: {p}Source += {s!r}".format(p=p, u=unit, s=suffix))
+
+    #conductance in nS is shown as resistance
+    lines += ["if {p}UnitOrg == 'nS':".format(p=p),
+              "    {p}Unit = 'Ω'".format(p=p),
+              "    {p}Value = 1e9/{p}ValueOrg if {p}ValueOrg != 0 else copysign(inf, {p}ValueOrg)".format(p=p),
+              "else:",
+              "    {p}Value = {p}Mult*{p}ValueOrg".format(p=p)]
+    return lines
+
+def DecoderSource(model):
+    '''Python source of the decode function of a model description'''
+    flags = model["flags"]
+    variables = {} #(section, name) -> local
+    lines = ["def Decode(inbytes):"]
+    body = []
+    for byte in sorted({byte for byte, bit, section, name in flags} |
+                       {first + i for first, count in model["digits"].values() for i in range(count)}):
+        body.append("b{0} = inbytes[{0}]".format(byte))
+    #bytes with several flags unpack all eight bits at once from the BITS table
+    bits = {}
+    for index, (byte, bit, section, name) in enumerate(flags):
+        variables[(section, name)] = "f{}".format(index)
+        bits.setdefault(byte, {})[bit] = "f{}".format(index)
+    for byte, names in sorted(bits.items()):
+        if len(names) > 1:
+            body.append("{} = BITS[b{}]".format(", ".join(names.get(bit, "_") for bit in range(8)), byte))
+        else:
+            for bit, name in names.items():
+                body.append("{} = (b{} & {}) != 0".format(name, byte, 1 << bit))
+    for display, (first, count) in model["digits"].items():
+        body.append("{}Segs = [{}]".format(display, ", ".join("SEG[b{}]".format(first + i) for i in range(count))))
+    body.append("timecode = (inbytes[23]<<24) + (inbytes[22]<<16) + (inbytes[21]<<8) + inbytes[20]")
+
+    #the unpacked flags, in the order of the layout
+    sections = {display: [] for display in ["lower", "upper"]}
+    common = []
+    for byte, bit, section, name in flags:
+        (common if section == "common" else sections[section]).append("{!r}: {}".format(name, variables[(section, name)]))
+    for display in sections:
+        sections[display].append("'Segs': {}Segs".format(display))
+    body.append("unpacked = {{'lower': {{{}}}, 'upper': {{{}}}, {}, 'timecode': timecode}}".format(
+        ", ".join(sections["lower"]), ", ".join(sections["upper"]), ", ".join(common)))
+
+    state = []
+    for name, lit, unlit in model["rules"]["state"]:
+        condition = variables.get(("common", lit), "False")
+        if condition != "False" and unlit is not None and ("common", unlit) in variables:
+            condition += " and not " + variables[("common", unlit)]
+        state.append("{!r}: {}".format(name, condition))
+    body.append("state = {{{}}}".format(", ".join(state)))
+
+    for display in ["upper", "lower"]:
+        body += MeasurementLines(display, model, lambda name, display=display: variables.get((display, name)))
+
+    #cross-display fixes
+    body += ["if upperText == 'diod': lowerSource = 'Diode' + lowerSource",
+             "if 'Temperature' in upperSource:",
+             "    upperUnit = lowerUnit",
+             "    upperUnitOrg = lowerUnitOrg"]
+    for display in ["upper", "lower"]:
+        body.append("{p}Measure = {{'text': {p}Text, 'value': {p}Value, 'unit': {p}Unit, 'valueOrg': {p}ValueOrg, "
+                    "'unitOrg': {p}UnitOrg, 'source': {p}Source}}".format(p=display))
+    body.append("return (timecode, state, upperMeasure, lowerMeasure, unpacked)")
+    return "\n".join(lines + ["    " + line for line in body]) + "\n"
+
+def CompileDecoder(model=DefaultModel):
+    '''the decode function of a model (description or name): decode(inbytes) returns
+    (timecode, state, measureUpper, measureLower, unpackedData) like BrymenDecoder's
+    DecodeUnpackedData(UnpackBytes(inbytes)) plus the unpacked data. Compiled once
+    per description'''
+    model = GetModel(model)
+    entry = Compiled.get(id(model))
+    if entry is None or entry[0] is not model:
+        namespace = {"SEG": SegmentTable(model), "BITS": BitTable, "nan": float('nan'), "inf": float('inf'), "copysign": math.copysign}
+        exec(compile(DecoderSource(model), "<BryLayout decoder>", "exec"), namespace)
+        entry = (model, namespace["Decode"])
+        Compiled[id(model)] = entry
+    return entry[1]
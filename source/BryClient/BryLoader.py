@@ -0,0 +1,273 @@
+'''
+====================================================
+BryLoader: opens captures and exports in a SampleHistory
+====================================================
+
+Loads a past test run back into a history the UI plots like a live one
+    csv      //ExportJob CSV, parsed with numpy a chunk of ChunkBytes at a time
+    npy/npz  //ExportJob NumPy exports, memory-mapped (npz members if stored uncompressed)
+    raw      //serial capture, framed from a memory map of the file
+    journal  //BryJournal segments, memory-mapped
+    hex      //PrintSample debug output
+    archive  //BryArchive, decoded block by block
+The load runs in a worker thread and adds the samples batch by batch, so the
+plots show the beginning of the file while the rest is still loading. Files
+with more samples than HistoryCapacity go to a BrySegments.SegmentStore, which
+spills to disk, so memory use stays flat whatever the file size
+
+Usage
+    job = StartLoad("run.csv")      //job.history fills in the background
+    history = LoadFile("logs/bench")
+'''
+
+import io
+import os
+import re
+import threading
+import zipfile
+import numpy as np
+
+import BryArchive
+import BryJournal
+import BryReplay
+import PyBry
+from PyBry import BrymenDecoder, SampleHistory, SampleColumns, Nread, SourceCodes, UnitCodes, UnitOrgCodes
+
+
+ChunkBytes   = 2 << 20 #bytes of CSV parsed at a time (~47000 rows, each parse holds the GIL)
+BlockRows    = 65536 #samples added to the history at a time
+CSVHeadBytes = 65536 #bytes at the start of a CSV whose rows give the average row length
+RowSlack     = 0.25 #extra capacity over size / average CSV row, for shorter rows past the head
+HexMinRow    = 75 #bytes of the shortest PrintSample packet line
+GraphNames   = ["timecode", "pctimestamp", "valueLower", "valueUpper"] #columns of CSV and .npy exports
+HeaderLabel  = re.compile(r'^\s*(.*?)\s*\((.*)\)\s*$')
+
+
+def DetectFormat(path):
+    '''csv, npy, npz or one of the capture kinds of BryReplay.DetectKind'''
+    extension = os.path.splitext(path)[1].lower()
+    if extension in [".csv", ".npy", ".npz"]:
+        return extension[1:]
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            if f.read(12).startswith(b"# Timecode"):
+                return "csv"
+    return BryReplay.DetectKind(path)
+
+def MaxRows(path, kind):
+    '''an upper bound of the number of samples in a file, exact where the format tells'''
+    if kind == "journal":
+        return len(BryJournal.JournalReader(path))
+    if kind == "archive":
+        with BryArchive.ArchiveReader(path) as reader:
+            return len(reader)
+    if kind == "npy":
+        return len(np.load(path, mmap_mode="r"))
+    if kind == "npz":
+        return len(MapNpz(path, ["timecode"])["timecode"])
+    size = os.path.getsize(path)
+    if kind == "csv":
+        return CSVRows(path, size)
+    return size // {"hex":HexMinRow, "raw":Nread}[kind] + 1
+
+def CSVRows(path, size):
+    '''the rows of a CSV, counted if it is short, otherwise estimated from the average
+    length of the rows in its head plus RowSlack. The head has the shortest timecodes,
+    only rows that lose their values (nan) later get shorter'''
+    with open(path, "rb") as f:
+        head = f.read(CSVHeadBytes)
+    lines = head.count(b"\n")
+    if len(head) == size or lines == 0:
+        return lines + 1
+    average = (head.rfind(b"\n") + 1) / lines
+    return int(size / average * (1 + RowSlack)) + 1
+
+def MapNpz(path, names):
+    '''the arrays names of a .npz found in it. Members stored uncompressed, as np.savez
+    writes them, are memory-mapped in place, compressed ones are read'''
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for name in names:
+            try:
+                info = archive.getinfo(name + ".npy")
+            except KeyError:
+                continue
+            if info.compress_type == zipfile.ZIP_STORED:
+                #the data follows the member's local header and the npy header
+                f.seek(info.header_offset)
+                local = f.read(30)
+                f.seek(info.header_offset + 30 + int.from_bytes(local[26:28], "little") + int.from_bytes(local[28:30], "little"))
+                version = np.lib.format.read_magic(f)
+                if version in [(1, 0), (2, 0)]:
+                    read = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                    shape, fortran, dtype = read(f)
+                    if not dtype.hasobject:
+                        if int(np.prod(shape)) == 0:
+                            arrays[name] = np.zeros(shape, dtype=dtype)
+                        else:
+                            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=f.tell(), shape=shape, order="F" if fortran else "C")
+                        continue
+            with archive.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member)
+    return arrays
+
+def NewHistory(rows):
+    '''a history for rows samples: a RAM ring up to HistoryCapacity, segments spilling to
+    disk beyond'''
+    if rows <= PyBry.HistoryCapacity:
+        return SampleHistory(capacity=max(rows, 1))
+    from BrySegments import SegmentStore
+    return SampleHistory(store=SegmentStore(spillDir=PyBry.HistorySpillDir))
+
+def ParseCSVHeader(line):
+    '''sample columns of the display labels in an ExportJob CSV header, {} if it has none'''
+    names = line.lstrip("#").split(",")
+    columns = {}
+    for key, name in zip(["Lower", "Upper"], names[2:4]):
+        match = HeaderLabel.match(name)
+        if match:
+            source, unit = match.group(1), match.group(2).replace("Ohm", "Ω")
+            columns["source" + key] = SourceCodes.get(source, 0)
+            columns["unit" + key] = UnitCodes.get(unit, 0)
+            columns["unitOrg" + key] = UnitOrgCodes.get(unit, 0)
+    return columns
+
+def GraphBatch(rows, labels):
+    '''full sample columns from an Nx4 array of GraphNames. What the export didn't keep
+    is filled in: the values as displayed are the values, the payload is empty'''
+    n = len(rows)
+    columns = {name: np.zeros((n,) + shape, dtype=dtype) for name, dtype, shape in SampleColumns}
+    for i, name in enumerate(GraphNames):
+        columns[name][:] = rows[:, i]
+    columns["valueOrgLower"][:] = columns["valueLower"]
+    columns["valueOrgUpper"][:] = columns["valueUpper"]
+    for name, code in labels.items():
+        columns[name][:] = code
+    return columns
+
+def ReadCSVBlocks(path, chunkBytes=ChunkBytes):
+    '''yields (columns, fraction of the file read) of an ExportJob CSV'''
+    size = max(os.path.getsize(path), 1)
+    labels = {}
+    rest = b""
+    done = 0
+    with open(path, "rb") as f:
+        first = True
+        while True:
+            data = f.read(chunkBytes)
+            done += len(data)
+            text = rest + data
+            if first and text.startswith(b"#"):
+                labels = ParseCSVHeader(text.split(b"\n", 1)[0].decode("latin1"))
+            first = False
+            #parse whole lines only, the last partial one goes with the next chunk
+            cut = text.rfind(b"\n") + 1 if data else len(text)
+            text, rest = text[:cut], text[cut:]
+            lines = text.split(b"\n", 1)[1] if text.startswith(b"#") else text
+            if lines.strip():
+                rows = np.loadtxt(io.BytesIO(lines), delimiter=",", comments="#", ndmin=2, usecols=range(len(GraphNames)), encoding="latin1")
+                yield GraphBatch(rows, labels), done / size
+            if not data:
+                return
+
+def ReadNumPyBlocks(path, kind, blockRows=BlockRows):
+    '''yields (columns, fraction) of an ExportJob .npy or .npz export, memory-mapped (see
+    MapNpz)'''
+    if kind == "npy":
+        rows = np.load(path, mmap_mode="r")
+        for start in range(0, len(rows), blockRows):
+            yield GraphBatch(rows[start:start+blockRows], {}), min(start + blockRows, len(rows)) / len(rows)
+        return
+    columns = MapNpz(path, [name for name, dtype, shape in SampleColumns])
+    n = len(columns["timecode"])
+    for start in range(0, n, blockRows):
+        yield {name: column[start:start+blockRows] for name, column in columns.items()}, min(start + blockRows, n) / n
+
+def ReadCaptureBlocks(path, kind, rows, blockRows=BlockRows):
+    '''yields (columns, fraction) of a capture, decoded with the batch decoder'''
+    decoder = BrymenDecoder()
+    done = 0
+    for packets, stamps, skipped in BryReplay.ReadCaptureBlocks(path, kind, blockRows):
+        done += len(packets)
+        if len(packets) == 0:
+            continue
+        columns = decoder.DecodeBatch(packets)
+        columns["pctimestamp"] = stamps
+        yield columns, min(done / max(rows, 1), 1.0)
+
+def ReadBlocks(path, kind=None, rows=None):
+    '''yields (columns, fraction) of any supported file'''
+    kind = kind or DetectFormat(path)
+    if kind == "csv":
+        return ReadCSVBlocks(path)
+    if kind in ["npy", "npz"]:
+        return ReadNumPyBlocks(path, kind)
+    return ReadCaptureBlocks(path, kind, rows if rows is not None else MaxRows(path, kind))
+
+
+class LoadJob:
+    '''
+    ====================================================================================
+    LoadJob: loads a file into a history in a worker thread, batch by batch. Readers
+    of the history see the samples as they arrive (it is the only writer). progress,
+    done, error and Cancel work like ExportJob's; a cancelled load clears its history
+    ====================================================================================
+    '''
+    def __init__(self, fileName, history=None, onDone=None, kind=None):
+        self.fileName = fileName
+        self.kind = kind or DetectFormat(fileName)
+        self.rows = MaxRows(fileName, self.kind)
+        self.history = history if history is not None else NewHistory(self.rows)
+        self.onDone = onDone #called from the worker thread with the job when finished
+        self.progress = 0.0
+        self.loaded = 0
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.thread = None
+
+    def Start(self):
+        self.thread = threading.Thread(target=self.Run, name="load", daemon=True)
+        self.thread.start()
+
+    def Cancel(self):
+        self.cancelled = True
+
+    def Wait(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def Run(self):
+        try:
+            for columns, fraction in ReadBlocks(self.fileName, self.kind, self.rows):
+                if self.cancelled:
+                    break
+                self.history.AddBatchToHistory(columns)
+                self.loaded += len(columns["timecode"])
+                self.progress = fraction
+            if self.cancelled:
+                self.history.clearSampleHistory()
+            else:
+                self.progress = 1.0
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.done = True
+            if self.onDone is not None:
+                self.onDone(self)
+
+
+def StartLoad(fileName, history=None, onDone=None, kind=None):
+    '''loads a file in a worker thread (see LoadJob) and returns the job. Without a
+    history one sized for the file is made, job.history'''
+    job = LoadJob(fileName, history, onDone, kind)
+    job.Start()
+    return job
+
+def LoadFile(fileName, history=None, kind=None):
+    '''loads a file synchronously and returns the history'''
+    job = LoadJob(fileName, history, kind=kind)
+    job.Run()
+    if job.error is not None:
+        raise job.error
+    return job.history
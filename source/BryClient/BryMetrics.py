@@ -0,0 +1,172 @@
+'''
+====================================================
+BryMetrics: hot-path instrumentation
+====================================================
+
+Latency histograms with fixed buckets and counters for the stages of acquisition
+and display. Disabled by default: every instrumented spot first checks
+metrics.enabled, so the cost is one attribute test
+
+stages
+    serialWait            //Connection: blocked until the first byte arrives (or ReadTimeout)
+    serialRead            //Connection: reading the bytes that are waiting
+    framing               //marker search and resync in the PacketFramer
+    journal               //BryJournal append
+    enqueue               //handing a packet to the sinks (BrySinks.SinkPipeline.Publish)
+    decode                //SinkPipeline: decoding a batch once for all sinks
+    sink.<name>           //a sink handling one batch in its thread, e.g. sink.history
+    DecodeCompiled        //decoder cache misses only, the compiled layout (see BryLayout)
+    dataLockWait          //time spent waiting for SampleHistory.dataLock
+    dataLockHeld          //time SampleHistory.dataLock was held
+    UpdateGraph           //BrymenUI
+    UpdateValueLabels
+    sampleToLabel         //from receiving a sample to showing it in the value labels
+counters
+    packets, resyncs, bytesSkipped  //Connection
+    drops                           //samples dropped by a full SampleStore that doesn't overwrite
+    inboxDrops                      //messages lost by BryServer's full inbox
+
+Usage
+    from BryMetrics import metrics
+    metrics.Enable()
+    metrics.StartDumping(60)        //report to stderr every minute
+    metrics.Snapshot()              //query in-process
+'''
+
+import bisect
+import sys
+import threading
+import time
+
+
+#bucket upper bounds in seconds: 1 µs to ~16.8 s in powers of two, plus an overflow bucket
+BucketBounds = [2**k * 1e-6 for k in range(25)]
+
+
+class Histogram:
+    '''
+    ====================================================================================
+    Histogram: counts durations in fixed buckets. Updates from several threads are
+    not locked, so a rare lost count is possible
+    ====================================================================================
+    '''
+    def __init__(self):
+        self.Reset()
+
+    def Reset(self):
+        self.counts = [0] * (len(BucketBounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def Record(self, seconds):
+        self.counts[bisect.bisect_left(BucketBounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def Percentile(self, fraction):
+        '''upper bound of the bucket holding the given fraction of the durations'''
+        if self.count == 0:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return BucketBounds[i] if i < len(BucketBounds) else self.max
+        return self.max
+
+    def Summary(self):
+        return {"count":self.count, "mean":self.total / self.count if self.count else 0.0, "max":self.max,
+                "p50":self.Percentile(0.5), "p90":self.Percentile(0.9), "p99":self.Percentile(0.99),
+                "buckets":list(self.counts)}
+
+
+class Metrics:
+    '''
+    ====================================================================================
+    Metrics: named histograms and counters, created on first use
+    ====================================================================================
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.dumpTimer = None
+
+    def Enable(self, enabled=True):
+        self.enabled = enabled
+
+    def Record(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms.setdefault(stage, Histogram())
+        histogram.Record(seconds)
+
+    def Lap(self, stage, start):
+        '''records the time since start (perf_counter) and returns the current time'''
+        now = time.perf_counter()
+        self.Record(stage, now - start)
+        return now
+
+    def Count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def Reset(self):
+        for histogram in list(self.histograms.values()):
+            histogram.Reset()
+        self.counters = {}
+
+    def Snapshot(self):
+        return {"stages":{stage: histogram.Summary() for stage, histogram in list(self.histograms.items())},
+                "counters":dict(self.counters), "bucketBounds":list(BucketBounds)}
+
+    def Report(self):
+        '''the snapshot as a text table, durations in µs'''
+        lines = ["{:<20} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10}".format("stage", "count", "mean", "p50", "p90", "p99", "max")]
+        for stage, s in sorted(self.Snapshot()["stages"].items()):
+            lines.append("{:<20} {:>9} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                stage, s["count"], s["mean"]*1e6, s["p50"]*1e6, s["p90"]*1e6, s["p99"]*1e6, s["max"]*1e6))
+        lines.append("  ".join("{}={}".format(name, count) for name, count in sorted(self.counters.items())))
+        return "\n".join(lines)
+
+    def StartDumping(self, period, stream=None):
+        '''prints Report every period seconds from a timer'''
+        self.StopDumping()
+        def Dump():
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + " metrics\n" + self.Report(), file=stream or sys.stderr)
+            self.StartDumping(period, stream)
+        self.dumpTimer = threading.Timer(period, Dump)
+        self.dumpTimer.daemon = True
+        self.dumpTimer.start()
+
+    def StopDumping(self):
+        if self.dumpTimer is not None:
+            self.dumpTimer.cancel()
+            self.dumpTimer = None
+
+
+class TimedLock:
+    '''wraps a lock to record how long it was waited for and held. Only used while
+    metrics are enabled, otherwise the plain lock is taken'''
+    def __init__(self, lock, name="dataLock", metrics=None):
+        self.lock = lock
+        self.name = name
+        self.metrics = metrics or globals()["metrics"]
+
+    def __enter__(self):
+        t0 = time.perf_counter()
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+        self.metrics.Record(self.name + "Wait", self.acquired - t0)
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.Record(self.name + "Held", time.perf_counter() - self.acquired)
+        self.lock.release()
+
+
+#process-wide instance used by the instrumented code
+metrics = Metrics()
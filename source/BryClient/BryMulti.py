@@ -0,0 +1,179 @@
+'''
+====================================================
+BryMulti: concurrent acquisition from several meters
+====================================================
+
+MeterManager opens a port per meter and runs their sample loops on a thread pool
+in one process. Each meter records into its own SampleHistory and all of them
+stamp samples with one shared HostClock, so the histories can be merged by host
+time (CombinedExportJob)
+
+Sample loops block in serial reads, so an idle meter costs no CPU, and the
+decoder tables, the interpreter and the GUI are shared instead of loaded per meter
+
+Usage
+    manager = MeterManager(["/dev/ttyUSB0", "/dev/ttyUSB1"])
+    manager.Start()
+    ...
+    manager.StartExport("rig.csv").Wait()
+    manager.Close()
+'''
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import PyBry
+from PyBry import Connection, SampleHistory, ExportJob, SampleColumns
+from BrySinks import DefaultPipeline
+
+
+MeterHistoryCapacity = 1000000 #samples per meter, memory is only committed as they are written
+
+
+class HostClock:
+    '''
+    ====================================================================================
+    HostClock: the host time base shared by all meters. Wall clock time read once at
+    creation and advanced by the monotonic performance counter, so stamps from
+    different meters are comparable and never step back when the system clock is set
+    ====================================================================================
+    '''
+    def __init__(self):
+        self.wallStart = time.time()
+        self.counterStart = time.perf_counter()
+
+    def __call__(self):
+        return self.wallStart + (time.perf_counter() - self.counterStart)
+
+
+class MeterManager:
+    '''
+    ====================================================================================
+    MeterManager: a Connection and a SampleHistory per port, sample loops run on a
+    thread pool. Commands go to all meters at once. Offers clearSampleHistory and
+    StartExport like a SampleHistory, so the UI can treat the rig as one history
+    ====================================================================================
+    '''
+    def __init__(self, ports, capacity=MeterHistoryCapacity, journalBase=PyBry.JournalBase, model=None):
+        self.clock = HostClock()
+        self.connections = []
+        for port in ports:
+            #a journal per meter, named after its port
+            journal = None
+            if journalBase:
+                journal = "{}.{}".format(journalBase, port.replace('/', '_').strip('_'))
+            #the console shows which meter a line comes from
+            history = SampleHistory(capacity, model=model)
+            conn = Connection(journal, history, self.clock, serverAddress=None, sinks=DefaultPipeline(history, label=port, model=model), model=model)
+            conn.portName = port
+            self.connections.append(conn)
+        self.pool = ThreadPoolExecutor(max_workers=max(len(ports), 1), thread_name_prefix="meter")
+        self.futures = {}
+
+    def ForEach(self, action):
+        '''runs action(conn) for all meters in parallel. Commands wait for the Arduino,
+        one after the other they would add up'''
+        threads = [threading.Thread(target=action, args=(conn,)) for conn in self.connections]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def Start(self):
+        '''opens the ports that aren't open yet and starts or resumes sampling'''
+        for conn in self.connections:
+            future = self.futures.get(conn.portName)
+            if future is None or future.done():
+                conn.killThread = False
+                self.futures[conn.portName] = self.pool.submit(conn.OpenAndSample)
+            conn.runEvent.set()
+
+    def Stop(self):
+        self.ForEach(lambda conn: conn.Stop())
+
+    def SetPeriod(self, period):
+        self.ForEach(lambda conn: conn.SetPeriod(period))
+
+    def SetModel(self, model):
+        for conn in self.connections:
+            conn.SetModel(model)
+
+    def Close(self):
+        '''ends all sample loops, closes the ports and the meters' sinks'''
+        for conn in self.connections:
+            conn.killThread = True
+            conn.runEvent.set()
+        self.pool.shutdown(wait=True)
+        for conn in self.connections:
+            conn.Close()
+
+    def Histories(self):
+        return [(conn.portName, conn.history) for conn in self.connections]
+
+    def clearSampleHistory(self):
+        for conn in self.connections:
+            conn.history.clearSampleHistory()
+
+    def StartExport(self, fileName, onDone=None):
+        job = CombinedExportJob(self, fileName, onDone)
+        job.Start()
+        return job
+
+    def exportCSV(self, fileName):
+        job = CombinedExportJob(self, fileName)
+        job.Run()
+        if job.error is not None:
+            raise job.error
+
+
+class CombinedExportJob(ExportJob):
+    '''
+    ====================================================================================
+    CombinedExportJob: exports the histories of all meters of a MeterManager into one
+    file, the rows of all meters merged in host time order with a meter column. .npz
+    files get all stored columns of every meter prefixed with the meter number
+    ====================================================================================
+    '''
+    rowFormat = "%d,%d,%f,%f,%f\n"
+
+    def __init__(self, manager, fileName, onDone=None, chunkRows=PyBry.ExportChunkRows):
+        ExportJob.__init__(self, manager, fileName, onDone, chunkRows)
+        self.manager = manager
+
+    def Header(self):
+        '''the column header followed by a line per meter with its own header'''
+        lines = ["Meter, Timecode (ms), WallClock (seconds), Lower, Upper"]
+        for meter, (name, history) in enumerate(self.manager.Histories()):
+            labels = history.GetLabels()
+            lines.append("Meter {} = {}: Lower {} ({}), Upper {} ({})".format(meter, name, labels["lower"]["source"], labels["lower"]["unit"],
+                                                                           labels["upper"]["source"], labels["upper"]["unit"]).replace('Ω', 'Ohm'))
+        return "\n# ".join(lines)
+
+    def GraphColumns(self):
+        blocks = []
+        for meter, (name, history) in enumerate(self.manager.Histories()):
+            cursor, rows = history.GetRowsSince(None, ["timecode", "pctimestamp", "valueLower", "valueUpper"])
+            blocks.append(np.column_stack([np.full(len(rows["timecode"]), meter), rows["timecode"], rows["pctimestamp"], rows["valueLower"], rows["valueUpper"]]))
+        data = np.concatenate(blocks) if blocks else np.empty((0, 5))
+        #stable, so samples of one meter keep their order if their stamps are equal
+        return data[np.argsort(data[:, 2], kind="stable")]
+
+    def WriteNPZ(self):
+        names = [name for name, dtype, shape in SampleColumns]
+        arrays = {}
+        for meter, (name, history) in enumerate(self.manager.Histories()):
+            cursor, rows = history.GetRowsSince(None, names)
+            labels = history.GetLabels()
+            for column, values in rows.items():
+                arrays["meter{}_{}".format(meter, column)] = values
+            arrays["meter{}_port".format(meter)] = np.array(name)
+            for display in ["lower", "upper"]:
+                arrays["meter{}_{}Label".format(meter, display)] = np.array([labels[display]["source"], labels[display]["unit"]])
+        arrays["unitNames"] = np.array(PyBry.UnitNames)
+        arrays["unitOrgNames"] = np.array(PyBry.UnitOrgNames)
+        arrays["sourceNames"] = np.array(PyBry.SourceNames)
+        arrays["stateNames"] = np.array(PyBry.StateNames)
+        np.savez(self.fileName, **arrays)
+        self.progress = 1.0
@@ -0,0 +1,247 @@
+'''
+====================================================
+BryProcess: acquisition in a child process
+====================================================
+
+ProcessConnection runs the serial port, framing, the journal and the decoder in
+a child process, so serial reads and pctimestamps keep their timing whatever the
+GUI process does with its GIL: redraws, zooming or exports. The child writes
+decoded samples into a SampleRing, a SampleStore whose columns and counters live
+in shared memory. Start, Stop and SetPeriod go to it over a control pipe. In the
+GUI process a pump thread copies the new ring rows out, checks the child didn't
+overwrite them meanwhile and hands them to the SampleHistory
+
+ProcessConnection has the interface of Connection the UI uses, and is used
+instead of it when PyBry.AcquisitionProcess is set
+
+Usage
+    conn = ProcessConnection()
+    conn.Start("/dev/ttyUSB0")
+    conn.history.GetLatestSample()
+    conn.Close()        //stops the child and frees the ring
+'''
+
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+import PyBry
+import BryLayout
+from PyBry import Connection, SampleHistory, SampleStore, SampleColumns
+from BrySinks import Sink, DefaultPipeline, HistoryPeriod
+
+
+RingCapacity  = 262144 #samples, ~18 MB, several seconds at the highest frame rates
+RingGuard     = 16384 #samples the pump stays away from the writer, so rows don't change while they're read
+PumpPeriod    = HistoryPeriod #seconds
+StopTimeout   = 5.0 #seconds Close waits for the child before terminating it
+ChildSettings = ["DebugOn", "ReadTimeout", "WatchdogResetPeriod", "FramerBufferSize", "LogFile", "ExportFile", "Triggers", "TriggerRecordBase", "MeterModel",
+                 "AdaptivePeriod", "PeriodLogFile"]
+
+Counters      = ["generation", "writeCount", "reserveCount", "dropCount", "version", "capacity"]
+HeaderBytes   = 64
+
+
+def SharedCounter(index):
+    '''a SampleStore counter kept in the shared header'''
+    return property(lambda self: int(self.header[index]), lambda self, value: self.header.__setitem__(index, value))
+
+
+class SampleRing(SampleStore):
+    '''
+    ====================================================================================
+    SampleRing: a SampleStore in multiprocessing.shared_memory. The process creating
+    it (name None) owns it and unlinks it; others attach by name. One process
+    writes, any read: the lock-free protocol of SampleStore works across processes
+    because the counters are in the shared header too
+    ====================================================================================
+    '''
+    generation   = SharedCounter(0)
+    writeCount   = SharedCounter(1)
+    reserveCount = SharedCounter(2)
+    dropCount    = SharedCounter(3)
+    version      = SharedCounter(4)
+
+    def __init__(self, capacity=RingCapacity, name=None):
+        self.overwrite = True
+        rowBytes = sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for column, dtype, shape in SampleColumns)
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=HeaderBytes + capacity * rowBytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.header = np.ndarray((len(Counters),), dtype=np.int64, buffer=self.shm.buf)
+        if self.owner:
+            self.header[:] = 0
+            self.header[Counters.index("capacity")] = capacity
+        self.capacity = int(self.header[Counters.index("capacity")])
+        #one column after the other, like SampleStore's separate arrays
+        self.columns = {}
+        offset = HeaderBytes
+        for column, dtype, shape in SampleColumns:
+            self.columns[column] = np.ndarray((self.capacity,) + shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            offset += self.columns[column].nbytes
+        if self.owner:
+            self.Clear()
+
+    def Close(self):
+        '''detaches, and frees the memory if this process created it'''
+        self.columns = {}
+        self.header = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingSink(Sink):
+    '''decodes batches into a SampleRing, losslessly'''
+    def __init__(self, ring, period=HistoryPeriod):
+        Sink.__init__(self, "ring", period, None)
+        self.ring = ring
+
+    def Write(self, batch):
+        self.ring.AppendBatch(batch.Columns())
+
+
+def AcquisitionMain(ringName, control, journalBase, settings):
+    '''the child process: a Connection whose history is the ring, run by the commands
+    arriving on control until "quit" or the GUI process is gone'''
+    for name, value in settings.items():
+        setattr(PyBry, name, value)
+    ring = SampleRing(name=ringName)
+    sinks = DefaultPipeline(None)
+    sinks.Add(RingSink(ring))
+    #the samples go to the ring, this history stays empty
+    conn = Connection(journalBase, SampleHistory(capacity=1), serverAddress=None, sinks=sinks)
+    try:
+        while True:
+            command, argument = control.recv()
+            if command == "start":
+                conn.Start(argument)
+            elif command == "stop":
+                conn.Stop()
+            elif command == "period":
+                conn.SetPeriod(argument)
+            elif command == "model":
+                conn.SetModel(argument)
+            elif command == "quit":
+                break
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        conn.killThread = True
+        conn.runEvent.set()
+        while conn.threadRunning:
+            time.sleep(0.01)
+        sinks.Close()
+        ring.Close()
+
+
+class ProcessConnection:
+    '''
+    ====================================================================================
+    ProcessConnection: Connection's Start, Stop and SetPeriod for an acquisition
+    child process, and the pump thread moving its samples into history. The child
+    is spawned, not forked, so it doesn't inherit the GUI's threads and Qt state;
+    the PyBry settings in ChildSettings are handed over
+    ====================================================================================
+    '''
+    def __init__(self, journalBase=PyBry.JournalBase, history=None, capacity=RingCapacity, model=None):
+        self.portName = ''
+        self.model = model if model is not None else PyBry.MeterModel
+        self.history = history if history is not None else SampleHistory(model=self.model)
+        self.ring = SampleRing(capacity)
+        self.guard = min(RingGuard, capacity // 4)
+        self.cursor = 0 #next ring row to pump
+        self.lost = 0 #rows overwritten before the pump got to them
+        self.torn = 0 #of the lost rows, the ones overwritten while they were being copied
+        self.generation = self.ring.generation
+        self.control, child = multiprocessing.Pipe()
+        settings = {name: getattr(PyBry, name) for name in ChildSettings}
+        settings["MeterModel"] = self.model
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=AcquisitionMain, args=(self.ring.name, child, journalBase, settings),
+                                       name="acquisition", daemon=True)
+        self.process.start()
+        child.close()
+        self.running = True
+        self.pump = threading.Thread(target=self.Pump, name="ring pump", daemon=True)
+        self.pump.start()
+
+    def Start(self, portTxtControl):
+        '''port name, or a text control holding it'''
+        self.portName = portTxtControl.text() if hasattr(portTxtControl, "text") else portTxtControl
+        self.control.send(("start", self.portName))
+
+    def Stop(self):
+        self.control.send(("stop", None))
+
+    def SetPeriod(self, periodTxtControl):
+        '''period in ms, or a text control holding it'''
+        period = periodTxtControl.text() if hasattr(periodTxtControl, "text") else periodTxtControl
+        self.control.send(("period", period))
+
+    def SetModel(self, model):
+        '''see Connection.SetModel'''
+        BryLayout.GetModel(model)
+        if model != self.model:
+            self.model = model
+            self.control.send(("model", model))
+            self.history.SetModel(model)
+
+    def Pump(self):
+        while self.running:
+            self.PumpOnce()
+            time.sleep(PumpPeriod)
+
+    def PumpOnce(self):
+        '''moves the rows written since the last call into history. Returns their number'''
+        ring = self.ring
+        generation, stop = ring.generation, ring.writeCount
+        if generation != self.generation:
+            #the ring was cleared and counts from 0 again
+            self.generation = generation
+            self.cursor = 0
+        start = max(self.cursor, stop - ring.capacity + self.guard)
+        self.lost += start - self.cursor
+        if stop <= start:
+            return 0
+        columns = {name: np.array(ring.Read(name, start, stop)) for name in ring.columns}
+        if not ring.IsIntact(generation, start):
+            if ring.generation != generation:
+                #cleared while copying: nothing copied is valid
+                safe = stop
+            else:
+                #rows below the writer's reservation may hold newer samples
+                safe = min(max(ring.reserveCount - ring.capacity, start), stop)
+            self.lost += safe - start
+            self.torn += safe - start
+            columns = {name: column[safe - start:] for name, column in columns.items()}
+            start = safe
+        self.cursor = stop
+        if stop > start:
+            self.history.AddBatchToHistory(columns)
+        return stop - start
+
+    def GetStats(self):
+        return {"written":self.ring.writeCount, "pumped":self.cursor, "lost":self.lost, "torn":self.torn,
+                "alive":self.process.is_alive()}
+
+    def Close(self):
+        '''ends the child, pumps what is left and frees the ring'''
+        try:
+            self.control.send(("quit", None))
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(StopTimeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.running = False
+        self.pump.join()
+        self.PumpOnce()
+        self.control.close()
+        self.ring.Close()
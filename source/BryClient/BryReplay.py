@@ -0,0 +1,248 @@
+'''
+====================================================
+BryReplay: headless replay/decode of captured packets
+====================================================
+
+Reads a capture, runs framing, the decoder and SampleHistory without any GUI
+and writes the result. Supported captures
+    raw      //bytes as received from the serial port
+    journal  //BryJournal segments (base path or a .bryj file)
+    archive  //BryArchive compressed archive (.brya)
+    hex      //PrintSample debug output (DebugOn), one "xx:xx:...:xx --> ..." line per packet
+
+Usage
+    python BryReplay.py capture.bin -o out.csv
+    python BryReplay.py logs/bench --start 60000 --stop 120000 -o out.npz
+    python BryReplay.py bench.brya --start 60000 --stop 120000 -o out.csv    //decodes only the blocks of the range
+    python BryReplay.py capture.bin --trigger "lower > 5 => start" --trigger "lower < 1 => stop" --record run
+'''
+
+import argparse
+import os
+import re
+import sys
+import time
+import numpy as np
+
+import BryArchive
+import BryJournal
+import BryLayout
+import BryTrigger
+import PyBry
+from PyBry import BrymenDecoder, SampleHistory, EncodeSample, Nread
+
+
+MarkerOffset = 15
+HexLine      = re.compile(r'^((?:[0-9a-f]{2}:){23}[0-9a-f]{2}) -->')
+TimeLine     = re.compile(r'^(\d+) - ([0-9.eE+-]+)$')
+
+
+def FrameStarts(data, stop=None, nextFree=0):
+    '''offsets of the complete packets in a uint8 array, skipping garbage and partial
+    packets. Only packets starting in [nextFree, stop) are returned, none overlapping'''
+    if len(data) < Nread:
+        return np.empty(0, dtype=np.int64)
+    isMarker = data[:-3] == 0x86
+    for i in range(1, 4):
+        isMarker &= data[i:len(data)-3+i] == 0x86
+    starts = np.flatnonzero(isMarker) - MarkerOffset
+    starts = starts[(starts >= nextFree) & (starts + Nread <= len(data))]
+    if stop is not None:
+        starts = starts[starts < stop]
+
+    #aligned streams have a packet every Nread bytes, otherwise pick non-overlapping frames
+    if len(starts) and not np.all(np.diff(starts) == Nread):
+        picked = []
+        for start in starts.tolist():
+            if start >= nextFree:
+                picked.append(start)
+                nextFree = start + Nread
+        starts = np.array(picked, dtype=np.int64)
+    return starts
+
+def FramePackets(buffer):
+    '''finds the complete packets in a raw byte stream, skipping garbage and partial
+    packets. Returns (packets Nx24, number of bytes skipped)'''
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    starts = FrameStarts(data)
+    packets = data[starts[:, None] + np.arange(Nread)]
+    return packets, len(data) - len(starts) * Nread
+
+def ReadRawBlocks(fileName, blockSize=65536):
+    '''yields (packets, pctimestamps, bytes skipped) of a raw capture, framed a block of
+    about blockSize packets at a time from a memory map of the file'''
+    size = os.path.getsize(fileName)
+    if size == 0:
+        return
+    data = np.memmap(fileName, dtype=np.uint8, mode="r")
+    chunk = blockSize * Nread
+    done = 0 #bytes accounted for, as packets or skipped
+    nextFree = 0
+    for pos in range(0, size, chunk):
+        #the window reaches into the next chunk so packets starting in this one are complete
+        window = data[pos:pos+chunk+Nread-1]
+        starts = FrameStarts(window, chunk, max(nextFree - pos, 0))
+        packets = window[starts[:, None] + np.arange(Nread)]
+        end = min(pos + chunk, size)
+        if len(starts):
+            nextFree = pos + int(starts[-1]) + Nread
+            end = max(end, nextFree)
+        yield packets, np.full(len(packets), np.nan), end - done - len(packets) * Nread
+        done = end
+
+def ReadHexDump(fileName):
+    '''parses PrintSample debug output. The "timecode - pctimestamp" line that follows
+    each packet line gives its host time'''
+    packets, stamps = [], []
+    with open(fileName, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            match = HexLine.match(line)
+            if match:
+                packets.append(bytes.fromhex(match.group(1).replace(':', '')))
+                stamps.append(np.nan)
+                continue
+            match = TimeLine.match(line)
+            if match and stamps and np.isnan(stamps[-1]):
+                stamps[-1] = float(match.group(2))
+    packets = np.frombuffer(b''.join(packets), dtype=np.uint8).reshape(-1, Nread)
+    return packets, np.array(stamps, dtype=np.float64), 0
+
+def DetectKind(path):
+    if path.endswith(BryJournal.JournalExtension) or not os.path.isfile(path):
+        return "journal"
+    with open(path, "rb") as f:
+        head = f.read(4096)
+    if head.startswith(BryArchive.ArchiveMagic):
+        return "archive"
+    head = head.decode("utf-8", errors="replace")
+    return "hex" if re.search(r'(?m)^(?:[0-9a-f]{2}:){23}[0-9a-f]{2} -->', head) else "raw"
+
+def ReadCaptureBlocks(path, kind=None, blockSize=65536, start=None, stop=None):
+    '''yields (packets, pctimestamps, bytes skipped) blocks of a capture. Archives yield
+    their own blocks, and only the packets with start <= timecode < stop'''
+    kind = kind or DetectKind(path)
+    if kind == "archive":
+        with BryArchive.ArchiveReader(path) as reader:
+            for packets, stamps in reader.ReadBlocks(start, stop):
+                yield packets, stamps, 0
+        return
+    if kind == "journal":
+        for packets, stamps in BryJournal.JournalReader(path).ReadBlocks(blockSize):
+            yield packets, stamps, 0
+        return
+    if kind == "raw":
+        yield from ReadRawBlocks(path, blockSize)
+        return
+    packets, stamps, skipped = ReadHexDump(path)
+    for start in range(0, max(len(packets), 1), blockSize):
+        yield packets[start:start+blockSize], stamps[start:start+blockSize], skipped if start == 0 else 0
+
+def DecodeScalar(decoder, packets):
+    '''per-packet decode of a block into the same columns DecodeBatch returns, using the
+    same path as Connection.SampleLoop'''
+    rows = []
+    for packet in packets:
+        inbytes = packet.tobytes()
+        sample = {"inbytes":inbytes, "pctimestamp":0.0}
+        sample["timecode"], sample["state"], sample["measureUpper"], sample["measureLower"], unpackedData = decoder.DecodePacket(inbytes)
+        rows.append(EncodeSample(sample))
+    columns = {name: np.array([row[name] for row in rows]) for name in rows[0] if name != "pctimestamp"}
+    return columns
+
+def Replay(path, outFile=None, kind=None, blockSize=65536, start=None, stop=None, wallStart=None, wallStop=None, scalar=False, capacity=None, triggers=None):
+    '''decodes a capture into a SampleHistory, optionally exports it and runs a
+    BryTrigger.TriggerEngine over it, and returns (history, stats). The capture is read
+    block by block; the history is sized from the file's bound of samples and spills to
+    disk beyond HistoryCapacity (see BryLoader.NewHistory). seconds times the whole
+    replay, reading and framing included, decodeSeconds the decoder only'''
+    import BryLoader
+    began = time.perf_counter()
+    kind = kind or DetectKind(path)
+    decoder = BrymenDecoder()
+    if capacity:
+        history = SampleHistory(capacity=capacity)
+    else:
+        history = BryLoader.NewHistory(BryLoader.MaxRows(path, kind))
+    stats = {"packets":0, "kept":0, "skippedBytes":0, "decodeSeconds":0.0}
+
+    for packets, stamps, skipped in ReadCaptureBlocks(path, kind, blockSize, start, stop):
+        stats["skippedBytes"] += skipped
+        if len(packets) == 0:
+            continue
+        t = time.perf_counter()
+        columns = DecodeScalar(decoder, packets) if scalar else decoder.DecodeBatch(packets)
+        stats["decodeSeconds"] += time.perf_counter() - t
+        columns["pctimestamp"] = stamps
+
+        #time range filters
+        keep = np.ones(len(packets), dtype=bool)
+        if start is not None:     keep &= columns["timecode"] >= start
+        if stop is not None:      keep &= columns["timecode"] < stop
+        if wallStart is not None: keep &= columns["pctimestamp"] >= wallStart
+        if wallStop is not None:  keep &= columns["pctimestamp"] < wallStop
+        if not np.all(keep):
+            columns = {name: col[keep] for name, col in columns.items()}
+
+        history.AddBatchToHistory(columns)
+        if triggers is not None:
+            triggers.Process(columns)
+        stats["packets"] += len(packets)
+        stats["kept"] += int(keep.sum())
+    if triggers is not None:
+        triggers.Close()
+    stats["seconds"] = time.perf_counter() - began
+
+    if outFile:
+        history.exportCSV(outFile)
+    return history, stats
+
+def PrintStats(snapshot):
+    for display, channel in snapshot.items():
+        print("{} display: {} ({})".format(display, channel["source"], channel["unit"]))
+        for scope, s in channel["scopes"].items():
+            print("  {:<8} n={:<8} mean={:.6g} std={:.6g} min={:.6g} max={:.6g} ewma={:.6g} slope={:.6g}/s span={:.1f}s invalid={}".format(
+                scope, s["count"], s["mean"], s["std"], s["min"], s["max"], s["ewma"], s["slope"], s["span"], s["invalid"]))
+
+def Main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode a Brymen packet capture without the GUI")
+    parser.add_argument("capture", help="raw capture, journal (base path or .bryj), archive (.brya) or PrintSample hex dump")
+    parser.add_argument("-o", "--output", help="output file, .csv, .npy or .npz")
+    parser.add_argument("--kind", choices=["raw", "journal", "hex", "archive"], help="capture type (detected by default)")
+    parser.add_argument("--batch", type=int, default=65536, help="packets decoded per batch")
+    parser.add_argument("--start", type=float, help="first timecode (ms) to keep")
+    parser.add_argument("--stop", type=float, help="timecode (ms) to stop at")
+    parser.add_argument("--wall-start", type=float, help="first host time (seconds since epoch) to keep")
+    parser.add_argument("--wall-stop", type=float, help="host time (seconds since epoch) to stop at")
+    parser.add_argument("--scalar", action="store_true", help="decode packet by packet like the live path")
+    parser.add_argument("--model", choices=list(BryLayout.Models), default=PyBry.MeterModel, help="meter model whose bit layout the capture has")
+    parser.add_argument("--stats", action="store_true", help="print the statistics of both displays")
+    parser.add_argument("--trigger", action="append", default=[], help="trigger rule (see BryTrigger), repeatable; events are printed")
+    parser.add_argument("--record", help="path prefix of the recordings started by trigger rules")
+    parser.add_argument("--pre", type=int, default=BryTrigger.PreSamples, help="samples kept before a trigger")
+    parser.add_argument("--post", type=int, default=BryTrigger.PostSamples, help="samples kept after a trigger")
+    args = parser.parse_args(argv)
+    PyBry.MeterModel = args.model
+
+    triggers = None
+    if args.trigger:
+        try:
+            rules = BryTrigger.ParseRules(args.trigger)
+        except ValueError as ex:
+            parser.error(str(ex))
+        triggers = BryTrigger.TriggerEngine(rules, args.pre, args.post, args.record, BryTrigger.PrintEvent)
+    history, stats = Replay(args.capture, args.output, args.kind, args.batch, args.start, args.stop,
+                            args.wall_start, args.wall_stop, args.scalar, triggers=triggers)
+
+    rate = stats["packets"] / stats["seconds"] if stats["seconds"] > 0 else float('inf')
+    decodeRate = stats["packets"] / stats["decodeSeconds"] if stats["decodeSeconds"] > 0 else float('inf')
+    print("{} packets ({} kept, {} bytes skipped) in {:.3f} s: {:.0f} packets/s, decoder {:.0f} packets/s".format(
+        stats["packets"], stats["kept"], stats["skippedBytes"], stats["seconds"], rate, decodeRate), file=sys.stderr)
+    if args.stats:
+        PrintStats(history.GetStats())
+    history.clearSampleHistory() #deletes the spill files of long captures
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -0,0 +1,259 @@
+'''
+====================================================
+BrySegments: segmented sample store with disk spill
+====================================================
+
+SegmentStore keeps the samples of a SampleHistory in fixed-size segments instead
+of one preallocated ring. Only the newest segments stay in RAM; older ones are
+written to a file each and memory-mapped, so the operating system loads their
+pages when a plot, export or statistic touches them and the history can be
+longer than RAM. A sparse index holds the first timecode and pctimestamp of
+each segment, so finding a time is a binary search over the segments followed
+by one inside a segment, and a [t0, t1) range reads only its own segments
+
+It has the interface and the lock-free reading protocol of PyBry.SampleStore
+and replaces it with SampleHistory(store=SegmentStore()), or for every history
+when PyBry.HistorySpillDir is set
+
+Usage
+    history = SampleHistory(store=SegmentStore(spillDir="spill"))
+    history.GetRange(["timecode", "valueLower"], t0, t1)
+    history.StartExport("hour.csv", t0=t0, t1=t1)
+'''
+
+import bisect
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from PyBry import SampleColumns, PyramidFactor
+from BryMetrics import metrics
+
+
+SegmentRows    = 65536 #samples per segment, ~4.6 MB
+HotSegments    = 4 #newest segments kept in RAM, the rest are spilled
+SpillCapacity  = 100000000 #samples kept before the oldest segments are deleted (~7 GB on disk)
+IndexedColumns = ["timecode", "pctimestamp"]
+ColumnTypes    = {name: (dtype, shape) for name, dtype, shape in SampleColumns}
+
+
+class SegmentStore:
+    '''
+    ====================================================================================
+    SegmentStore: SampleStore's interface over segments of SegmentRows samples. Rows
+    keep their absolute index; the oldest whole segments are dropped once more than
+    capacity samples are stored (or new ones are, if overwrite is disabled).
+
+    One writer, lock-free readers: the writer never changes a row below writeCount
+    and publishes the list of segments and the index as one tuple it replaces, so a
+    reader always sees a consistent layout. Spilled segments are read-only maps of
+    their files; a reader still holding the RAM arrays of one keeps them alive
+    ====================================================================================
+    '''
+    #the graph pyramid starts at buckets of this many samples; below that it reads the
+    #samples themselves, which keeps the pyramid's RAM at ~1.3 bytes per sample
+    pyramidBase = PyramidFactor * PyramidFactor
+
+    def __init__(self, capacity=SpillCapacity, overwrite=True, spillDir=None, segmentRows=SegmentRows, hotSegments=HotSegments):
+        self.capacity = capacity
+        self.overwrite = overwrite
+        self.segmentRows = segmentRows
+        self.hotSegments = hotSegments
+        self.baseDir = spillDir
+        self.spillDir = None #created with the first spilled segment
+        self.deleted = [] #files the OS didn't let us delete yet (still mapped on Windows)
+        self.generation = 0
+        self.version = 0
+        self.Clear()
+
+    def Clear(self):
+        self.generation += 1 #first, so readers notice before the counters go back
+        self.layout = (0, (), {name: () for name in IndexedColumns}) #(first segment number, segments, index)
+        self.writeCount = 0
+        self.reserveCount = 0
+        self.dropCount = 0
+        self.spilled = 0 #segments below this number are on disk
+        self.RemoveSpillDir()
+        self.version += 1
+
+    def Close(self):
+        '''drops every segment and deletes the spill files'''
+        self.Clear()
+
+    def IsIntact(self, generation, start):
+        return self.generation == generation and start >= self.FirstIndex()
+
+    def __len__(self):
+        return self.writeCount - self.FirstIndex()
+
+    def FirstIndex(self, end=None):
+        '''absolute index of the oldest sample still stored, or of the oldest one that
+        was when writeCount was end (NewSegment keeps the newest capacity // segmentRows
+        segments, at least one)'''
+        end = self.writeCount if end is None else end
+        first = self.layout[0]
+        if self.overwrite and end > 0:
+            newest = (end - 1) // self.segmentRows
+            first = max(first, newest + 1 - max(self.capacity // self.segmentRows, 1))
+        return min(first * self.segmentRows, end)
+
+    def RowBytes(self):
+        return sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for name, dtype, shape in SampleColumns)
+
+    def GetStats(self):
+        first, segments, index = self.layout
+        return {"segments":len(segments), "spilled":max(self.spilled - first, 0), "inRAM":min(len(segments), self.hotSegments + 1),
+                "spillDir":self.spillDir}
+
+    #------------------------------------------------------------------------------
+    # writer
+    #------------------------------------------------------------------------------
+    def NewSegment(self, columns):
+        '''starts a segment, its index entries taken from the first row of columns. The
+        oldest are dropped first, so never more than capacity samples are stored'''
+        number = self.writeCount // self.segmentRows
+        while self.overwrite and (number + 1 - self.layout[0]) * self.segmentRows > self.capacity and self.layout[0] < number:
+            self.Drop()
+        first, segments, index = self.layout
+        segment = {name: np.empty((self.segmentRows,) + shape, dtype=dtype) for name, dtype, shape in SampleColumns}
+        index = {name: index[name] + (float(columns[name][0]),) for name in IndexedColumns}
+        self.layout = (first, segments + (segment,), index)
+        return segment
+
+    def Append(self, row):
+        return self.AppendBatch({name: np.asarray(value)[np.newaxis] for name, value in row.items()}) == 1
+
+    def AppendBatch(self, columns):
+        n = len(columns["timecode"])
+        if not self.overwrite:
+            room = max(self.capacity - len(self), 0)
+            self.dropCount += max(n - room, 0)
+            if metrics.enabled:
+                metrics.Count("drops", max(n - room, 0))
+            n = min(n, room)
+        self.reserveCount = self.writeCount + n
+        done = 0
+        while done < n:
+            first, segments, index = self.layout
+            offset = self.writeCount % self.segmentRows
+            if offset == 0:
+                segment = self.NewSegment({name: columns[name][done:] for name in IndexedColumns})
+            else:
+                segment = segments[-1]
+            chunk = min(n - done, self.segmentRows - offset)
+            for name, col in columns.items():
+                segment[name][offset:offset+chunk] = col[done:done+chunk]
+            self.writeCount += chunk
+            done += chunk
+            if offset + chunk == self.segmentRows:
+                self.Retire()
+        self.version += 1
+        return n
+
+    def Retire(self):
+        '''after a segment filled up: spills the ones beyond the hot ones'''
+        full = self.writeCount // self.segmentRows
+        while self.spilled < full - self.hotSegments:
+            if self.spilled >= self.layout[0]:
+                self.Spill(self.spilled)
+            self.spilled += 1
+
+    def SegmentPath(self, number):
+        return os.path.join(self.spillDir, "segment{:08d}.bin".format(number))
+
+    def Spill(self, number):
+        '''writes a segment to its file and replaces it with a read-only map of it'''
+        if self.spillDir is None:
+            if self.baseDir is not None:
+                os.makedirs(self.baseDir, exist_ok=True)
+            self.spillDir = tempfile.mkdtemp(prefix="history", dir=self.baseDir)
+        first, segments, index = self.layout
+        segment = segments[number - first]
+        path = self.SegmentPath(number)
+        with open(path, "wb") as f:
+            for name, dtype, shape in SampleColumns:
+                segment[name].tofile(f)
+        raw = np.memmap(path, dtype=np.uint8, mode="r")
+        mapped, offset = {}, 0
+        for name, dtype, shape in SampleColumns:
+            nbytes = segment[name].nbytes
+            mapped[name] = raw[offset:offset+nbytes].view(dtype).reshape((self.segmentRows,) + shape)
+            offset += nbytes
+        first, segments, index = self.layout
+        self.layout = (first, segments[:number - first] + (mapped,) + segments[number - first + 1:], index)
+
+    def Drop(self):
+        '''forgets the oldest segment and deletes its file'''
+        first, segments, index = self.layout
+        self.layout = (first + 1, segments[1:], {name: index[name][1:] for name in IndexedColumns})
+        if first < self.spilled and self.spillDir is not None:
+            self.deleted.append(self.SegmentPath(first))
+        self.DeleteFiles()
+
+    def DeleteFiles(self):
+        remaining = []
+        for path in self.deleted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                remaining.append(path)
+        self.deleted = remaining
+
+    def RemoveSpillDir(self):
+        if self.spillDir is not None:
+            shutil.rmtree(self.spillDir, ignore_errors=True)
+            self.spillDir = None
+        self.deleted = []
+
+    #------------------------------------------------------------------------------
+    # readers
+    #------------------------------------------------------------------------------
+    def Read(self, name, start=None, stop=None):
+        '''rows [start, stop) of a column, a view into the segment if they are all in one.
+        Rows of segments dropped meanwhile read as zeros; IsIntact tells'''
+        first, segments, index = self.layout
+        start = self.FirstIndex() if start is None else start
+        stop = self.writeCount if stop is None else stop
+        dtype, shape = ColumnTypes[name]
+        if stop <= start:
+            return np.empty((0,) + shape, dtype=dtype)
+        rows = self.segmentRows
+        parts = []
+        for number in range(start // rows, (stop - 1) // rows + 1):
+            lo, hi = max(start - number * rows, 0), min(stop - number * rows, rows)
+            if first <= number < first + len(segments):
+                parts.append(segments[number - first][name][lo:hi])
+            else:
+                parts.append(np.zeros((hi - lo,) + shape, dtype=dtype))
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def SearchSorted(self, name, value, start=None, stop=None):
+        '''absolute index of the first sample in [start, stop) whose column value is >= value,
+        assuming the column is sorted in it. Indexed columns take a binary search over the
+        segments' first values and one inside a segment'''
+        first, segments, index = self.layout
+        lo = self.FirstIndex() if start is None else start
+        hi = self.writeCount if stop is None else stop
+        if lo >= hi:
+            return lo
+        rows = self.segmentRows
+        if name not in index:
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.Read(name, mid, mid + 1)[0] < value:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        #only segments starting inside [lo, hi) take part, the column may restart outside
+        j0 = min(max(-(-lo // rows) - first, 0), len(segments))
+        j1 = min(max((hi - 1) // rows + 1 - first, j0), len(segments))
+        j = bisect.bisect_left(index[name], value, j0, j1)
+        number = first + j - 1 #the last segment starting below value, or the one holding lo
+        a, b = max(number * rows, lo), min((number + 1) * rows, hi)
+        if a >= b:
+            return min(max(a, lo), hi)
+        return a + int(np.searchsorted(self.Read(name, a, b), value, side="left"))
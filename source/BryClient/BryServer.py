@@ -0,0 +1,428 @@
+'''
+====================================================
+BryServer: local pub/sub server for live samples
+====================================================
+
+Fans out the decoded samples of a Connection, and optionally its raw frames, to
+any number of subscribers on a TCP or UNIX socket. Addresses are "host:port" or
+"unix:/path/to/socket"
+
+encodings
+    json    //one JSON object per line
+                {"timecode":..., "pctimestamp":..., "state":[...], "upper":{...}, "lower":{...}}
+                {"frame":"<hex>", "pctimestamp":...}
+    binary  //messages of a little-endian header (uint16 body length, uint8 kind) and a body
+                kind 1: sample, a SampleRecord (the SampleColumns row, 71 bytes)
+                kind 2: raw frame, 24 packet bytes and the float64 pctimestamp
+
+Publishing only appends to an inbox and never blocks. One I/O thread encodes each
+message once and queues it for every subscriber. A subscriber whose bounded queue
+is full either loses its oldest messages ("drop") or is disconnected ("disconnect").
+If the I/O thread falls InboxSize messages behind, the inbox loses its oldest ones
+too; they are counted in inboxDropped and the inboxDrops metric
+
+Usage
+    python BryServer.py --load-test 500 --rate 1000    //local load test with 500 subscribers
+    python BryServer.py localhost:8869      //print the stream of a running server
+'''
+
+import argparse
+import collections
+import json
+import math
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+import numpy as np
+
+from PyBry import SampleColumns, StateNames, EncodeSample, Nread
+from BryMetrics import metrics
+
+
+ServerAddress       = "localhost:8869"
+SubscriberQueueSize = 1024   #messages queued per subscriber before the slow-consumer policy applies
+InboxSize           = 65536  #published messages waiting for the I/O thread
+SendBatch           = 64     #queued messages joined into one send
+ReceiveSize         = 4096
+
+KindSample = 1
+KindFrame  = 2
+MessageHeader = struct.Struct('<HB')
+FrameBody     = struct.Struct('<{}sd'.format(Nread))
+SampleRecord  = np.dtype([(name, np.dtype(dtype).newbyteorder('<'), shape) for name, dtype, shape in SampleColumns])
+
+
+def ParseAddress(address):
+    '''returns (socket family, socket address) of "host:port" or "unix:/path"'''
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[5:]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or "localhost", int(port))
+
+def Finite(value):
+    '''JSON has no nan or inf'''
+    return value if math.isfinite(value) else None
+
+def EncodeJSON(kind, message):
+    if kind == KindFrame:
+        inbytes, pctimestamp = message
+        return (json.dumps({"frame":inbytes.hex(), "pctimestamp":pctimestamp}) + "\n").encode()
+    sample = message
+    record = {"timecode":sample["timecode"], "pctimestamp":sample["pctimestamp"],
+              "state":[name for name in StateNames if sample["state"][name]]}
+    for display, measure in [("upper", sample["measureUpper"]), ("lower", sample["measureLower"])]:
+        record[display] = {"text":measure["text"], "value":Finite(measure["value"]), "unit":measure["unit"],
+                           "valueOrg":Finite(measure["valueOrg"]), "unitOrg":measure["unitOrg"], "source":measure["source"]}
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode()
+
+def EncodeBinary(kind, message):
+    if kind == KindFrame:
+        inbytes, pctimestamp = message
+        body = FrameBody.pack(bytes(inbytes), pctimestamp)
+    else:
+        row = EncodeSample(message)
+        record = np.zeros(1, dtype=SampleRecord)
+        for name in SampleRecord.names:
+            record[name] = row[name]
+        body = record.tobytes()
+    return MessageHeader.pack(len(body), kind) + body
+
+Encoders = {"json":EncodeJSON, "binary":EncodeBinary}
+
+
+class Subscriber:
+    '''a connected client: its socket, queued messages and the unsent rest of the last send'''
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.queue = collections.deque()
+        self.pending = None
+        self.writing = False
+        self.sent = 0
+        self.dropped = 0
+
+
+class SampleServer:
+    '''
+    ====================================================================================
+    SampleServer: accepts subscribers and streams published samples to them from one
+    I/O thread with non-blocking sockets. Publish/PublishFrame are called from the
+    sampling thread and cost an append to the inbox, whatever the subscribers do
+    ====================================================================================
+    '''
+    def __init__(self, address=ServerAddress, encoding="json", raw=False, queueSize=SubscriberQueueSize, policy="drop"):
+        if encoding not in Encoders:
+            raise ValueError("unknown encoding " + encoding)
+        if policy not in ("drop", "disconnect"):
+            raise ValueError("unknown slow consumer policy " + policy)
+        self.address = address
+        self.encode = Encoders[encoding]
+        self.raw = raw
+        self.queueSize = queueSize
+        self.policy = policy
+        self.inbox = collections.deque(maxlen=InboxSize)
+        self.subscribers = []
+        self.listener = None
+        self.selector = None
+        self.thread = None
+        self.running = False
+        self.wakePending = False
+        self.published = 0
+        self.dropped = 0
+        self.inboxDropped = 0 #messages the full inbox lost before the I/O thread got to them
+        self.disconnected = 0
+
+    def Start(self):
+        family, address = ParseAddress(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        if family == socket.AF_INET:
+            #port 0 picks a free port
+            self.address = "{}:{}".format(*self.listener.getsockname()[:2])
+
+        self.wakeRecv, self.wakeSend = socket.socketpair()
+        self.wakeRecv.setblocking(False)
+        self.wakeSend.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ, "accept")
+        self.selector.register(self.wakeRecv, selectors.EVENT_READ, "wake")
+
+        self.running = True
+        self.thread = threading.Thread(target=self.Run, name="BryServer", daemon=True)
+        self.thread.start()
+        return self
+
+    def Close(self):
+        if not self.running:
+            return
+        self.running = False
+        self.Wake()
+        self.thread.join()
+        for sub in list(self.subscribers):
+            self.Disconnect(sub)
+        self.selector.close()
+        self.listener.close()
+        self.wakeRecv.close()
+        self.wakeSend.close()
+        family, address = ParseAddress(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+
+    def Publish(self, sample):
+        '''queues a decoded sample for all subscribers'''
+        self.Enqueue((KindSample, sample))
+
+    def PublishFrame(self, inbytes, pctimestamp):
+        '''queues a raw frame for all subscribers if the server streams raw frames'''
+        if self.raw:
+            self.Enqueue((KindFrame, (inbytes, pctimestamp)))
+
+    def Enqueue(self, message):
+        #a full inbox drops its oldest message. Not locked against the I/O thread, which
+        #may make room meanwhile, so a rare drop is counted that didn't happen
+        if len(self.inbox) == self.inbox.maxlen:
+            self.inboxDropped += 1
+            if metrics.enabled:
+                metrics.Count("inboxDrops")
+        self.inbox.append(message)
+        self.Wake()
+
+    def Wake(self):
+        #one wake-up byte at a time is enough, the I/O thread drains the whole inbox
+        if not self.wakePending:
+            self.wakePending = True
+            try:
+                self.wakeSend.send(b'w')
+            except (BlockingIOError, OSError):
+                pass
+
+    def GetStats(self):
+        return {"subscribers":len(self.subscribers), "published":self.published, "dropped":self.dropped,
+                "inboxDropped":self.inboxDropped, "disconnected":self.disconnected, "queued":sum(len(sub.queue) for sub in self.subscribers)}
+
+    def Run(self):
+        while self.running:
+            for key, events in self.selector.select(timeout=1.0):
+                if key.data == "accept":
+                    self.Accept()
+                elif key.data == "wake":
+                    self.DrainInbox()
+                else:
+                    sub = key.data
+                    if events & selectors.EVENT_READ:
+                        self.Receive(sub)
+                    if events & selectors.EVENT_WRITE and sub.sock is not None:
+                        self.Flush(sub)
+
+    def Accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, OSError):
+                return
+            sock.setblocking(False)
+            sub = Subscriber(sock, address)
+            self.subscribers.append(sub)
+            self.selector.register(sock, selectors.EVENT_READ, sub)
+
+    def Receive(self, sub):
+        '''subscribers don't send anything, a read only tells that they hung up'''
+        try:
+            data = sub.sock.recv(ReceiveSize)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.Disconnect(sub)
+
+    def Disconnect(self, sub):
+        if sub.sock is None:
+            return
+        self.selector.unregister(sub.sock)
+        sub.sock.close()
+        sub.sock = None
+        sub.queue.clear()
+        self.subscribers.remove(sub)
+
+    def DrainInbox(self):
+        try:
+            while self.wakeRecv.recv(ReceiveSize):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        self.wakePending = False
+
+        inbox = self.inbox
+        while inbox:
+            kind, message = inbox.popleft()
+            self.published += 1
+            if not self.subscribers:
+                continue
+            data = self.encode(kind, message)
+            for sub in list(self.subscribers):
+                if len(sub.queue) >= self.queueSize:
+                    if self.policy == "disconnect":
+                        self.disconnected += 1
+                        self.Disconnect(sub)
+                        continue
+                    sub.queue.popleft()
+                    sub.dropped += 1
+                    self.dropped += 1
+                sub.queue.append(data)
+
+        for sub in list(self.subscribers):
+            if not sub.writing:
+                self.Flush(sub)
+
+    def Flush(self, sub):
+        '''sends as much as the socket takes without blocking. Whatever is left is sent
+        when the socket is writable again'''
+        try:
+            while True:
+                if sub.pending is None:
+                    if not sub.queue:
+                        break
+                    count = min(len(sub.queue), SendBatch)
+                    sub.pending = memoryview(b''.join(sub.queue.popleft() for i in range(count)))
+                    sub.sent += count
+                n = sub.sock.send(sub.pending)
+                sub.pending = sub.pending[n:] if n < len(sub.pending) else None
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.Disconnect(sub)
+            return
+
+        writing = sub.pending is not None or len(sub.queue) > 0
+        if writing != sub.writing:
+            sub.writing = writing
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            self.selector.modify(sub.sock, events, sub)
+
+
+def Subscribe(address=ServerAddress, encoding="json"):
+    '''connects to a SampleServer and yields its messages: dicts for json, for binary
+    (KindSample, SampleRecord) or (KindFrame, (packet bytes, pctimestamp))'''
+    family, sockAddress = ParseAddress(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(sockAddress)
+        stream = sock.makefile("rb")
+        if encoding == "json":
+            for line in stream:
+                yield json.loads(line)
+            return
+        while True:
+            header = stream.read(MessageHeader.size)
+            if len(header) < MessageHeader.size:
+                return
+            length, kind = MessageHeader.unpack(header)
+            body = stream.read(length)
+            if len(body) < length:
+                return
+            if kind == KindSample:
+                yield kind, np.frombuffer(body, dtype=SampleRecord)[0]
+            elif kind == KindFrame:
+                yield kind, FrameBody.unpack(body)
+
+
+def LoadTest(subscribers=200, packets=20000, slow=0, encoding="binary", policy="drop", queueSize=SubscriberQueueSize, rate=None, address="localhost:0"):
+    '''publishes packets synthetic samples, rate per second or as fast as possible, to
+    subscribers reading clients plus slow ones that never read. Returns a dict of results'''
+    from PyBry import BrymenDecoder
+    server = SampleServer(address, encoding, queueSize=queueSize, policy=policy).Start()
+    family, sockAddress = ParseAddress(server.address)
+    received = [0] * subscribers
+    socks = []
+
+    def Reader(i, sock):
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            received[i] += len(data)
+
+    threads = []
+    for i in range(subscribers + slow):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(sockAddress)
+        socks.append(sock)
+        if i < subscribers:
+            threads.append(threading.Thread(target=Reader, args=(i, sock), daemon=True))
+            threads[-1].start()
+    while len(server.subscribers) < subscribers + slow:
+        time.sleep(0.01)
+
+    #one steady measurement, the timecode counts up
+    decoder = BrymenDecoder()
+    packet = bytearray(b'\x00\x00\xbe\xa0\xda\xf8\xe4\x7c\x00\x00\x00\x00\x00\x08\x00\x86\x86\x86\x86\x00\x00\x00\x00\x00')
+    slowest = 0.0
+    began = time.perf_counter()
+    for timecode in range(packets):
+        if rate:
+            delay = began + timecode / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        packet[20:24] = timecode.to_bytes(4, 'little')
+        sample = {"inbytes":bytes(packet), "pctimestamp":time.time()}
+        sample["timecode"], sample["state"], sample["measureUpper"], sample["measureLower"], unpacked = decoder.DecodePacket(packet)
+        t = time.perf_counter()
+        server.Publish(sample)
+        slowest = max(slowest, time.perf_counter() - t)
+    publishSeconds = time.perf_counter() - began
+
+    #wait until the readers stop receiving
+    messageSize = len(server.encode(KindSample, sample))
+    total, lastChange = -1, time.perf_counter()
+    while sum(received) != total:
+        if total >= 0:
+            lastChange = time.perf_counter()
+        total = sum(received)
+        time.sleep(0.3)
+    deliverSeconds = lastChange - began
+    stats = server.GetStats()
+    for sock in socks:
+        sock.close()
+    server.Close()
+
+    messages = [count // messageSize for count in received]
+    return {"subscribers":subscribers, "slow":slow, "packets":packets, "publishPerSecond":packets / publishSeconds,
+            "slowestPublishMicroseconds":slowest * 1e6, "deliveredPerSecond":sum(messages) / deliverSeconds,
+            "minReceived":min(messages) if messages else 0, "dropped":stats["dropped"], "inboxDropped":stats["inboxDropped"],
+            "disconnected":stats["disconnected"]}
+
+def Main(argv=None):
+    parser = argparse.ArgumentParser(description="Brymen sample stream client and load test")
+    parser.add_argument("address", nargs="?", default=ServerAddress, help='"host:port" or "unix:/path" of the server')
+    parser.add_argument("--encoding", choices=list(Encoders), default="json")
+    parser.add_argument("--load-test", type=int, metavar="N", help="run a local load test with N subscribers")
+    parser.add_argument("--slow", type=int, default=0, help="load test subscribers that never read")
+    parser.add_argument("--packets", type=int, default=20000, help="load test samples")
+    parser.add_argument("--rate", type=float, help="load test samples per second (default: as fast as possible)")
+    parser.add_argument("--policy", choices=["drop", "disconnect"], default="drop")
+    args = parser.parse_args(argv)
+
+    if args.load_test is not None:
+        result = LoadTest(args.load_test, args.packets, args.slow, args.encoding, args.policy, rate=args.rate)
+        print(json.dumps(result, indent=1))
+        return 0
+    for message in Subscribe(args.address, args.encoding):
+        print(message)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
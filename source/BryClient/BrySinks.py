@@ -0,0 +1,437 @@
+'''
+====================================================
+BrySinks: sample output pipeline
+====================================================
+
+The acquisition thread only appends each raw frame and its host timestamp to the
+pipeline's queue (SinkPipeline.Publish). The pipeline's thread decodes what queued
+up once, with DecodeBatch, and hands the Batch to every sink. Each sink runs in its
+own thread, wakes every period and handles the batches that queued up as one, so a
+slow terminal, disk or subscriber only delays its own sink. Sinks with a bounded queue
+drop their oldest frames when they fall behind; the drops are counted. A sink
+whose Write raises keeps serving: its first traceback goes to stderr, the errors
+are counted in SinkPipeline.GetStats
+
+sinks
+    HistorySink    //SampleHistory, the batch's columns. Lossless
+    ConsoleSink    //PrintSample output, at most rate samples per second, the rest summarized,
+                   //each line led by a label (the port of a MeterManager's meter)
+    LogSink        //PrintSample output of every sample to a file (BryReplay reads it back)
+    ExportSink     //CSV rows appended as samples arrive (PyBry.ExportFile). Lossless
+    NetworkSink    //BryServer subscribers
+    TriggerSink    //BryTrigger rules: events and triggered recordings. Lossless
+
+Usage
+    pipeline = SinkPipeline([HistorySink(history), ConsoleSink()]).Start()
+    pipeline.Publish(inbytes, pctimestamp)
+    pipeline.Stop()     //drains the queues and stops the sink threads
+    pipeline.Close()    //also closes the sinks' files
+'''
+
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+import numpy as np
+
+import PyBry
+from PyBry import BrymenDecoder, AsPacketArray, ExportJob
+from BryMetrics import metrics
+
+
+SinkBatchSize   = 4096 #frames a sink takes from its queue at once
+SinkQueueSize   = 65536 #frames queued for a bounded sink before the oldest are dropped
+ConsoleRate     = 20 #samples per second the console shows
+ConsolePeriod   = 0.2 #seconds
+HistoryPeriod   = 0.02 #seconds, well below the 50 ms UI refresh
+FilePeriod      = 0.5 #seconds
+DecodePeriod    = 0.01 #seconds, half of HistoryPeriod so decoding adds little latency
+
+
+def CSVHeader(columns):
+    '''the ExportJob header line, labelled with the first row's sources and units'''
+    labels = [(PyBry.SourceNames[columns["source" + key][0]], PyBry.UnitNames[columns["unit" + key][0]]) for key in ["Lower", "Upper"]]
+    header = "Timecode (ms), WallClock (seconds), {} ({}), {} ({})".format(*labels[0], *labels[1])
+    return "# " + header.replace('Ω', 'Ohm') + "\n"
+
+def CSVRows(columns):
+    '''SampleColumns arrays as ExportJob CSV rows'''
+    rows = np.column_stack([columns["timecode"], columns["pctimestamp"], columns["valueLower"], columns["valueUpper"]])
+    return (ExportJob.rowFormat * len(rows)) % tuple(rows.ravel().tolist())
+
+
+class Batch:
+    '''
+    ====================================================================================
+    Batch: frames decoded once for all sinks. Columns are the SampleColumns arrays
+    (pctimestamp included) the pipeline's thread decoded; Samples are the (sample,
+    unpackedData) pairs the text sinks format, decoded on the first request and
+    shared. Join makes one batch of several, concatenating only what is asked for
+    ====================================================================================
+    '''
+    def __init__(self, frames, stamps, columns=None, decoder=None, lock=None, parts=None):
+        self.frames = frames
+        self.stamps = stamps
+        self.columns = columns
+        self.decoder = decoder #also formats the samples (FormatSample)
+        self.lock = lock #the pipeline's, DecodePacket's cache isn't thread-safe
+        self.parts = parts
+        self.samples = None
+
+    @classmethod
+    def Join(cls, batches):
+        if len(batches) == 1:
+            return batches[0]
+        frames = [inbytes for batch in batches for inbytes in batch.frames]
+        stamps = [pctimestamp for batch in batches for pctimestamp in batch.stamps]
+        return cls(frames, stamps, decoder=batches[-1].decoder, parts=batches)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def Columns(self):
+        if self.columns is None:
+            parts = [part.Columns() for part in self.parts]
+            self.columns = {name: np.concatenate([columns[name] for columns in parts]) for name in parts[0]}
+        return self.columns
+
+    def Samples(self, start=0):
+        '''(sample, unpackedData) of the frames from start on, the way Connection.ProcessPacket
+        used to decode them'''
+        if self.parts is not None:
+            samples, offset = [], 0
+            for part in self.parts:
+                if offset + len(part) > start:
+                    samples.extend(part.Samples(max(start - offset, 0)))
+                offset += len(part)
+            return samples
+        if self.samples is None:
+            with self.lock:
+                if self.samples is None:
+                    self.samples = list(self.DecodeSamples())
+        return self.samples[start:]
+
+    def DecodeSamples(self):
+        for inbytes, pctimestamp in zip(self.frames, self.stamps):
+            sample = {"inbytes":inbytes, "pctimestamp":pctimestamp}
+            sample["timecode"], sample["state"], sample["measureUpper"], sample["measureLower"], unpackedData = self.decoder.DecodePacket(inbytes)
+            yield sample, unpackedData
+
+
+class Sink:
+    '''
+    ====================================================================================
+    Sink: base class. Subclasses implement Write(batch) for a Batch and optionally
+    Close, which releases its resources for good. queueSize is in frames, None makes
+    the sink lossless
+    ====================================================================================
+    '''
+    def __init__(self, name, period, queueSize=SinkQueueSize):
+        self.name = name
+        self.period = period
+        self.queue = deque() #of batches
+        self.queueSize = queueSize
+        self.queued = 0 #frames in queue
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.busy = False
+        self.running = False
+        self.thread = None
+        self.error = None #the last exception Write raised
+        self.errors = 0
+
+    def Start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.Serve, name="sink " + self.name, daemon=True)
+        self.thread.start()
+
+    def Stop(self):
+        '''drains the queue and ends the thread'''
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def Put(self, batch):
+        '''queues a batch. A bounded sink that fell behind drops its oldest batches'''
+        with self.lock:
+            self.queue.append(batch)
+            self.queued += len(batch)
+            while self.queueSize is not None and self.queued > self.queueSize and len(self.queue) > 1:
+                n = len(self.queue.popleft())
+                self.queued -= n
+                self.dropped += n
+
+    def Serve(self):
+        queue = self.queue
+        while self.running or queue:
+            self.busy = True
+            batches, n = [], 0
+            with self.lock:
+                while queue and n < SinkBatchSize:
+                    batches.append(queue.popleft())
+                    n += len(batches[-1])
+                self.queued -= n
+            if batches:
+                t = time.perf_counter()
+                try:
+                    self.Write(Batch.Join(batches))
+                except Exception as ex:
+                    #keep serving, one bad batch must not silence the sink
+                    if self.error is None:
+                        print("sink {} failed, later errors are only counted".format(self.name), file=sys.stderr)
+                        traceback.print_exc()
+                    self.error = ex
+                    self.errors += 1
+                self.processed += n
+                if metrics.enabled:
+                    metrics.Lap("sink." + self.name, t)
+            self.busy = False
+            if not queue:
+                time.sleep(self.period)
+
+    def Write(self, batch):
+        raise NotImplementedError
+
+    def Close(self):
+        pass
+
+
+class HistorySink(Sink):
+    def __init__(self, history, period=HistoryPeriod):
+        Sink.__init__(self, "history", period, None)
+        self.history = history
+
+    def Write(self, batch):
+        self.history.AddBatchToHistory(batch.Columns())
+
+
+class ConsoleSink(Sink):
+    '''prints the newest samples of each batch, at most rate per second, and the
+    number of the ones it left out. With a label every line starts with it, so the
+    meters sharing a console can be told apart'''
+    def __init__(self, rate=ConsoleRate, period=ConsolePeriod, stream=None, label=None):
+        Sink.__init__(self, "console", period)
+        self.rate = rate
+        self.stream = stream
+        self.label = label
+        self.skipped = 0
+
+    def Write(self, batch):
+        stream = self.stream or sys.stdout
+        shown = max(int(self.rate * self.period), 1)
+        text = []
+        if len(batch) > shown:
+            self.skipped += len(batch) - shown
+            text.append("... {} samples not shown\n".format(len(batch) - shown))
+        text.extend(batch.decoder.FormatSample(sample, unpackedData) for sample, unpackedData in batch.Samples(max(len(batch) - shown, 0)))
+        text = ''.join(text)
+        if self.label:
+            text = ''.join("{}: {}".format(self.label, line) for line in text.splitlines(True))
+        stream.write(text)
+
+
+class LogSink(Sink):
+    '''writes every sample to a text file, with the raw bytes and segments when debug'''
+    def __init__(self, fileName, debug=True, period=FilePeriod):
+        Sink.__init__(self, "log", period)
+        self.file = open(fileName, "a", encoding="utf-8")
+        self.debug = debug
+
+    def Write(self, batch):
+        self.file.write(''.join(batch.decoder.FormatSample(sample, unpackedData, self.debug) for sample, unpackedData in batch.Samples()))
+        self.file.flush()
+
+    def Close(self):
+        self.file.close()
+
+
+class ExportSink(Sink):
+    '''appends CSV rows in the format of ExportJob, with a header line taken from the
+    first batch'''
+    def __init__(self, fileName, period=FilePeriod):
+        Sink.__init__(self, "export", period, None)
+        self.file = open(fileName, "w", encoding="latin1")
+        self.headerWritten = False
+
+    def Write(self, batch):
+        columns = batch.Columns()
+        if not self.headerWritten:
+            self.file.write(CSVHeader(columns))
+            self.headerWritten = True
+        self.file.write(CSVRows(columns))
+        self.file.flush()
+
+    def Close(self):
+        self.file.close()
+
+
+class NetworkSink(Sink):
+    '''hands frames and decoded samples to a BryServer.SampleServer'''
+    def __init__(self, server, period=HistoryPeriod):
+        Sink.__init__(self, "network", period)
+        self.server = server
+
+    def Write(self, batch):
+        for sample, unpackedData in batch.Samples():
+            self.server.PublishFrame(sample["inbytes"], sample["pctimestamp"])
+            self.server.Publish(sample)
+
+
+def LabelledName(fileName, label):
+    '''fileName with label before its extension, so the meters of a MeterManager write
+    a file each'''
+    if not label:
+        return fileName
+    root, extension = os.path.splitext(fileName)
+    return "{}.{}{}".format(root, label.replace('/', '_').strip('_'), extension)
+
+def DefaultPipeline(history, server=None, label=None, model=None):
+    '''the sinks PyBry's settings ask for: history (unless None), console (its lines
+    led by label), LogFile, ExportFile (named after label too), server and Triggers,
+    decoding frames of model'''
+    pipeline = SinkPipeline([HistorySink(history)] if history is not None else [], model)
+    pipeline.Add(ConsoleSink(label=label))
+    if PyBry.LogFile:
+        pipeline.Add(LogSink(PyBry.LogFile, PyBry.DebugOn))
+    if PyBry.ExportFile:
+        pipeline.Add(ExportSink(LabelledName(PyBry.ExportFile, label)))
+    if server is not None:
+        pipeline.Add(NetworkSink(server))
+    if PyBry.Triggers:
+        import BryTrigger
+        engine = BryTrigger.TriggerEngine(BryTrigger.ParseRules(PyBry.Triggers), recordBase=PyBry.TriggerRecordBase, onEvent=BryTrigger.PrintEvent)
+        pipeline.Add(BryTrigger.TriggerSink(engine))
+    return pipeline
+
+
+class SinkPipeline:
+    '''
+    ====================================================================================
+    SinkPipeline: fans frames out to the sinks. Publish is called from one
+    acquisition thread and costs a deque append, whatever the sinks do. The
+    pipeline's thread decodes what was published once per batch and queues the
+    Batch for every sink
+    ====================================================================================
+    '''
+    def __init__(self, sinks=(), model=None):
+        self.sinks = []
+        self.queue = deque()
+        self.published = 0
+        self.decoded = 0
+        self.running = False
+        self.busy = False
+        self.thread = None
+        self.error = None #the last exception decoding raised
+        self.errors = 0
+        self.lost = 0 #frames of the batches that failed to decode
+        #the meter model the frames are decoded as, MeterModel by default
+        self.decoder = BrymenDecoder(model=model)
+        self.lock = threading.Lock()
+        for sink in sinks:
+            self.Add(sink)
+
+    def Add(self, sink):
+        self.sinks.append(sink)
+        if self.running:
+            sink.Start()
+        return sink
+
+    def SetModel(self, model):
+        '''decodes the frames of another meter model from the next batch on'''
+        self.decoder = BrymenDecoder(model=model)
+
+    def Remove(self, sink):
+        self.sinks = [s for s in self.sinks if s is not sink]
+        sink.Stop()
+        sink.Close()
+
+    def Publish(self, inbytes, pctimestamp):
+        self.queue.append((inbytes, pctimestamp))
+        self.published += 1
+
+    def Serve(self):
+        queue = self.queue
+        while self.running or queue:
+            self.busy = True
+            frames, stamps = [], []
+            try:
+                while queue and len(frames) < SinkBatchSize:
+                    inbytes, pctimestamp = queue.popleft()
+                    frames.append(inbytes)
+                    stamps.append(pctimestamp)
+            except IndexError:
+                pass
+            if frames:
+                self.Dispatch(frames, stamps)
+            self.busy = False
+            if not queue:
+                time.sleep(DecodePeriod)
+
+    def Dispatch(self, frames, stamps):
+        '''decodes a batch and queues it for every sink'''
+        t = time.perf_counter()
+        decoder = self.decoder
+        try:
+            columns = decoder.DecodeBatch(AsPacketArray(b''.join(frames)))
+            columns["pctimestamp"] = np.array(stamps, dtype=np.float64)
+        except Exception as ex:
+            if self.error is None:
+                print("decoding failed, later errors are only counted", file=sys.stderr)
+                traceback.print_exc()
+            self.error = ex
+            self.errors += 1
+            self.lost += len(frames)
+            return
+        self.decoded += len(frames)
+        if metrics.enabled:
+            metrics.Lap("decode", t)
+        batch = Batch(frames, stamps, columns, decoder, self.lock)
+        for sink in self.sinks:
+            sink.Put(batch)
+
+    def Start(self):
+        if not self.running:
+            self.running = True
+            for sink in self.sinks:
+                sink.Start()
+            self.thread = threading.Thread(target=self.Serve, name="sink decode", daemon=True)
+            self.thread.start()
+        return self
+
+    def Flush(self, timeout=None):
+        '''waits until every sink handled what was published so far. Returns False on
+        timeout'''
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while ((self.thread is not None and (self.queue or self.busy)) or
+               any(sink.queue or sink.busy for sink in self.sinks if sink.thread is not None)):
+            if deadline is not None and time.perf_counter() > deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def Stop(self):
+        '''drains the queues and stops the threads. Start runs them again'''
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for sink in self.sinks:
+            sink.Stop()
+
+    def Close(self):
+        '''stops the sinks and closes their files'''
+        self.Stop()
+        for sink in self.sinks:
+            sink.Close()
+
+    def GetStats(self):
+        '''per sink, and for decoding under "decode" '''
+        stats = {"decode": {"processed":self.decoded, "queued":len(self.queue), "dropped":self.lost, "errors":self.errors, "error":None if self.error is None else repr(self.error)}}
+        for sink in self.sinks:
+            stats[sink.name] = {"processed":sink.processed, "queued":sink.queued, "dropped":sink.dropped,
+                                "errors":sink.errors, "error":None if sink.error is None else repr(sink.error)}
+        return stats
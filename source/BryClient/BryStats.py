@@ -0,0 +1,318 @@
+'''
+====================================================
+BryStats: incremental statistics of the displays
+====================================================
+
+Count, mean, standard deviation, min, max, an EWMA and the linear trend slope of
+both displays over sliding time windows and the whole session. Mean, variance
+and the slope's covariance are Welford moments, removed again when samples leave
+a window; min and max come from monotonic deques. Single samples update in O(1),
+batches are merged with Chan's formulas, so a history load doesn't loop over
+every sample. Time is the history's continuous time in seconds (device timecode
+carried across restarts, see PyBry.SampleHistory.Times). A channel starts over
+when its unit or source changes
+
+Snapshot layout
+    {"lower": {"unit":"V", "source":"DC Voltage", "scopes": {"10s": {...}, "60s": {...}, "session": {...}}},
+     "upper": {...}}
+    scope: count, mean, std, min, max, ewma, slope (unit/s), span (s), invalid (overload/nan samples)
+'''
+
+import math
+from collections import deque
+import numpy as np
+
+
+StatsWindows    = (10.0, 60.0, 600.0) #seconds
+SessionTau      = 60.0 #seconds, EWMA time constant of the session scope (windows use their length)
+RecomputePeriod = 100000 #samples removed from a window before its moments are recomputed exactly
+SmallBatch      = 64 #batches up to this size are added sample by sample, cheaper than numpy
+
+
+def Moments(t, v):
+    '''(n, mean t, mean v, M2 t, M2 v, C tv) of arrays'''
+    n = len(t)
+    if n == 0:
+        return (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    meanT, meanV = float(t.mean()), float(v.mean())
+    dt, dv = t - meanT, v - meanV
+    return (n, meanT, meanV, float(dt @ dt), float(dv @ dv), float(dt @ dv))
+
+def MergeMoments(a, b):
+    '''moments of the union of two sets (Chan et al.)'''
+    nA, nB = a[0], b[0]
+    if nA == 0:
+        return b
+    if nB == 0:
+        return a
+    n = nA + nB
+    dT, dV = b[1] - a[1], b[2] - a[2]
+    f = nA * nB / n
+    return (n, a[1] + dT * nB / n, a[2] + dV * nB / n, a[3] + b[3] + dT * dT * f, a[4] + b[4] + dV * dV * f, a[5] + b[5] + dT * dV * f)
+
+def RemoveMoments(ab, b):
+    '''moments of a set after removing the subset b'''
+    n, nB = ab[0], b[0]
+    nA = n - nB
+    if nA <= 0:
+        return (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    meanT = (n * ab[1] - nB * b[1]) / nA
+    meanV = (n * ab[2] - nB * b[2]) / nA
+    dT, dV = b[1] - meanT, b[2] - meanV
+    f = nA * nB / n
+    return (nA, meanT, meanV, max(ab[3] - b[3] - dT * dT * f, 0.0), max(ab[4] - b[4] - dV * dV * f, 0.0), ab[5] - b[5] - dT * dV * f)
+
+def SuffixExtremes(t, v, less):
+    '''the entries of a monotonic deque built from scratch over (t, v): those strictly
+    below (less) or above every later value'''
+    if less:
+        best = np.minimum.accumulate(v[::-1])[::-1]
+        keep = np.append(v[:-1] < best[1:], True)
+    else:
+        best = np.maximum.accumulate(v[::-1])[::-1]
+        keep = np.append(v[:-1] > best[1:], True)
+    return list(zip(t[keep].tolist(), v[keep].tolist()))
+
+
+class Timeline:
+    '''device timecodes (ms) to continuous seconds: a step back (device restart or
+    wrap) continues from the previous time. For streams without a SampleHistory, e.g.
+    BryTrigger's; SampleHistory.Times does the same for stored rows'''
+    def __init__(self):
+        self.offset = 0.0
+        self.lastT = None
+
+    def Times(self, timecodes):
+        t = np.asarray(timecodes, dtype=np.float64) / 1000.0
+        steps = np.diff(np.concatenate(([self.lastT if self.lastT is not None else t[0]], t)))
+        back = np.where(steps < 0, -steps, 0.0)
+        t = t + self.offset + np.cumsum(back)
+        self.offset += float(back.sum())
+        self.lastT = float(t[-1]) - self.offset
+        return t
+
+    def Time(self, timecode):
+        '''Times for a single timecode'''
+        t = timecode / 1000.0
+        if self.lastT is not None and t < self.lastT:
+            self.offset += self.lastT - t
+        self.lastT = t
+        return t + self.offset
+
+
+class ScopeStats:
+    '''
+    ====================================================================================
+    ScopeStats: statistics of one channel over the last window seconds, or over all
+    samples if window is None. Values must be finite and times non-decreasing
+    ====================================================================================
+    '''
+    def __init__(self, window=None, tau=None):
+        self.window = window
+        self.tau = tau or window or SessionTau
+        self.Clear()
+
+    def Clear(self):
+        self.moments = (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        self.samples = deque()
+        self.minQ = deque()
+        self.maxQ = deque()
+        self.min = math.inf
+        self.max = -math.inf
+        self.ewma = math.nan
+        self.firstT = None
+        self.lastT = None
+        self.removed = 0
+
+    def Add(self, t, v):
+        #Welford
+        n, meanT, meanV, m2T, m2V, cTV = self.moments
+        n += 1
+        dT, dV = t - meanT, v - meanV
+        meanT += dT / n
+        meanV += dV / n
+        self.moments = (n, meanT, meanV, m2T + dT * (t - meanT), m2V + dV * (v - meanV), cTV + dT * (v - meanV))
+
+        if self.lastT is None:
+            self.ewma = v
+            self.firstT = t
+        else:
+            self.ewma += (1.0 - math.exp(-(t - self.lastT) / self.tau)) * (v - self.ewma)
+        self.lastT = t
+
+        if self.window is None:
+            self.min = min(self.min, v)
+            self.max = max(self.max, v)
+            return
+        self.samples.append((t, v))
+        while self.minQ and self.minQ[-1][1] >= v:
+            self.minQ.pop()
+        self.minQ.append((t, v))
+        while self.maxQ and self.maxQ[-1][1] <= v:
+            self.maxQ.pop()
+        self.maxQ.append((t, v))
+        self.Expire(t - self.window)
+
+    def AddBatch(self, t, v):
+        '''adds arrays of samples, same result as Add for each'''
+        if len(t) == 0:
+            return
+        #EWMA over the batch: the final value is the weighted sum of the values, each
+        #decayed by the steps after it
+        if self.lastT is None:
+            self.ewma, self.firstT, self.lastT = float(v[0]), float(t[0]), float(t[0])
+        steps = np.diff(np.concatenate(([self.lastT], t))) / self.tau
+        alpha = -np.expm1(-steps)
+        decayAfter = np.exp(-(np.cumsum(steps[::-1])[::-1] - steps))
+        self.ewma = self.ewma * math.exp(-steps.sum()) + float((alpha * decayAfter) @ v)
+        self.lastT = float(t[-1])
+
+        if self.window is None:
+            self.moments = MergeMoments(self.moments, Moments(t, v))
+            self.min = min(self.min, float(v.min()))
+            self.max = max(self.max, float(v.max()))
+            return
+
+        #only the part of the batch that is still in the window afterwards matters
+        cutoff = float(t[-1]) - self.window
+        first = int(np.searchsorted(t, cutoff, side="right"))
+        t, v = t[first:], v[first:]
+        self.Expire(cutoff)
+        if len(t) == 0:
+            return
+        self.moments = MergeMoments(self.moments, Moments(t, v))
+        self.samples.extend(zip(t.tolist(), v.tolist()))
+        for queue, less in [(self.minQ, True), (self.maxQ, False)]:
+            edge = float(v.min()) if less else float(v.max())
+            while queue and (queue[-1][1] >= edge if less else queue[-1][1] <= edge):
+                queue.pop()
+            queue.extend(SuffixExtremes(t, v, less))
+
+    def Expire(self, cutoff):
+        '''removes the samples at or before cutoff from the window'''
+        samples = self.samples
+        if samples and samples[0][0] <= cutoff:
+            if samples[-1][0] <= cutoff:
+                self.removed += len(samples)
+                samples.clear()
+                self.moments = (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+            else:
+                old = []
+                while samples[0][0] <= cutoff:
+                    old.append(samples.popleft())
+                if len(old) < 16:
+                    for t, v in old:
+                        self.moments = RemoveMoments(self.moments, (1, t, v, 0.0, 0.0, 0.0))
+                else:
+                    old = np.array(old)
+                    self.moments = RemoveMoments(self.moments, Moments(old[:, 0], old[:, 1]))
+                self.removed += len(old)
+            if self.removed >= RecomputePeriod:
+                #downdates lose precision over time, start from the exact moments again
+                self.removed = 0
+                window = np.array(samples) if samples else np.empty((0, 2))
+                self.moments = Moments(window[:, 0], window[:, 1])
+        while self.minQ and self.minQ[0][0] <= cutoff:
+            self.minQ.popleft()
+        while self.maxQ and self.maxQ[0][0] <= cutoff:
+            self.maxQ.popleft()
+
+    def Get(self):
+        n, meanT, meanV, m2T, m2V, cTV = self.moments
+        if self.window is None:
+            low, high = (self.min, self.max) if n else (math.nan, math.nan)
+            span = self.lastT - self.firstT if n else 0.0
+        else:
+            #the writer may empty the deques meanwhile
+            try:
+                low, high = self.minQ[0][1], self.maxQ[0][1]
+                span = self.samples[-1][0] - self.samples[0][0]
+            except IndexError:
+                low, high, span = math.nan, math.nan, 0.0
+        return {"count":n, "mean":meanV if n else math.nan, "std":math.sqrt(m2V / (n - 1)) if n > 1 else math.nan,
+                "min":low, "max":high, "ewma":self.ewma if n else math.nan,
+                "slope":cTV / m2T if m2T > 0 else math.nan, "span":span}
+
+
+class ChannelStats:
+    '''the scopes of one display, started over when its unit or source changes'''
+    def __init__(self, windows):
+        self.scopes = {"{:g}s".format(window): ScopeStats(window) for window in windows}
+        self.scopes["session"] = ScopeStats()
+        self.key = None
+        self.invalid = 0
+
+    def Clear(self):
+        for scope in self.scopes.values():
+            scope.Clear()
+        self.key = None
+        self.invalid = 0
+
+    def Add(self, t, v, key):
+        if key != self.key:
+            self.Clear()
+            self.key = key
+        if not math.isfinite(v):
+            self.invalid += 1
+            return
+        for scope in self.scopes.values():
+            scope.Add(t, v)
+
+    def AddBatch(self, t, v, keys):
+        '''keys: per-sample (unit, source) codes as an Nx2 array'''
+        if len(t) <= SmallBatch:
+            for sample in zip(t.tolist(), v.tolist(), map(tuple, keys.tolist())):
+                self.Add(*sample)
+            return
+        #every change starts over, so only the samples after the last one count
+        changes = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+        start = int(changes[-1]) if len(changes) else 0
+        key = tuple(keys[start].tolist())
+        if key != self.key or start > 0:
+            self.Clear()
+            self.key = key
+        t, v = t[start:], v[start:]
+        finite = np.isfinite(v)
+        self.invalid += int(len(v) - finite.sum())
+        for scope in self.scopes.values():
+            scope.AddBatch(t[finite], v[finite])
+
+
+class RollingStats:
+    '''
+    ====================================================================================
+    RollingStats: ChannelStats of the lower and upper display of a SampleHistory,
+    added to by one writer. Snapshot reads them without a lock: each scope's moments
+    are one tuple that is replaced, never changed, so they are always consistent
+    ====================================================================================
+    '''
+    channels = [("lower", "Lower"), ("upper", "Upper")]
+
+    def __init__(self, windows=StatsWindows, unitNames=None, sourceNames=None):
+        self.windows = windows
+        self.unitNames = unitNames
+        self.sourceNames = sourceNames
+        self.Clear()
+
+    def Clear(self):
+        self.stats = {display: ChannelStats(self.windows) for display, key in self.channels}
+
+    def AddBatch(self, columns, t):
+        '''columns: value, unit and source arrays of both displays (see PyBry.SampleColumns),
+        t: their times in seconds, non-decreasing'''
+        if len(t) == 0:
+            return
+        for display, key in self.channels:
+            keys = np.column_stack([columns["unit" + key], columns["source" + key]])
+            self.stats[display].AddBatch(t, np.asarray(columns["value" + key], dtype=np.float64), keys)
+
+    def Snapshot(self):
+        snapshot = {}
+        for display, key in self.channels:
+            channel = self.stats[display]
+            unit = source = ""
+            if channel.key is not None and self.unitNames is not None:
+                unit, source = self.unitNames[channel.key[0]], self.sourceNames[channel.key[1]]
+            scopes = {name: dict(scope.Get(), invalid=channel.invalid) for name, scope in channel.scopes.items()}
+            snapshot[display] = {"unit":unit, "source":source, "scopes":scopes}
+        return snapshot
@@ -0,0 +1,403 @@
+'''
+====================================================
+BryTrigger: streaming triggers and events
+====================================================
+
+Evaluates declarative rules on the decoded sample stream and turns what they
+detect into events, timestamped and with the samples just before and after the
+trigger. Rules look at whole batches of SampleColumns and carry only their last
+state into the next one, so the time per sample is constant and memory is
+bounded by the windows. TriggerSink runs the engine in its own sink thread, off
+the acquisition path. An event can also start or stop a recording
+
+Rules as ParseRule reads them (channel lower or upper, flag one of StateNames)
+    lower > 5                //rises to 5 or above, once until it fell below 5 again
+    upper < -1 hyst 0.05     //falls below -1, once until it rose to -0.95 again
+    lower settle 0.01 2      //stays within ±0.01 for 2 seconds
+    lower change             //unit, range or source changes
+    lower overload           //display shows OL or ? (NaN)
+    hold on                  //state flag set. off: cleared, toggle: either
+    ... => start             //the event starts a recording, => stop ends it
+
+Event
+    {"rule", "action", "sample" (number since the start), "timecode", "pctimestamp",
+     "channel", "value", "file" (recording started),
+     "pre": the pre samples before the trigger, "post": the trigger sample and the post after it}
+     pre and post are numpy record arrays with the SampleColumns fields, e.g. event["pre"]["valueLower"]
+
+Usage
+    engine = TriggerEngine(ParseRules(["lower > 5 => start", "lower < 1 => stop"]), recordBase="run")
+    engine.Process(columns)     //e.g. DecodeBatch output with pctimestamp
+    engine.events               //completed events, newest last
+    engine.Close()              //ends the recording, completes pending events
+'''
+
+import math
+import os
+from collections import deque
+import numpy as np
+
+from PyBry import StateNames
+from BryStats import Timeline
+from BrySinks import Sink, HistoryPeriod, CSVHeader, CSVRows
+
+
+PreSamples  = 100 #samples kept before a trigger
+PostSamples = 100 #samples kept after a trigger
+MaxEvents   = 1000 #completed events kept in TriggerEngine.events
+
+Channels    = {"lower":"Lower", "upper":"Upper"}
+FlagNames   = dict({name.lower(): name for name in StateNames}, hold="Holding", rel="Relative", rec="Recording")
+
+
+def Records(columns):
+    '''SampleColumns arrays as one record array, so a window of samples is one slice'''
+    records = np.empty(len(columns["timecode"]), dtype=[(name, col.dtype, col.shape[1:]) for name, col in columns.items()])
+    for name, col in columns.items():
+        records[name] = col
+    return records
+
+def Raw(records):
+    '''records as opaque rows, which numpy copies and concatenates many times faster'''
+    return records.view((np.void, records.dtype.itemsize))
+
+def Previous(values, last):
+    '''values shifted by one, last (the previous batch's final value) first'''
+    return np.concatenate(([values[0] if last is None else last], values[:-1]))
+
+
+#====================================================================================
+# Rules
+#====================================================================================
+class Rule:
+    '''
+    ====================================================================================
+    Rule: base class. Evaluate(t, columns) returns the indices of the batch where
+    the rule fires, t being continuous time in seconds. A rule keeps what it needs
+    of the previous batch, so it fires the same however the stream is split
+    ====================================================================================
+    '''
+    channel = None
+
+    def __init__(self, name, action=None):
+        self.name = name
+        self.action = action
+        self.Reset()
+
+    def Reset(self):
+        pass
+
+    def Evaluate(self, t, columns):
+        raise NotImplementedError
+
+
+class Threshold(Rule):
+    '''fires when the value crosses level rising (or falling), then re-arms once it went
+    back beyond level by hysteresis. NaN leaves the state as it is'''
+    def __init__(self, channel, level, rising=True, hysteresis=0.0, name=None, action=None):
+        self.channel = channel
+        self.level = level
+        self.rising = rising
+        self.hysteresis = hysteresis
+        Rule.__init__(self, name or "{} {} {:g}".format(channel.lower(), ">" if rising else "<", level), action)
+
+    def Reset(self):
+        self.state = 0 #1 crossed, -1 armed, 0 not known yet
+
+    def Evaluate(self, t, columns):
+        v = columns["value" + self.channel]
+        with np.errstate(invalid='ignore'):
+            if self.rising:
+                crossed, armed = v >= self.level, v < self.level - self.hysteresis
+            else:
+                crossed, armed = v < self.level, v >= self.level + self.hysteresis
+        #Schmitt trigger: the state is the side last reached
+        marks = np.where(crossed, 1, np.where(armed, -1, 0)).astype(np.int8)
+        last = np.maximum.accumulate(np.where(marks != 0, np.arange(len(v)), -1))
+        state = np.where(last >= 0, marks[np.maximum(last, 0)], self.state)
+        fires = np.flatnonzero((state == 1) & (Previous(state, self.state) == -1))
+        self.state = int(state[-1])
+        return fires
+
+
+class Settle(Rule):
+    '''fires once the value stayed within ±tolerance of where it settled for duration
+    seconds, and again only after it left that band'''
+    def __init__(self, channel, tolerance, duration, name=None, action=None):
+        self.channel = channel
+        self.tolerance = tolerance
+        self.duration = duration
+        Rule.__init__(self, name or "{} settle {:g} {:g}".format(channel.lower(), tolerance, duration), action)
+
+    def Reset(self):
+        self.reference = math.nan
+        self.since = 0.0
+        self.fired = False
+
+    def Evaluate(self, t, columns):
+        #each step depends on the last reference, so this one loops
+        fires = []
+        reference, since, fired = self.reference, self.since, self.fired
+        tolerance, duration = self.tolerance, self.duration
+        for i, (when, value) in enumerate(zip(t.tolist(), columns["value" + self.channel].tolist())):
+            if not abs(value - reference) <= tolerance:
+                reference, since, fired = value, when, False
+            elif not fired and when - since >= duration:
+                fired = True
+                fires.append(i)
+        self.reference, self.since, self.fired = reference, since, fired
+        return np.array(fires, dtype=np.intp)
+
+
+class Change(Rule):
+    '''fires when the unit, range (prefixed unit) or source of the display changes'''
+    def __init__(self, channel, name=None, action=None):
+        self.channel = channel
+        Rule.__init__(self, name or channel.lower() + " change", action)
+
+    def Reset(self):
+        self.last = None
+
+    def Evaluate(self, t, columns):
+        keys = np.column_stack([columns[name + self.channel] for name in ["unit", "unitOrg", "source"]])
+        fires = np.flatnonzero(np.any(keys != Previous(keys, self.last), axis=1))
+        self.last = keys[-1]
+        return fires
+
+
+class Overload(Rule):
+    '''fires when the display goes to OL or ?, decoded as NaN'''
+    def __init__(self, channel, name=None, action=None):
+        self.channel = channel
+        Rule.__init__(self, name or channel.lower() + " overload", action)
+
+    def Reset(self):
+        self.last = False
+
+    def Evaluate(self, t, columns):
+        overload = np.isnan(columns["value" + self.channel])
+        fires = np.flatnonzero(overload & ~Previous(overload, self.last))
+        self.last = bool(overload[-1])
+        return fires
+
+
+class StateFlag(Rule):
+    '''fires when a state flag (StateNames) is set (to True), cleared (False) or either
+    (None)'''
+    def __init__(self, flag, to=None, name=None, action=None):
+        self.flag = flag
+        self.bit = StateNames.index(flag)
+        self.to = to
+        Rule.__init__(self, name or "{} {}".format(flag.lower(), {True:"on", False:"off", None:"toggle"}[to]), action)
+
+    def Reset(self):
+        self.last = None
+
+    def Evaluate(self, t, columns):
+        flag = (columns["state"] >> self.bit) & 1
+        fires = flag != Previous(flag, self.last)
+        if self.to is not None:
+            fires &= flag == int(self.to)
+        self.last = flag[-1]
+        return np.flatnonzero(fires)
+
+
+def ParseRule(text):
+    '''a Rule from its text form (see above). Raises ValueError'''
+    rule, action = text, None
+    if "=>" in text:
+        rule, action = text.split("=>", 1)
+        action = action.strip().lower()
+        if action not in ("start", "stop"):
+            raise ValueError("unknown trigger action: " + text)
+    words = rule.lower().split()
+    name = " ".join(words)
+    try:
+        if words[0] in Channels:
+            channel, verb, args = Channels[words[0]], words[1], words[2:]
+            if verb in (">", "<") and len(args) in (1, 3):
+                hysteresis = 0.0
+                if len(args) == 3:
+                    if args[1] != "hyst":
+                        raise ValueError
+                    hysteresis = float(args[2])
+                return Threshold(channel, float(args[0]), verb == ">", hysteresis, name, action)
+            if verb == "settle" and len(args) == 2:
+                return Settle(channel, float(args[0]), float(args[1]), name, action)
+            if verb == "change" and not args:
+                return Change(channel, name, action)
+            if verb == "overload" and not args:
+                return Overload(channel, name, action)
+        elif words[0] in FlagNames and len(words) == 2:
+            to = {"on":True, "off":False, "toggle":None}[words[1]]
+            return StateFlag(FlagNames[words[0]], to, name, action)
+    except (IndexError, KeyError, ValueError):
+        pass
+    raise ValueError("unknown trigger rule: " + text)
+
+def ParseRules(texts):
+    return [ParseRule(text) for text in texts]
+
+
+#====================================================================================
+# Events and recordings
+#====================================================================================
+class Recorder:
+    '''
+    ====================================================================================
+    Recorder: one CSV file in the ExportJob format per recording, base_001.csv,
+    base_002.csv, ... Existing files are skipped, not overwritten
+    ====================================================================================
+    '''
+    def __init__(self, base):
+        self.base = base
+        self.number = 0
+        self.file = None
+        self.fileName = None
+        self.recording = False
+
+    def Start(self, columns):
+        self.Stop()
+        self.number += 1
+        while os.path.exists("{}_{:03d}.csv".format(self.base, self.number)):
+            self.number += 1
+        self.fileName = "{}_{:03d}.csv".format(self.base, self.number)
+        self.file = open(self.fileName, "w", encoding="latin1")
+        self.headerWritten = False
+        self.recording = True
+        self.Write(columns)
+
+    def Write(self, columns):
+        if not self.recording or len(columns["timecode"]) == 0:
+            return
+        if not self.headerWritten:
+            self.file.write(CSVHeader(columns))
+            self.headerWritten = True
+        self.file.write(CSVRows(columns))
+        self.file.flush()
+
+    def Stop(self):
+        if self.recording:
+            self.file.close()
+            self.file = None
+            self.recording = False
+
+
+class TriggerEngine:
+    '''
+    ====================================================================================
+    TriggerEngine: runs the rules over batches of SampleColumns, fills in the
+    events' pre and post windows and drives the recorder. Events wait for their
+    post samples at most as long as post samples take to arrive, so memory stays
+    bounded. One caller at a time, e.g. a TriggerSink
+    ====================================================================================
+    '''
+    def __init__(self, rules, pre=PreSamples, post=PostSamples, recordBase=None, onEvent=None, maxEvents=MaxEvents):
+        self.rules = list(rules)
+        self.pre = pre
+        self.post = post
+        self.recorder = Recorder(recordBase) if recordBase else None
+        self.onEvent = onEvent
+        self.events = deque(maxlen=maxEvents)
+        self.pending = deque() #[event, post parts, samples still needed]
+        self.Reset()
+
+    def Reset(self):
+        '''starts over, e.g. for a new stream'''
+        for rule in self.rules:
+            rule.Reset()
+        self.timeline = Timeline()
+        self.tail = None #the last pre samples, the pre window of the next batch's events
+        self.count = 0
+        self.fired = 0
+        self.pending.clear()
+
+    def Process(self, columns):
+        n = len(columns["timecode"])
+        if n == 0:
+            return
+        t = self.timeline.Times(columns["timecode"])
+        fires = sorted((i, order) for order, rule in enumerate(self.rules) for i in rule.Evaluate(t, columns).tolist())
+
+        records = Records(columns)
+        raw = Raw(records)
+        self.dtype = records.dtype
+
+        #earlier events are completed first, from the start of this batch
+        while self.pending and self.pending[0][2] <= n:
+            event, parts, need = self.pending.popleft()
+            self.Complete(event, parts + [raw[:need]])
+        for entry in self.pending:
+            entry[1].append(raw)
+            entry[2] -= n
+
+        window = raw if self.tail is None else np.concatenate((self.tail, raw))
+        offset = len(window) - n
+        position = 0 #first sample of this batch not yet recorded
+        for i, order in fires:
+            rule = self.rules[order]
+            k = offset + i
+            event = {"rule":rule.name, "action":rule.action, "sample":self.count + i,
+                     "timecode":int(columns["timecode"][i]), "pctimestamp":float(columns["pctimestamp"][i]) if "pctimestamp" in columns else math.nan,
+                     "channel":rule.channel, "value":float(columns["value" + rule.channel][i]) if rule.channel else math.nan,
+                     "file":None, "pre":window[max(k - self.pre, 0):k].copy()}
+            recorder = self.recorder
+            if recorder is not None and rule.action == "start" and not recorder.recording:
+                recorder.Start(event["pre"].view(self.dtype))
+                event["file"] = recorder.fileName
+                position = i
+            elif recorder is not None and rule.action == "stop" and recorder.recording:
+                recorder.Write(records[position:i + 1])
+                recorder.Stop()
+            post = raw[i:i + self.post + 1]
+            need = self.post + 1 - (n - i)
+            if need > 0:
+                self.pending.append([event, [post], need])
+            else:
+                self.Complete(event, [post])
+        if self.recorder is not None and self.recorder.recording:
+            self.recorder.Write(records[position:])
+
+        self.tail = window[max(len(window) - self.pre, 0):].copy()
+        self.count += n
+
+    def Complete(self, event, parts):
+        event["pre"] = event["pre"].view(self.dtype)
+        event["post"] = np.concatenate(parts).view(self.dtype)
+        self.events.append(event)
+        self.fired += 1
+        if self.onEvent is not None:
+            self.onEvent(event)
+
+    def Close(self):
+        '''ends the recording and completes the pending events with what arrived'''
+        while self.pending:
+            event, parts, need = self.pending.popleft()
+            self.Complete(event, parts)
+        if self.recorder is not None:
+            self.recorder.Stop()
+
+
+def FormatEvent(event):
+    line = "trigger '{}' at {} ms: {:.6g}".format(event["rule"], event["timecode"], event["value"])
+    if event["file"]:
+        line += ", recording to " + event["file"]
+    elif event["action"]:
+        line += ", " + event["action"]
+    return line + "\n"
+
+def PrintEvent(event):
+    print(FormatEvent(event), end='')
+
+
+class TriggerSink(Sink):
+    '''runs a TriggerEngine on every sample, losslessly'''
+    def __init__(self, engine, period=HistoryPeriod):
+        Sink.__init__(self, "trigger", period, None)
+        self.engine = engine
+
+    def Write(self, batch):
+        self.engine.Process(batch.Columns())
+
+    def Close(self):
+        self.engine.Close()
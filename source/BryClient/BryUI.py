@@ -0,0 +1,503 @@
+'''
+====================================================
+BryUI: PyQtGraph user interface of the PyBry client
+====================================================
+
+Qt and pyqtgraph are only loaded with this module, PyBry itself imports without
+them. Run PyBry.py or BryUI.py [port ...]
+'''
+
+import os
+import sys
+import time
+
+#for graphing
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtCore, QtGui
+from PyQt5.QtWidgets import QFileDialog
+from pyqtgraph.dockarea import *
+from datetime import timedelta
+
+import PyBry
+import BryLayout
+import BryLoader
+from PyBry import Connection, SampleHistory
+from BryMetrics import metrics
+
+
+PORTNAME = 'Com9'
+LinkAxes = False
+StatsScope = '60s' #window of the statistics under the value labels, one of BryStats.StatsWindows or 'session'
+
+
+class TimeAxisItem(pg.AxisItem):
+    XAxisTime = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def tickStrings(self, values, scale, spacing):
+        #print("*")
+        if self.XAxisTime:
+            #return [time.strftime("%H:%M:%S", time.localtime(max(value,0))) for value in values]
+            return [str(timedelta(milliseconds=value)) for value in values]
+            
+        return super().tickStrings(values, scale, spacing)
+
+
+class BrymenUI:
+    '''
+    '''
+    def __init__(self, history=None):
+        self.history = history if history is not None else SampleHistory()
+        self.liveHistory = self.history #the connection's, self.history is an opened file's while one is shown
+        self.lastFileName = ''
+        self.exportJob = None
+        self.loadJob = None
+        self.fileTitle = None
+        #what is currently shown, so updates can be skipped when nothing changed
+        self.labelsVersion = None
+        self.curveStates = {}
+        self.plotLabels = {}
+
+    def ToggleXAxis(self):
+        TimeAxisItem.XAxisTime = not TimeAxisItem.XAxisTime
+        ##TOOD: force update in case data is invisible
+        
+
+    def UpdateValueLabels(self):
+        version = self.history.GetVersion()
+        if version == self.labelsVersion:
+            return
+        self.labelsVersion = version
+
+        timing = metrics.enabled
+        if timing:
+            t = time.perf_counter()
+        sample = self.history.GetLatestSample()
+        if sample is not None:
+            textUp   = sample["measureUpper"]["text"] + sample["measureUpper"]["unitOrg"]
+            textMain = sample["measureLower"]["text"] + sample["measureLower"]["unitOrg"]
+            if textUp != self.labelUp.text():
+                self.labelUp.setText(textUp)
+                self.labelUp.repaint()
+            if textMain != self.labelMain.text():
+                self.labelMain.setText(textMain)
+                self.labelMain.repaint()
+            stats = self.history.GetStats()
+            self.statsUp.setText(self.FormatStats(stats["upper"]))
+            self.statsMain.setText(self.FormatStats(stats["lower"]))
+            if timing and sample["pctimestamp"] == sample["pctimestamp"]: #not nan, replayed samples may have no host time
+                metrics.Record("sampleToLabel", time.time() - sample["pctimestamp"])
+        if timing:
+            metrics.Lap("UpdateValueLabels", t)
+    
+
+    def FormatStats(self, channel):
+        s = channel["scopes"][StatsScope]
+        if s["count"] == 0:
+            return ""
+        unit = channel["unit"]
+        return "mean {}  std {}\nmin {}  max {}\ntrend {}/s  ({}, n={})".format(
+            pg.siFormat(s["mean"], suffix=unit), pg.siFormat(s["std"], suffix=unit) if s["count"] > 1 else "-",
+            pg.siFormat(s["min"], suffix=unit), pg.siFormat(s["max"], suffix=unit),
+            pg.siFormat(s["slope"], suffix=unit) if s["slope"] == s["slope"] else "-", StatsScope, s["count"])
+
+    def InitStatsLabels(self, layout, font):
+        '''adds statistics labels under the value labels in rows 1 and 3 of a layout'''
+        self.statsUp   = QtGui.QLabel("")
+        self.statsMain = QtGui.QLabel("")
+        for label, row in [(self.statsUp, 1), (self.statsMain, 3)]:
+            label.setFont(font)
+            layout.addWidget(label, row=row, col=0)
+
+    def UpdateCurve(self, plot, curve, channel):
+        '''fetches only the visible part of a channel at the level of detail matching the
+        plot's pixel width. Does nothing if neither the data nor the view changed'''
+        viewBox = plot.getViewBox()
+        x0 = x1 = None
+        pixels = max(int(viewBox.width()), 1)
+        if not viewBox.autoRangeEnabled()[0]:
+            #fetch a view width on both sides so panning doesn't show gaps until the next update
+            x0, x1 = viewBox.viewRange()[0]
+            width = x1 - x0
+            x0, x1 = x0 - width, x1 + width
+            pixels *= 3
+
+        state = (self.history.GetVersion(), TimeAxisItem.XAxisTime, x0, x1, pixels)
+        if self.curveStates.get(channel) == state:
+            return
+        self.curveStates[channel] = state
+
+        x, y = self.history.GetPlotData(channel, x0, x1, pixels, TimeAxisItem.XAxisTime)
+        curve.setData(x=x, y=y)
+
+    def UpdateGraph(self):
+        if metrics.enabled:
+            t = time.perf_counter()
+            self.DrawGraph()
+            metrics.Lap("UpdateGraph", t)
+        else:
+            self.DrawGraph()
+
+    def DrawGraph(self):
+        self.UpdateCurve(self.plL, self.curveL, "valueLower")
+        self.UpdateCurve(self.plU, self.curveU, "valueUpper")
+
+        labels = self.history.GetLabels()
+        for plot, display in [(self.plL, "lower"), (self.plU, "upper")]:
+            if labels[display] != self.plotLabels.get(display):
+                self.plotLabels[display] = labels[display]
+                label = labels[display]["source"]
+                unit =  labels[display]["unit"]
+                plot.getAxis('left').setLabel(label, unit)
+                plot.setTitle(label)
+       
+    def PickFile(self):
+        if self.exportJob is not None:
+            return
+        options = QFileDialog.Options()
+        #options |= QFileDialog.DontUseNativeDialog
+        fileName, _ = QFileDialog.getSaveFileName(None, "Save output CSV file", self.lastFileName, "All Files (*);;Comma Separated Values (*.csv);;NumPy (*.npy *.npz)", options=options)
+        #fileName = "d:/temp/aa.csv"
+        if not fileName:
+            return
+        self.lastFileName = fileName
+
+        #the export runs in the background, Update polls its progress
+        self.exportJob = self.history.StartExport(self.lastFileName)
+        self.exportDialog = QtGui.QProgressDialog("Saving " + self.lastFileName, "Cancel", 0, 100)
+        self.exportDialog.canceled.connect(self.exportJob.Cancel)
+        self.exportDialog.show()
+
+    def UpdateExport(self):
+        job = self.exportJob
+        if job is None:
+            return
+        self.exportDialog.setValue(int(job.progress * 100))
+        if job.done:
+            self.exportJob = None
+            self.exportDialog.reset()
+            if job.error is not None:
+                msg = QtGui.QMessageBox(QtGui.QMessageBox.Critical, "Save Failed", str(job.error), buttons=QtGui.QMessageBox.Ok)
+                msg.exec_();
+
+    def PickOpenFile(self):
+        options = QFileDialog.Options()
+        fileName, _ = QFileDialog.getOpenFileName(None, "Open capture or export", self.lastFileName,
+                                                  "Captures and exports (*.csv *.npy *.npz *.bryj *.brya *.bin *.txt);;All Files (*)", options=options)
+        if not fileName:
+            return
+        self.lastFileName = fileName
+        try:
+            job = BryLoader.LoadJob(fileName)
+        except (OSError, ValueError, KeyError) as ex:
+            msg = QtGui.QMessageBox(QtGui.QMessageBox.Critical, "Open Failed", str(ex), buttons=QtGui.QMessageBox.Ok)
+            msg.exec_();
+            return
+        #the plots show the file while it loads (see BryLoader)
+        self.ShowHistory(job.history, os.path.basename(fileName))
+        self.loadJob = job
+        job.Start()
+
+    def ShowHistory(self, history, title=None):
+        '''shows another history, closing the file shown before'''
+        if history is not self.history:
+            self.CloseFile()
+        self.history = history
+        self.fileTitle = title
+        self.labelsVersion = None
+        self.curveStates = {}
+        self.plotLabels = {}
+        win.setWindowTitle('PyBry' if title is None else 'PyBry - ' + title)
+
+    def CloseFile(self):
+        '''stops loading the shown file and frees its history (and spill files)'''
+        if self.loadJob is not None:
+            self.loadJob.Cancel()
+            self.loadJob.Wait()
+            self.loadJob = None
+        if self.history is not self.liveHistory:
+            self.history.clearSampleHistory()
+
+    def StartLive(self, conn, portTxt, modelBox):
+        self.ShowHistory(self.liveHistory)
+        conn.SetModel(modelBox.currentText())
+        conn.Start(portTxt)
+
+    def ModelBox(self, model):
+        '''a drop-down of the meter models, model selected'''
+        modelBox = QtGui.QComboBox()
+        modelBox.addItems(list(BryLayout.Models))
+        modelBox.setCurrentText(model)
+        return modelBox
+
+    def UpdateLoad(self):
+        job = self.loadJob
+        if job is None:
+            return
+        if not job.done:
+            win.setWindowTitle('PyBry - {} (loading {}%)'.format(self.fileTitle, int(job.progress * 100)))
+            return
+        self.loadJob = None
+        win.setWindowTitle('PyBry - {} ({} samples)'.format(self.fileTitle, job.loaded))
+        if job.error is not None:
+            msg = QtGui.QMessageBox(QtGui.QMessageBox.Critical, "Open Failed", str(job.error), buttons=QtGui.QMessageBox.Ok)
+            msg.exec_();
+
+
+    def InitGraph(self, conn, portName=PORTNAME):
+        '''the window of a single meter, its port field filled with portName'''
+        global win
+        global app
+        #global history
+
+        #create the window
+        #win = pg.GraphicsWindow()
+        app = QtGui.QApplication([])
+        win = QtGui.QMainWindow()
+        win.setWindowTitle('PyBry')
+
+        #create the docking area
+        area = DockArea()
+        win.setCentralWidget(area)
+        win.resize(1000,500)
+
+        #create docks
+        dDis = Dock("Display", size=(100,100))
+        dSet = Dock("Settings", size=(50,1))
+        dGr1 = Dock("Upper Display", size=(900,250))
+        dGr2 = Dock("Main Display", size=(900,250))
+
+        #place the docks in the area
+        area.addDock(dDis, 'left')
+        area.addDock(dSet, 'bottom', dDis)
+        area.addDock(dGr1, 'right')
+        area.addDock(dGr2, 'bottom', dGr1) #share the bottom edge of d1
+
+        #Display Widget
+        font1=QtGui.QFont("SansSerif", 16, QtGui.QFont.Bold)     
+        font2=QtGui.QFont("SansSerif", 20, QtGui.QFont.Bold)     
+        self.labelUp   = QtGui.QLabel("0.000V")
+        self.labelMain = QtGui.QLabel("0.00000V")
+        self.labelUp.setFont(font1)
+        self.labelMain.setFont(font2)
+        wL1 = pg.LayoutWidget()
+        wL1.addWidget(self.labelUp, row=0, col=0)
+        wL1.addWidget(self.labelMain, row=2, col=0)
+        self.InitStatsLabels(wL1, QtGui.QFont("SansSerif", 9))
+        dDis.addWidget(wL1)
+        
+        #setting widgets
+        wL2 = pg.LayoutWidget()
+        clearBt = QtGui.QPushButton('Clear History')
+        saveBt  = QtGui.QPushButton('Save to CSV')
+        openBt  = QtGui.QPushButton('Open...')
+        xAxisBt = QtGui.QPushButton('Toggle X Axis')
+
+        portTxt = QtGui.QLineEdit(portName)
+        modelBox = self.ModelBox(conn.model)
+        startBt = QtGui.QPushButton('Start')
+        stopBt  = QtGui.QPushButton('Stop')
+        setPerBt= QtGui.QPushButton('Set Period')
+        perTxt = QtGui.QLineEdit('200')
+
+        #saveBt.setEnabled(False)
+
+        wL2.addWidget(clearBt, row=0, col=0)
+        wL2.addWidget(saveBt,row=1, col=0)
+        wL2.addWidget(openBt,row=1, col=1)
+        wL2.addWidget(xAxisBt,row=2, col=0)
+        wL2.addWidget(portTxt, row=3, col=0)
+        wL2.addWidget(modelBox, row=3, col=1)
+        wL2.addWidget(startBt,row=4, col=0)
+        wL2.addWidget(stopBt,row=5, col=0)
+        wL2.addWidget(setPerBt,row=6, col=0)
+        wL2.addWidget(perTxt,row=6, col=1)
+
+        clearBt.clicked.connect(lambda: self.history.clearSampleHistory())
+        saveBt.clicked.connect(self.PickFile)
+        openBt.clicked.connect(self.PickOpenFile)
+        xAxisBt.clicked.connect(self.ToggleXAxis)
+        startBt.clicked.connect(lambda: self.StartLive(conn, portTxt, modelBox))
+        stopBt.clicked.connect(conn.Stop)
+        setPerBt.clicked.connect(lambda: conn.SetPeriod(perTxt))
+
+        dSet.addWidget(wL2)
+
+        #graph widgets
+        wgU, wgL = self.InitPlots()
+
+        #place graph widgets in the docks
+        dGr1.addWidget(wgU)
+        dGr2.addWidget(wgL)
+        win.show()
+
+    def InitPlots(self):
+        '''creates the upper and lower display graphs and returns their widgets'''
+        wgU = pg.PlotWidget(axisItems={'bottom': TimeAxisItem(orientation='bottom')})
+        wgL = pg.PlotWidget(axisItems={'bottom': TimeAxisItem(orientation='bottom')})
+        #wgU = pg.PlotWidget()
+        #wgL = pg.PlotWidget()
+
+        self.plU = wgU.getPlotItem()
+        self.plL = wgL.getPlotItem()
+
+        self.plU.getAxis('left').setGrid(128)
+        self.plU.getAxis('left').enableAutoSIPrefix(True)
+        self.plU.getAxis('bottom').setGrid(128)
+        self.curveU = self.plU.plot()
+
+        self.plL.getAxis('left').setGrid(128)
+        self.plL.getAxis('left').enableAutoSIPrefix(True)
+        self.plL.getAxis('bottom').setGrid(128)
+        self.curveL = self.plL.plot()
+
+        #link the x axis
+        if LinkAxes:
+            self.plL.setXLink(self.plU)
+            self.plU.setXLink(self.plL)
+        return wgU, wgL
+
+    def InitMeterDock(self, name):
+        '''creates a compact dock for one meter of a MeterManager with its value labels
+        and both graphs, and returns it'''
+        dock = Dock(name, size=(900,200))
+        self.labelUp   = QtGui.QLabel("0.000V")
+        self.labelMain = QtGui.QLabel("0.00000V")
+        self.labelUp.setFont(QtGui.QFont("SansSerif", 12, QtGui.QFont.Bold))
+        self.labelMain.setFont(QtGui.QFont("SansSerif", 16, QtGui.QFont.Bold))
+        wgU, wgL = self.InitPlots()
+
+        layout = pg.LayoutWidget()
+        layout.addWidget(self.labelUp, row=0, col=0)
+        layout.addWidget(self.labelMain, row=2, col=0)
+        self.InitStatsLabels(layout, QtGui.QFont("SansSerif", 8))
+        layout.addWidget(wgU, row=0, col=1, rowspan=2)
+        layout.addWidget(wgL, row=2, col=1, rowspan=2)
+        dock.addWidget(layout)
+        return dock
+
+    def Update(self):
+        self.UpdateValueLabels()
+        self.UpdateGraph()
+        self.UpdateExport()
+        self.UpdateLoad()
+
+
+class MultiMeterUI(BrymenUI):
+    '''
+    ====================================================================================
+    MultiMeterUI: one window for all meters of a MeterManager (see BryMulti), with a
+    dock per meter and common controls. Save writes the combined export
+    ====================================================================================
+    '''
+    def __init__(self, manager):
+        BrymenUI.__init__(self, manager)
+        self.manager = manager
+        self.panels = [BrymenUI(conn.history) for conn in manager.connections]
+
+    def InitGraph(self):
+        global win
+        global app
+
+        app = QtGui.QApplication([])
+        win = QtGui.QMainWindow()
+        win.setWindowTitle('PyBry - {} meters'.format(len(self.panels)))
+        area = DockArea()
+        win.setCentralWidget(area)
+        win.resize(1200,200 * len(self.panels))
+
+        #common controls
+        dSet = Dock("Settings", size=(50,1))
+        area.addDock(dSet, 'left')
+        wL = pg.LayoutWidget()
+        clearBt = QtGui.QPushButton('Clear History')
+        saveBt  = QtGui.QPushButton('Save Combined')
+        xAxisBt = QtGui.QPushButton('Toggle X Axis')
+        startBt = QtGui.QPushButton('Start All')
+        stopBt  = QtGui.QPushButton('Stop All')
+        setPerBt= QtGui.QPushButton('Set Period')
+        perTxt = QtGui.QLineEdit('200')
+        modelBox = self.ModelBox(self.manager.connections[0].model if self.manager.connections else PyBry.MeterModel)
+        for row, widget in enumerate([clearBt, saveBt, xAxisBt, startBt, stopBt, setPerBt]):
+            wL.addWidget(widget, row=row, col=0)
+        wL.addWidget(modelBox, row=3, col=1)
+        wL.addWidget(perTxt, row=5, col=1)
+
+        clearBt.clicked.connect(self.manager.clearSampleHistory)
+        saveBt.clicked.connect(self.PickFile)
+        xAxisBt.clicked.connect(self.ToggleXAxis)
+        startBt.clicked.connect(lambda: self.StartAll(modelBox))
+        stopBt.clicked.connect(self.manager.Stop)
+        setPerBt.clicked.connect(lambda: self.manager.SetPeriod(perTxt.text()))
+        dSet.addWidget(wL)
+
+        #a dock per meter, stacked on the right
+        previous = None
+        for panel, conn in zip(self.panels, self.manager.connections):
+            dock = panel.InitMeterDock(conn.portName)
+            if previous is None:
+                area.addDock(dock, 'right')
+            else:
+                area.addDock(dock, 'bottom', previous)
+            previous = dock
+        win.show()
+
+    def StartAll(self, modelBox):
+        self.manager.SetModel(modelBox.currentText())
+        self.manager.Start()
+
+    def Update(self):
+        for panel in self.panels:
+            panel.UpdateValueLabels()
+            panel.UpdateGraph()
+        self.UpdateExport()
+
+
+def Main():
+    global bryui, timer #kept alive for interactive sessions
+
+    #PyBry.py [port ...]: one port fills the port field, several open them all at once
+    #in one window
+    ports = sys.argv[1:]
+    if len(ports) > 1:
+        from BryMulti import MeterManager
+        manager = MeterManager(ports)
+        bryui = MultiMeterUI(manager)
+        bryui.InitGraph()
+    else:
+        if PyBry.AcquisitionProcess:
+            from BryProcess import ProcessConnection
+            conn = ProcessConnection()
+        else:
+            conn = Connection()
+        bryui = BrymenUI(conn.history)
+
+        #init graph
+        bryui.InitGraph(conn, ports[0] if ports else PORTNAME)
+
+    if PyBry.MetricsOn:
+        metrics.Enable()
+        metrics.StartDumping(PyBry.MetricsDumpPeriod)
+
+    #setup update timer as gui updates need to done via the main thread
+    timer = QtCore.QTimer()
+    timer.timeout.connect(bryui.Update)
+    timer.start(50)
+
+    #run the background sampling thread 
+    #conn.Start()
+
+    #run the application
+    if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
+        QtGui.QApplication.instance().exec_()
+    if len(ports) > 1:
+        manager.Close()
+    else:
+        bryui.CloseFile()
+        conn.Close()
+
+
+if __name__ == "__main__":
+    Main()
@@ -13,44 +13,92 @@ sample
     measureLower
 '''
 
-#for Brymen connection
-import serial #pyserial
+#for Brymen connection. pyserial is imported when a port is opened, the GUI lives in
+#BryUI, so the decoder, framer and history layers load without serial or Qt
+import math
+import os
 import time
 import threading
+from collections import OrderedDict
+from types import MappingProxyType
 import numpy as np
-
-
-#for graphing
-import pyqtgraph as pg
-from pyqtgraph.Qt import QtCore, QtGui
-from PyQt5.QtWidgets import QFileDialog
-from pyqtgraph.dockarea import *
-from datetime import timedelta
+from BryJournal import JournalWriter
+from BryMetrics import metrics, TimedLock
+from BryStats import RollingStats
+import BryLayout
 
 
 #Some constants
-PORTNAME            = 'Com9'
 Nread               = 24
 WatchdogResetPeriod = 60 #seconds
+ReadTimeout         = 0.5 #seconds a serial read waits for data
 DebugOn             = True
-LinkAxes            = False
+HistoryCapacity     = 1000000 #samples (~71 bytes each)
+HistorySpillDir     = None #directory where histories spill old samples to disk (see BrySegments), None keeps them in a RAM ring
+PyramidFactor       = 8 #samples per graph level-of-detail bucket, and buckets per bucket of the next level
+FramerBufferSize    = 4096 #bytes, serial reads per loop are capped to this
+ReadRetries         = 3 #lock-free history read attempts before falling back to the lock
+StatsBatch          = 256 #samples added one by one that SampleHistory merges into its statistics at once
+ExportChunkRows     = 65536 #rows formatted and written at once by ExportJob
+DecodeCacheSize     = 1024 #distinct packet payloads BrymenDecoder.DecodePacket keeps decoded
+MeterModel          = "BM869" #bit layout of the meter's frames, a name of BryLayout.Models
+JournalBase         = None #path prefix of the raw packet journal (see BryJournal), None to disable
+MetricsOn           = False #per-stage latency histograms and counters (see BryMetrics)
+MetricsDumpPeriod   = 60 #seconds between metric reports on stderr while MetricsOn
+ServerAddress       = None #"host:port" or "unix:/path" to stream samples to local subscribers (see BryServer), None to disable
+AcquisitionProcess  = False #read, frame and decode in a child process, away from the GUI's GIL (see BryProcess)
+LogFile             = None #path of a text log of every sample (see BrySinks.LogSink), None to disable
+ExportFile          = None #path of a CSV the samples are appended to as they arrive (see BrySinks.ExportSink), None to disable
+Triggers            = None #trigger rules, e.g. ["lower > 5 => start", "lower < 1 => stop"] (see BryTrigger), None to disable
+TriggerRecordBase   = "trigger" #path prefix of the recordings trigger rules start
+AdaptivePeriod      = None #(fastest, slowest) sample period in ms, chosen from the decoded stream (see BryAdaptive), None keeps the one set by hand
+PeriodLogFile       = None #path of the log of the period changes AdaptivePeriod makes, None keeps them in memory only
 
 
 #====================================================================================
 # Connection
 #====================================================================================
 class Connection:
-    def __init__(self):
+    def __init__(self, journalBase=JournalBase, history=None, clock=time.time, serverAddress=ServerAddress, sinks=None, model=None):
         self.portName = ''
+        self.journalBase = journalBase
+        #the meter model whose bit layout the decoders use, MeterModel by default
+        self.model = model if model is not None else MeterModel
+        #where samples are recorded and the host clock stamping them. Meters of a
+        #MeterManager each have a history and share one clock
+        self.history = history if history is not None else SampleHistory(model=self.model)
+        self.clock = clock
+        self.journal = None
+        self.framer = None
         self.ser = None
         self.doRun = False
         self.killThread = False
         self.threadRunning = False
         self.runEvent = threading.Event()
+        self.writeLock = threading.Lock()
+        self.watchdogTimer = None
+        self.server = None
+        if serverAddress:
+            from BryServer import SampleServer
+            self.server = SampleServer(serverAddress).Start()
+        #where packets go after the journal: the history, the console, the log file, the
+        #server and the triggers, each in its own thread (see BrySinks). A given pipeline
+        #replaces all of them and needs its own HistorySink
+        if sinks is None:
+            import BrySinks
+            sinks = BrySinks.DefaultPipeline(self.history, self.server, model=self.model)
+        self.sinks = sinks
+        #the sample period follows the stream within AdaptivePeriod (see BryAdaptive)
+        self.periodController = None
+        if AdaptivePeriod:
+            import BryAdaptive
+            self.periodController = BryAdaptive.AddController(self, AdaptivePeriod)
 
     def Start(self, portTxtControl):
+        '''port name, or a text control holding it'''
+        portName = portTxtControl.text() if hasattr(portTxtControl, "text") else portTxtControl
         #stop the thread and disconnect if another port is requested
-        if portTxtControl.text() != self.portName:
+        if portName != self.portName:
             self.killThread = True
             self.runEvent.set()
             while(self.threadRunning):
@@ -58,7 +106,7 @@ class Connection:
             self.runEvent.clear()
             
         if not self.threadRunning:
-            self.portName = portTxtControl.text()
+            self.portName = portName
             self.killThread = False
             thread = threading.Thread(target = self.OpenAndSample)
             thread.start()
@@ -68,44 +116,124 @@ class Connection:
         
     def Stop(self):
         if self.ser!=None and self.ser.is_open:
-            self.ser.write("[Stop]".encode())
-            self.ser.flushOutput()
+            self.StopWatchdog()
+            self.SendCommand("[Stop]")
             time.sleep(0.1)
             self.ser.flushInput()
             self.runEvent.clear()
 
+    def SetModel(self, model):
+        '''switches the sinks and the history to another meter model (a name of
+        BryLayout.Models). The history decodes the samples it already has with it too'''
+        BryLayout.GetModel(model)
+        if model != self.model:
+            self.model = model
+            self.sinks.SetModel(model)
+            self.history.SetModel(model)
+
+    def Close(self):
+        '''ends the sample thread and closes the sinks (log file, trigger recorder, period
+        log) and the server. The connection can't be started again'''
+        self.killThread = True
+        self.runEvent.set()
+        while(self.threadRunning):
+            time.sleep(0.01)
+        self.sinks.Close()
+        if self.server is not None:
+            self.server.Close()
+            self.server = None
+
     def SetPeriod(self, periodTxtControl):
+        '''period in ms, or a text control holding it'''
+        period = periodTxtControl.text() if hasattr(periodTxtControl, "text") else periodTxtControl
         if self.ser!=None and self.ser.is_open:
-            cmd="[Per={}]".format(periodTxtControl.text())
-            self.ser.write(cmd.encode())
-            self.ser.flushOutput()
+            self.SendCommand("[Per={}]".format(period))
             time.sleep(0.1)
             self.ser.flushInput()
+            if self.periodController is not None:
+                self.periodController.Manual(period)
+
+    def ApplyPeriod(self, period):
+        '''sets the period in ms without SetPeriod's input flush, which would drop the
+        samples queued meanwhile. For the period controller, tells if the port was open'''
+        if self.ser!=None and self.ser.is_open:
+            self.SendCommand("[Per={}]".format(period))
+            return True
+        return False
+
+    def SendCommand(self, cmd):
+        '''writes a command to the Arduino. Commands come from the UI, the watchdog timer
+        and the sampling thread, so writes are serialized'''
+        with self.writeLock:
+            self.ser.write(cmd.encode())
+            self.ser.flush() #wait until sent, flushOutput would discard it
 
 
     def ResetWatchdog(self):
-        self.ser.write("[Rst]".encode())
-        self.nextWatchdogReset = time.time() + WatchdogResetPeriod
+        self.SendCommand("[Rst]")
         if DebugOn:    
             print("*********Watchdog Reset**********")
 
+    def StartWatchdog(self):
+        '''resets the Arduino watchdog now and then every WatchdogResetPeriod from a timer'''
+        self.StopWatchdog()
+        self.ResetWatchdog()
+        self.watchdogTimer = threading.Timer(WatchdogResetPeriod, self.StartWatchdog)
+        self.watchdogTimer.daemon = True
+        self.watchdogTimer.start()
+
+    def StopWatchdog(self):
+        '''no resets while stopped, [Rst] would restart the sampling'''
+        if self.watchdogTimer is not None:
+            self.watchdogTimer.cancel()
+            self.watchdogTimer = None
+
+    def OpenPort(self):
+        '''opens the serial port. Replace it to sample from another port object, e.g. a
+        BryEmulator.LoopPort'''
+        import serial #pyserial
+        return serial.Serial(self.portName, timeout=ReadTimeout)
+
     def OpenAndSample(self):
+        import serial #pyserial
+
         self.threadRunning = True
+        self.sinks.Start()
         try:
-            with serial.Serial(self.portName) as self.ser:
+            with self.OpenPort() as self.ser:
+                if self.journalBase:
+                    self.journal = JournalWriter(self.journalBase)
                 self.SampleLoop()
         except serial.SerialException as e:
             print("Serial port Exception " + self.portName)
         finally:
+            self.StopWatchdog()
+            self.sinks.Stop()
+            if self.journal is not None:
+                self.journal.Close()
+                self.journal = None
             self.threadRunning = False
 
+    def ProcessPacket(self, inbytes, pctimestamp):
+        '''journals one validated packet and queues it for the sinks, which decode, print
+        and record it in their own threads'''
+        timing = metrics.enabled
+        if timing:
+            t = time.perf_counter()
+        if self.journal is not None:
+            self.journal.Append(inbytes, pctimestamp)
+            if timing:
+                t = metrics.Lap("journal", t)
+        self.sinks.Publish(inbytes, pctimestamp)
+        if timing:
+            metrics.Lap("enqueue", t)
+
     def SampleLoop(self):
-        global history
 
         #make sure DMM is not sending while we start so that we don't start packets in the midle.
         # turns out this is unnecessary as Arduino uno resets on serial connection
         self.ser.write("[Stop]".encode())
-        self.ser.flushOutput()
+        self.ser.flush()
         time.sleep(0.1)
         
         #flush the input buffer
@@ -114,125 +242,866 @@ class Connection:
             self.ser.reset_input_buffer()
             time.sleep(0.1)
         
-        self.ResetWatchdog()
+        self.StartWatchdog()
 
-        decoder = BrymenDecoder()
+        framer = PacketFramer()
+        self.framer = framer
 
-        #Main loop: sample and reset watchdog
+        #Main loop: blocks until data arrives (or ReadTimeout) and handles every complete
+        #packet right away. The watchdog is reset from a timer
         while not self.killThread:
-            if self.ser.in_waiting >=Nread:
-                #read the raw bytes
-                inbytes = self.ser.read(Nread)
-
-                #make sure the data is not garbage
-                markerpos = (inbytes+inbytes).find(b'\x86\x86\x86\x86')
-                while(markerpos!=15):
-                    if(markerpos==-1):
-                        hexs = ":".join("{:02x}".format(c) for c in inbytes)
-                        print("invalid data stream:", hexs)
-                        self.ser.reset_input_buffer()
-                    else:
-                        phase = markerpos - 15
-                        if phase<0: phase = Nread+phase
-
-                        nMore = phase
-                        morebytes = self.ser.read(nMore)
-                        inbytes = inbytes[nMore:]  + morebytes
-                    
-                    #now make sure the possibly completed packet is a good one
-                    markerpos = (inbytes+inbytes).find(b'\x86\x86\x86\x86')
-                     
-                #unpack the bits and 7 segment data
-                unpackedData = decoder.UnpackBytes(inbytes)
-            
-                #decode the unpacked data to meaninful states and measurements with units
-                sample = {"inbytes":inbytes, "pctimestamp":time.time()}
-                sample["timecode"], sample["state"], sample["measureUpper"], sample["measureLower"] = decoder.DecodeUnpackedData(unpackedData)
-                #QtGui.QApplication.instance().beep()
-                #record and display
-                decoder.PrintSample(sample, decoder, unpackedData)
-                history.AddSampleToHistory(sample)
-            else:
-                time.sleep(0.05)
-        
-            #if time to reset watchdog, do it
-            if time.time() > self.nextWatchdogReset:
-                self.ResetWatchdog()
+            timing = metrics.enabled
+            if timing:
+                t = time.perf_counter()
+            waiting = self.ser.in_waiting
+            if waiting == 0:
+                #block for the first byte, timed apart from reading what is there
+                framer.ReadFrom(self.ser, 1)
+                if timing:
+                    t = metrics.Lap("serialWait", t)
+                waiting = self.ser.in_waiting
+            if waiting > 0:
+                framer.ReadFrom(self.ser, waiting)
+            if timing:
+                t = metrics.Lap("serialRead", t)
+            skipped, resyncs = framer.bytesSkipped, framer.framesDropped
+            #the samples outlive the framer's buffer, so keep copies of the bytes
+            frames = [bytes(frame) for frame in framer.Frames()]
+            if timing:
+                metrics.Lap("framing", t)
+                metrics.Count("packets", len(frames))
+                metrics.Count("resyncs", framer.framesDropped - resyncs)
+                metrics.Count("bytesSkipped", framer.bytesSkipped - skipped)
+            for frame in frames:
+                self.ProcessPacket(frame, self.clock())
+            if DebugOn and framer.bytesSkipped != skipped:
+                print("invalid data stream: skipped {} bytes".format(framer.bytesSkipped - skipped))
 
             #if run event is cleared, stop the DMM and wait for the signal
             if not self.runEvent.isSet():
                 #stop the DMM
-                self.ser.write("[Stop]".encode())
-                self.ser.flushOutput()
-                #self.ser.reset_input_buffer()
-                time.sleep(0.1)
+                self.StopWatchdog()
+                self.SendCommand("[Stop]")
                 
                 self.runEvent.wait()
 
                 #start the DMM
-                self.ser.write("[Go]".encode())
-                self.ser.flushOutput()
-                #self.ser.reset_input_buffer()
-                time.sleep(0.1)
+                self.SendCommand("[Go]")
+                if not self.killThread:
+                    self.StartWatchdog()
 
                 
 
 
+class PacketFramer:
+    '''
+    ====================================================================================
+    PacketFramer: cuts the serial byte stream into 24-byte packets. Bytes are read into
+    a preallocated buffer and complete packets are returned as memoryviews into it, so
+    nothing is allocated per packet. A packet is valid when the marker sits at offset
+    15. If it doesn't, the framer skips ahead to the next marker in the data it already
+    has instead of flushing the port, so packets already queued are not lost.
+    Frame views are only valid until the next ReadFrom/Feed call
+    ====================================================================================
+    '''
+    marker = b'\x86\x86\x86\x86'
+    markerOffset = 15
+
+    def __init__(self, bufferSize=FramerBufferSize):
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+        self.readPos = 0
+        self.writePos = 0
+        self.frames = 0          #valid packets returned
+        self.bytesSkipped = 0    #garbage bytes thrown away while resynchronizing
+        self.framesDropped = 0   #resynchronizations, each loses at least one damaged packet
+        self.framesRecovered = 0 #valid packets found right after a resynchronization
+        self.resyncing = False
+
+    def Reset(self):
+        '''forgets the buffered bytes, e.g. after the device was restarted'''
+        self.readPos = self.writePos = 0
+        self.resyncing = False
+
+    def Compact(self):
+        '''moves the unprocessed bytes (less than a packet) to the start of the buffer'''
+        if self.readPos > 0:
+            n = self.writePos - self.readPos
+            self.view[0:n] = self.view[self.readPos:self.writePos]
+            self.readPos, self.writePos = 0, n
+
+    def ReadFrom(self, stream, count):
+        '''reads up to count bytes from a stream (e.g. serial.Serial) into the buffer.
+        Returns the number of bytes read'''
+        self.Compact()
+        count = min(count, len(self.buffer) - self.writePos)
+        n = stream.readinto(self.view[self.writePos:self.writePos+count]) or 0
+        self.writePos += n
+        return n
+
+    def Feed(self, data):
+        '''copies bytes from any other source into the buffer. Returns the number of bytes
+        taken, which is less than len(data) if the buffer is full'''
+        self.Compact()
+        n = min(len(data), len(self.buffer) - self.writePos)
+        self.view[self.writePos:self.writePos+n] = data[:n]
+        self.writePos += n
+        return n
+
+    def Frames(self):
+        '''yields the complete packets in the buffer'''
+        while self.writePos - self.readPos >= Nread:
+            markerPos = self.readPos + self.markerOffset
+            if self.buffer.find(self.marker, markerPos, markerPos + len(self.marker)) == markerPos:
+                frame = self.view[self.readPos:self.readPos+Nread]
+                self.readPos += Nread
+                self.frames += 1
+                if self.resyncing:
+                    self.resyncing = False
+                    self.framesRecovered += 1
+                yield frame
+                continue
+
+            #out of sync: jump to the next marker we already have, or keep just enough
+            #bytes to still catch one that is only partly received
+            if not self.resyncing:
+                self.resyncing = True
+                self.framesDropped += 1
+            nextMarker = self.buffer.find(self.marker, markerPos + 1, self.writePos)
+            if nextMarker >= 0:
+                newPos = nextMarker - self.markerOffset
+            else:
+                newPos = max(self.writePos - (self.markerOffset + len(self.marker) - 1), self.readPos + 1)
+            self.bytesSkipped += newPos - self.readPos
+            self.readPos = newPos
+
+
+def ReadRing(array, start, stop):
+    '''returns the rows [start, stop) of a ring buffer addressed by absolute index. The
+    result is a view unless the range wraps around the end of the array'''
+    size = len(array)
+    if start >= stop:
+        return array[:0]
+    i0 = start % size
+    i1 = i0 + (stop - start)
+    if i1 <= size:
+        return array[i0:i1]
+    return np.concatenate([array[i0:], array[:i1 - size]])
+
+def WriteRing(array, start, values):
+    '''writes values to a ring buffer starting at absolute index start'''
+    size = len(array)
+    written = 0
+    while written < len(values):
+        idx = (start + written) % size
+        chunk = min(len(values) - written, size - idx)
+        array[idx:idx+chunk] = values[written:written+chunk]
+        written += chunk
+
+
+class SampleStore:
+    '''
+    ====================================================================================
+    SampleStore: preallocated columnar ring buffer of decoded samples (see SampleColumns).
+    Every sample takes the same number of bytes and appends never reallocate. Once the
+    store is full the oldest samples are overwritten, or new ones are dropped if
+    overwrite is disabled. Rows are addressed by absolute sample index, i.e. the number
+    of samples written before them. BrySegments.SegmentStore has the same interface.
+
+    There is a single writer. Readers don't need to lock: rows below writeCount never
+    change until the ring wraps over them, so a reader copies what it needs and then
+    checks with IsIntact that neither an overwrite (reserveCount is raised before
+    writing) nor a Clear (bumps generation) happened meanwhile
+    ====================================================================================
+    '''
+    pyramidBase = PyramidFactor #samples per bucket of the first GraphPyramid level
+
+    def __init__(self, capacity, overwrite=True):
+        self.capacity = capacity
+        self.overwrite = overwrite
+        self.columns = {name: np.zeros((capacity,)+shape, dtype=dtype) for name, dtype, shape in SampleColumns}
+        self.generation = 0
+        self.version = 0
+        self.Clear()
+
+    def Clear(self):
+        self.generation += 1 #first, so readers notice before the counters go back
+        self.writeCount = 0   #number of samples written (published)
+        self.reserveCount = 0 #number of samples written or being written
+        self.dropCount = 0    #number of samples dropped because the store was full
+        self.version += 1
+
+    def IsIntact(self, generation, start):
+        '''tells if rows from absolute index start on, read during generation, were not
+        overwritten or cleared since'''
+        return self.generation == generation and start >= self.reserveCount - self.capacity
+
+    def __len__(self):
+        return min(self.writeCount, self.capacity)
+
+    def FirstIndex(self, end=None):
+        '''absolute index of the oldest sample still in the store, or of the oldest one
+        that was when writeCount was end'''
+        end = self.writeCount if end is None else end
+        return max(end - self.capacity, 0)
+
+    def RowBytes(self):
+        return sum(col.itemsize * int(np.prod(col.shape[1:])) for col in self.columns.values())
+
+    def Append(self, row):
+        '''appends one sample given as a dict of column values'''
+        if self.writeCount >= self.capacity and not self.overwrite:
+            self.dropCount += 1
+            if metrics.enabled:
+                metrics.Count("drops")
+            return False
+        idx = self.writeCount % self.capacity
+        self.reserveCount = self.writeCount + 1
+        for name, val in row.items():
+            self.columns[name][idx] = val
+        self.writeCount += 1
+        self.version += 1
+        return True
+
+    def AppendBatch(self, columns):
+        '''appends a block of samples given as a dict of equal length column arrays'''
+        n = len(columns["timecode"])
+        skip = 0
+        if not self.overwrite:
+            room = max(self.capacity - self.writeCount, 0)
+            self.dropCount += max(n - room, 0)
+            if metrics.enabled:
+                metrics.Count("drops", max(n - room, 0))
+            n = min(n, room)
+        elif n > self.capacity:
+            #only the last capacity samples would survive
+            skip = n - self.capacity
+            n = self.capacity
+        self.reserveCount = self.writeCount + skip + n
+        for name, col in columns.items():
+            WriteRing(self.columns[name], self.writeCount + skip, col[skip:skip+n])
+        self.writeCount += skip + n
+        self.version += 1
+        return n
+
+    def Read(self, name, start=None, stop=None):
+        '''returns the rows [start, stop) of a column in chronological order. start and stop
+        are absolute sample indices and default to the oldest and newest stored samples; the
+        caller keeps them in that range. The result is a view into the store unless the range
+        wraps around the end of the ring'''
+        start = self.FirstIndex() if start is None else start
+        stop = self.writeCount if stop is None else stop
+        return ReadRing(self.columns[name], start, stop)
+
+    def SearchSorted(self, name, value, start=None, stop=None):
+        '''absolute index of the first sample in [start, stop) whose column value is >= value,
+        assuming the column is sorted (e.g. timecode). Binary search in place, nothing is copied'''
+        col = self.columns[name]
+        lo = self.FirstIndex() if start is None else start
+        hi = self.writeCount if stop is None else stop
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if col[mid % self.capacity] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class GraphPyramid:
+    '''
+    ====================================================================================
+    GraphPyramid: min/max/mean level-of-detail pyramid over the graph columns of a
+    SampleStore. Level k has one bucket per baseSize*factor^(k-1) samples. Buckets are filled as
+    soon as they are complete, from the level below, so each sample costs O(1)
+    amortized. Queries return at most a couple of points per pixel whatever the history
+    size, and min/max buckets keep every spike visible
+    ====================================================================================
+    '''
+    def __init__(self, store, channels, factor=PyramidFactor, baseSize=None, times=None):
+        self.store = store
+        self.times = times or (lambda start, stop: store.Read("timecode", start, stop).astype(np.float64)) #x of rows [start, stop)
+        self.channels = channels
+        self.factor = factor
+        self.levels = []
+        size = baseSize or factor
+        while size <= store.capacity:
+            buckets = store.capacity // size + 2
+            level = {"size":size, "xFirst":np.zeros(buckets), "xLast":np.zeros(buckets)}
+            for channel in channels:
+                level[channel] = {"min":np.zeros(buckets), "max":np.zeros(buckets), "sum":np.zeros(buckets), "count":np.zeros(buckets, dtype=np.int32)}
+            self.levels.append(level)
+            size *= factor
+        self.Clear()
+
+    def Clear(self):
+        for level in self.levels:
+            level["done"] = 0 #absolute sample index up to which buckets are complete
+
+    def ReduceSamples(self, x, channelData, size):
+        '''reduces each run of size raw samples to a bucket'''
+        m = len(x) // size
+        x = x.reshape(m, size)
+        out = {"xFirst":x[:, 0], "xLast":x[:, -1]}
+        for channel, y in channelData.items():
+            y = y.reshape(m, size)
+            valid = np.isfinite(y)
+            out[channel] = {"min":np.fmin.reduce(y, axis=1), "max":np.fmax.reduce(y, axis=1),
+                            "sum":np.where(valid, y, 0.0).sum(axis=1), "count":valid.sum(axis=1)}
+        return out
+
+    def ReduceBuckets(self, lower):
+        '''reduces each run of factor buckets of the level below to a bucket'''
+        m = len(lower["xFirst"]) // self.factor
+        out = {"xFirst":lower["xFirst"].reshape(m, self.factor)[:, 0], "xLast":lower["xLast"].reshape(m, self.factor)[:, -1]}
+        for channel in self.channels:
+            stats = {stat: arr.reshape(m, self.factor) for stat, arr in lower[channel].items()}
+            out[channel] = {"min":np.fmin.reduce(stats["min"], axis=1), "max":np.fmax.reduce(stats["max"], axis=1),
+                            "sum":stats["sum"].sum(axis=1), "count":stats["count"].sum(axis=1)}
+        return out
+
+    def ReadLevel(self, k, j0, j1):
+        '''returns buckets [j0, j1) of level k (1 based)'''
+        level = self.levels[k-1]
+        out = {"xFirst":ReadRing(level["xFirst"], j0, j1), "xLast":ReadRing(level["xLast"], j0, j1)}
+        for channel in self.channels:
+            out[channel] = {stat: ReadRing(arr, j0, j1) for stat, arr in level[channel].items()}
+        return out
+
+    def Update(self):
+        '''completes the buckets of every level that the new samples filled up'''
+        end = self.store.writeCount
+        first = self.store.FirstIndex()
+        for k, level in enumerate(self.levels, 1):
+            size = level["size"]
+            newDone = end // size * size
+            if newDone <= level["done"]:
+                break
+            #samples dropped from the ring (after a very large batch) can't be reduced
+            start = max(level["done"], -(-first // size) * size)
+            if start < newDone:
+                lowerSize = size // self.factor
+                if k == 1:
+                    x = self.times(start, newDone)
+                    out = self.ReduceSamples(x, {channel: self.store.Read(channel, start, newDone) for channel in self.channels}, size)
+                else:
+                    out = self.ReduceBuckets(self.ReadLevel(k-1, start // lowerSize, newDone // lowerSize))
+                j0 = start // size
+                WriteRing(level["xFirst"], j0, out["xFirst"])
+                WriteRing(level["xLast"], j0, out["xLast"])
+                for channel in self.channels:
+                    for stat, arr in level[channel].items():
+                        WriteRing(arr, j0, out[channel][stat])
+            level["done"] = newDone
+
+    def Query(self, channel, i0, i1, points, mode="minmax"):
+        '''returns (sample index, x, value) arrays covering samples [i0, i1) using the
+        coarsest level that still has at least points buckets in the range. mode "minmax"
+        gives two points per bucket (min at its first sample, max at its last), "mean" one'''
+        #raw samples up to points times what a level below the first would hold
+        k, size = 0, (self.levels[0]["size"] // self.factor if self.levels else 1)
+        while k < len(self.levels) and i1 - i0 > points * size:
+            k += 1
+            size = self.levels[k-1]["size"]
+        if k == 0:
+            return np.arange(i0, i1), self.times(i0, i1), self.store.Read(channel, i0, i1)
+
+        level = self.levels[k-1]
+        j0 = i0 // size
+        jDone = max(min(-(-i1 // size), level["done"] // size), j0)
+        buckets = self.ReadLevel(k, j0, jDone)
+        xFirst, xLast, stats = buckets["xFirst"], buckets["xLast"], buckets[channel]
+        vMin, vMax, vSum, vCount = stats["min"], stats["max"], stats["sum"], stats["count"]
+
+        #the newest bucket is not complete yet, reduce its samples directly
+        tail0 = max(jDone * size, i0)
+        if tail0 < i1:
+            x = self.times(tail0, i1)
+            y = self.store.Read(channel, tail0, i1)
+            valid = np.isfinite(y)
+            xFirst = np.append(xFirst, x[0])
+            xLast = np.append(xLast, x[-1])
+            vMin = np.append(vMin, np.fmin.reduce(y))
+            vMax = np.append(vMax, np.fmax.reduce(y))
+            vSum = np.append(vSum, np.where(valid, y, 0.0).sum())
+            vCount = np.append(vCount, valid.sum())
+
+        idxFirst = np.arange(j0, j0 + len(xFirst)) * size
+        if mode == "mean":
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return idxFirst, xFirst, vSum / vCount
+        idx = np.column_stack([idxFirst, np.minimum(idxFirst + size, i1) - 1]).ravel()
+        return idx, np.column_stack([xFirst, xLast]).ravel(), np.column_stack([vMin, vMax]).ravel()
+
+
 class SampleHistory:
     '''
     ====================================================================================
-    SampleHistory: stores the individual samples in a python array. Simple x-y values
-    are also stores in numpy arrays for direct consumption by the graph
+    SampleHistory: stores the decoded samples in a bounded, preallocated SampleStore, or
+    in a BrySegments.SegmentStore that spills to disk (capacity defaults to
+    HistoryCapacity, or to BrySegments.SpillCapacity when spilling). Each sample keeps
+    its raw payload bytes so the full sample can be decoded again on request. Graph
+    columns are served straight from the store, and any [t0, t1) range is found by
+    binary search.
+    dataLock only serializes writers. Readers never take it: they copy what they need
+    and retry if the writer overwrote it meanwhile (see ReadConsistent), so a slow
+    reader never stalls acquisition. GetVersion tells readers if anything changed.
+    Lock waits and hold times go to the dataLockWait/dataLockHeld metrics when enabled
     ====================================================================================
     '''
-    def __init__(self):
+    def __init__(self, capacity=None, overwrite=True, store=None, model=None):
         self.dataLock = threading.Lock()
+        if store is None:
+            if HistorySpillDir:
+                from BrySegments import SegmentStore, SpillCapacity
+                store = SegmentStore(SpillCapacity if capacity is None else capacity, overwrite, spillDir=HistorySpillDir)
+            else:
+                store = SampleStore(HistoryCapacity if capacity is None else capacity, overwrite)
+        self.store = store
+        self.pyramid = GraphPyramid(self.store, ["valueLower", "valueUpper"], baseSize=self.store.pyramidBase, times=self.Times)
+        self.decoder = BrymenDecoder(model=model)
+        self.stats = RollingStats(unitNames=UnitNames, sourceNames=SourceNames)
         self.clearSampleHistory()
         
 
     def AddSampleToHistory(self, sample):
-        with self.dataLock:
-            self.logSamples.append(sample)
-    
-            #grow graph data by 2x
-            sampleIdx = self.logGraphLen
-            self.logGraphLen +=1 
-            graphCapacity = self.logGraphData.shape[1]
-            if self.logGraphLen >= graphCapacity:
-                newData = np.empty((4,2*graphCapacity))
-                newData[:,:graphCapacity] = self.logGraphData
-                self.logGraphData = newData
-    
-            self.logGraphData[0,sampleIdx] = sample["timecode"]    
-            self.logGraphData[1,sampleIdx] = sample["pctimestamp"]    
-            self.logGraphData[2,sampleIdx] = sample["measureLower"]["value"]
-            self.logGraphData[3,sampleIdx] = sample["measureUpper"]["value"]
-
-            self.labels["lower"]["source"] = sample["measureLower"]["source"]
-            self.labels["lower"]["unit"] = sample["measureLower"]["unit"]
-            self.labels["upper"]["source"] = sample["measureUpper"]["source"]
-            self.labels["upper"]["unit"] = sample["measureUpper"]["unit"]
+        row = EncodeSample(sample)
+        labels = {"lower":{"source":sample["measureLower"]["source"], "unit":sample["measureLower"]["unit"]},
+                  "upper":{"source":sample["measureUpper"]["source"], "unit":sample["measureUpper"]["unit"]}}
+        with (TimedLock(self.dataLock) if metrics.enabled else self.dataLock):
+            self.AddEpochs([row["timecode"]])
+            self.store.Append(row)
+            self.pyramid.Update()
+            if self.store.writeCount - self.statsDone >= min(StatsBatch, self.store.capacity):
+                self.UpdateStats()
+            self.labels = labels
             #print(sample)
 
+    def AddBatchToHistory(self, columns):
+        '''adds a block of samples decoded by BrymenDecoder.DecodeBatch. pctimestamp is
+        taken from the columns if present, otherwise it is unknown (nan)'''
+        n = len(columns["timecode"])
+        if n == 0:
+            return
+        if "pctimestamp" not in columns:
+            columns = dict(columns, pctimestamp=np.full(n, np.nan))
+        labels = {display: {"source":SourceNames[columns["source" + key][-1]], "unit":UnitNames[columns["unit" + key][-1]]}
+                  for display, key in [("lower", "Lower"), ("upper", "Upper")]}
+        with (TimedLock(self.dataLock) if metrics.enabled else self.dataLock):
+            self.UpdateStats()
+            self.AddEpochs(columns["timecode"])
+            t = self.EpochTimes(columns["timecode"], self.store.writeCount)
+            self.store.AppendBatch(columns)
+            self.pyramid.Update()
+            self.stats.AddBatch(columns, t / 1000.0)
+            self.statsDone = self.store.writeCount
+            self.labels = labels
+
     def clearSampleHistory(self):
-        with self.dataLock:
-            self.logSamples = [] #this effectively  resets the pointer
-            self.logGraphData = np.empty((4,100))
-            self.logGraphLen = 0
+        with (TimedLock(self.dataLock) if metrics.enabled else self.dataLock):
+            self.store.Clear()
+            self.epochs = NewEpochs()
+            self.lastTimecode = None
+            self.pyramid.Clear()
+            self.stats.Clear()
+            self.statsDone = 0 #absolute index up to which the samples are in stats
             self.labels = {"upper":{"source":"", "unit":""}, "lower":{"source":"", "unit":""}} 
 
-    def exportCSV(self, fileName):
-        with self.dataLock:
-            headerStr = "Timecode (ms), WallClock (seconds), {} ({}), {} ({})".format(self.labels["lower"]["source"], self.labels["lower"]["unit"], self.labels["upper"]["source"], self.labels["upper"]["unit"])   
-            headerStr = headerStr.replace('Ω', 'Ohm')
-            np.savetxt(fileName, self.logGraphData[:,:self.logGraphLen].T, delimiter=",", fmt='%d,%f,%f,%f', header=headerStr)
-        
+    def AddEpochs(self, timecodes):
+        '''starts an epoch at every timecode of a batch about to be appended that steps
+        back (device restart, or the wrap after ~49 days), so the continuous time goes on
+        from the previous sample. Called before the rows are stored, so a reader never
+        sees rows without their epoch'''
+        store = self.store
+        if not store.overwrite:
+            timecodes = timecodes[:max(store.capacity - len(store), 0)]
+        if len(timecodes) == 0:
+            return
+        previous = self.lastTimecode
+        if len(timecodes) == 1 and (previous is None or timecodes[0] >= previous):
+            #a single sample going on, without numpy's overhead
+            self.lastTimecode = float(timecodes[0])
+            return
+        t = np.asarray(timecodes, dtype=np.float64)
+        self.lastTimecode = float(t[-1])
+        prior = np.concatenate(([t[0] if previous is None else previous], t[:-1]))
+        back = np.flatnonzero(t < prior)
+        if len(back) == 0:
+            return
+        #the epochs of rows no longer stored go, the one holding the oldest row stays
+        starts, offsets, times = self.epochs
+        keep = max(int(np.searchsorted(starts, store.FirstIndex(), side="right")) - 1, 0)
+        added = offsets[-1] + np.cumsum(prior[back] - t[back])
+        self.epochs = (np.concatenate((starts[keep:], store.writeCount + back)), np.concatenate((offsets[keep:], added)),
+                       np.concatenate((times[keep:], t[back] + added)))
+
+    def EpochTimes(self, timecodes, start):
+        '''continuous time (ms) of the rows from absolute index start on with these
+        timecodes: the timecode plus the offset of the row's epoch (see AddEpochs)'''
+        starts, offsets, times = self.epochs
+        t = np.array(timecodes, dtype=np.float64)
+        stop = start + len(t)
+        j0 = max(int(np.searchsorted(starts, start, side="right")) - 1, 0)
+        j1 = int(np.searchsorted(starts, stop, side="left"))
+        for j in range(j0, max(j1, j0 + 1)):
+            a = max(int(starts[j]), start)
+            b = min(int(starts[j+1]), stop) if j + 1 < len(starts) else stop
+            if a < b and offsets[j]:
+                t[a-start:b-start] += offsets[j]
+        return t
+
+    def Times(self, start, stop):
+        '''continuous time (ms) of rows [start, stop), the plots' x axis'''
+        return self.EpochTimes(self.store.Read("timecode", start, stop), start)
+
+    def SearchTime(self, t, lo, hi):
+        '''absolute index of the first row in [lo, hi) whose continuous time (see Times)
+        is >= t: a binary search of the epochs, then of the timecodes of one epoch'''
+        starts, offsets, times = self.epochs
+        j = int(np.searchsorted(times, t, side="left"))
+        if j == 0:
+            return lo
+        stop = int(starts[j]) if j < len(starts) else hi
+        a, b = max(int(starts[j-1]), lo), min(stop, hi)
+        if a >= b:
+            return lo if stop <= lo else hi
+        return self.store.SearchSorted("timecode", t - offsets[j-1], a, b)
+
+    def UpdateStats(self):
+        '''merges the samples added one by one since the last update into the statistics,
+        as one batch on the history's continuous time. The caller holds dataLock'''
+        end = self.store.writeCount
+        start = max(self.statsDone, self.store.FirstIndex())
+        self.statsDone = end
+        if start < end:
+            columns = {name: self.store.Read(name, start, end) for name in StatsColumns}
+            self.stats.AddBatch(columns, self.Times(start, end) / 1000.0)
+
+    def GetSampleCount(self):
+        return len(self.store)
+
+    def SetModel(self, model):
+        '''the meter model GetSample decodes the stored payloads with'''
+        self.decoder = BrymenDecoder(model=model)
+
+    def GetVersion(self):
+        '''a number that changes whenever samples are added or the history is cleared'''
+        return self.store.version
+
+    def ReadConsistent(self, reader):
+        '''runs reader(writeCount) without taking dataLock. reader copies the rows it needs
+        up to writeCount and returns (first absolute index it read, result). If the writer
+        overwrote those rows or cleared the history meanwhile it is run again'''
+        for attempt in range(ReadRetries):
+            generation = self.store.generation
+            start, result = reader(self.store.writeCount)
+            if self.store.IsIntact(generation, start):
+                return result
+        #the writer keeps overtaking us, read under the lock this time
+        with (TimedLock(self.dataLock) if metrics.enabled else self.dataLock):
+            return reader(self.store.writeCount)[1]
+
+    def GetRowsSince(self, cursor, names):
+        '''returns (new cursor, {name: rows}) with the rows appended since cursor, which is
+        None or the cursor returned by the previous call. If the history was cleared or the
+        rows were already overwritten meanwhile it starts from the oldest stored row'''
+        def Reader(end):
+            generation = self.store.generation
+            start = self.store.FirstIndex(end)
+            if cursor is not None and cursor[0] == generation:
+                start = max(start, cursor[1])
+            return start, ((generation, end), {name: np.array(self.store.Read(name, start, end)) for name in names})
+        return self.ReadConsistent(Reader)
+
+    def GetLatestSample(self):
+        '''returns the newest sample as a full sample dict (decoded again from its raw bytes)
+        or None if the history is empty'''
+        def Reader(end):
+            if end == 0:
+                return end, None
+            last = end - 1
+            return last, (self.store.Read("payload", last, end)[0].tobytes(), int(self.store.Read("timecode", last, end)[0]), float(self.store.Read("pctimestamp", last, end)[0]))
+        latest = self.ReadConsistent(Reader)
+        if latest is None:
+            return None
+
+        payload, timecode, pctimestamp = latest
+        inbytes = payload + timecode.to_bytes(4, 'little')
+        sample = {"inbytes":inbytes, "pctimestamp":pctimestamp}
+        sample["timecode"], sample["state"], sample["measureUpper"], sample["measureLower"], unpackedData = self.decoder.DecodePacket(inbytes)
+        return sample
+
+    def GetGraphData(self):
+        '''returns a 4xN array of timecode, pctimestamp, lower and upper values'''
+        def Reader(end):
+            start = self.store.FirstIndex(end)
+            return start, np.stack([self.store.Read(name, start, end) for name in ["timecode", "pctimestamp", "valueLower", "valueUpper"]])
+        return self.ReadConsistent(Reader)
+
+    def GetPlotData(self, channel, x0=None, x1=None, pixels=None, timeAxis=True, mode="minmax"):
+        '''returns (x, y) arrays of a graph channel ("valueLower" or "valueUpper") for the x
+        range [x0, x1), in continuous time ms (see Times) if timeAxis else in sample index (0 is the oldest
+        stored sample). With pixels given, the level-of-detail pyramid keeps the number of
+        points proportional to the pixel width (see GraphPyramid.Query)'''
+        def Reader(end):
+            first = self.store.FirstIndex(end)
+            if timeAxis:
+                i0 = first if x0 is None else self.SearchTime(x0, first, end)
+                i1 = end if x1 is None else self.SearchTime(x1, i0, end)
+            else:
+                i0 = first if x0 is None else min(max(first + int(np.floor(x0)), first), end)
+                i1 = end if x1 is None else min(max(first + int(np.ceil(x1)), i0), end)
+            #include the neighbours so the line continues to the edges of the view
+            i0, i1 = max(i0 - 1, first), min(i1 + 1, end)
+            idx, x, y = self.pyramid.Query(channel, i0, i1, pixels if pixels else i1 - i0, mode)
+            return i0, ((x if timeAxis else (idx - first).astype(np.float64)), np.array(y))
+        return self.ReadConsistent(Reader)
+
+    def IndexRange(self, t0, t1, key, first, end):
+        '''absolute indices [i0, i1) of the samples with t0 <= key < t1 among [first, end).
+        key is timecode, searched as the continuous time of the plots (ms, see Times), or
+        pctimestamp (seconds)'''
+        search = self.SearchTime if key == "timecode" else lambda t, lo, hi: self.store.SearchSorted(key, t, lo, hi)
+        i0 = first if t0 is None else search(t0, first, end)
+        i1 = end if t1 is None else search(t1, i0, end)
+        return i0, i1
+
+    def GetRange(self, names, t0=None, t1=None, key="timecode"):
+        '''{name: rows} of the samples with t0 <= key < t1, None meaning open. Only the
+        part of the store holding them is read'''
+        def Reader(end):
+            i0, i1 = self.IndexRange(t0, t1, key, self.store.FirstIndex(end), end)
+            return i0, {name: np.array(self.store.Read(name, i0, i1)) for name in names}
+        return self.ReadConsistent(Reader)
+
+    def GetRangeStats(self, t0=None, t1=None, key="timecode"):
+        '''count, mean, std, min and max of both displays over [t0, t1), overloads left out'''
+        rows = self.GetRange(["valueLower", "valueUpper"], t0, t1, key)
+        stats = {}
+        for display, name in [("lower", "Lower"), ("upper", "Upper")]:
+            v = rows["value" + name]
+            v = v[np.isfinite(v)]
+            n = len(v)
+            stats[display] = {"count":n, "mean":float(v.mean()) if n else math.nan, "std":float(v.std(ddof=1)) if n > 1 else math.nan,
+                              "min":float(v.min()) if n else math.nan, "max":float(v.max()) if n else math.nan}
+        return stats
+
+    def GetStats(self):
+        '''rolling statistics of both displays over the windows and the session (see
+        BryStats), read without waiting for dataLock. The samples added one by one since
+        the last merge are merged first if the writer isn't holding it'''
+        if self.statsDone != self.store.writeCount and self.dataLock.acquire(blocking=False):
+            try:
+                self.UpdateStats()
+            finally:
+                self.dataLock.release()
+        return self.stats.Snapshot()
+
+    def GetLabels(self):
+        labels = self.labels
+        return {display: dict(label) for display, label in labels.items()}
+
+    def GetCSVHeader(self):
+        labels = self.GetLabels()
+        headerStr = "Timecode (ms), WallClock (seconds), {} ({}), {} ({})".format(labels["lower"]["source"], labels["lower"]["unit"], labels["upper"]["source"], labels["upper"]["unit"])   
+        return headerStr.replace('Ω', 'Ohm')
+
+    def StartExport(self, fileName, onDone=None, t0=None, t1=None, key="timecode"):
+        '''exports the history, or its samples with t0 <= key < t1, in a worker thread (see
+        ExportJob) and returns the job'''
+        job = ExportJob(self, fileName, onDone, t0=t0, t1=t1, key=key)
+        job.Start()
+        return job
+
+    def exportCSV(self, fileName, t0=None, t1=None, key="timecode"):
+        '''exports the history synchronously. The format follows the file extension'''
+        job = ExportJob(self, fileName, t0=t0, t1=t1, key=key)
+        job.Run()
+        if job.error is not None:
+            raise job.error
+
+
+class ExportJob:
+    '''
+    ====================================================================================
+    ExportJob: writes the history to a file in a worker thread. The rows are copied
+    first from a lock-free snapshot, so acquisition never waits for the export.
+    CSV is formatted and written in chunks; progress (0..1) can be polled and Cancel
+    stops the job between chunks and removes the partial file. .npy files get the
+    graph columns as an Nx4 array, .npz files all stored columns
+    ====================================================================================
+    '''
+    rowFormat = "%d,%f,%f,%f\n" #CSV format of a GraphColumns row
+
+    def __init__(self, history, fileName, onDone=None, chunkRows=ExportChunkRows, t0=None, t1=None, key="timecode"):
+        self.history = history
+        self.fileName = fileName
+        self.range = (t0, t1, key) #samples with t0 <= key < t1, None meaning open
+        self.onDone = onDone #called from the worker thread with the job when finished
+        self.chunkRows = chunkRows
+        self.progress = 0.0
+        self.cancelled = False
+        self.done = False
+        self.error = None
+        self.thread = None
+
+    def Start(self):
+        self.thread = threading.Thread(target=self.Run)
+        self.thread.start()
+
+    def Cancel(self):
+        self.cancelled = True
+
+    def Wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.done
+
+    def Run(self):
+        try:
+            if self.fileName.lower().endswith(".npz"):
+                self.WriteNPZ()
+            elif self.fileName.lower().endswith(".npy"):
+                self.WriteNPY()
+            else:
+                self.WriteCSV()
+            if self.cancelled and os.path.exists(self.fileName):
+                os.remove(self.fileName)
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.done = True
+            if self.onDone is not None:
+                self.onDone(self)
+
+    def GraphColumns(self):
+        rows = self.history.GetRange(["timecode", "pctimestamp", "valueLower", "valueUpper"], *self.range)
+        return np.column_stack([rows["timecode"], rows["pctimestamp"], rows["valueLower"], rows["valueUpper"]])
+
+    def Header(self):
+        return self.history.GetCSVHeader()
+
+    def WriteCSV(self):
+        header = self.Header()
+        data = self.GraphColumns()
+        with open(self.fileName, "w", encoding="latin1") as f:
+            f.write("# " + header + "\n")
+            for start in range(0, len(data), self.chunkRows):
+                if self.cancelled:
+                    return
+                chunk = data[start:start+self.chunkRows]
+                #one big %-format per chunk is several times faster than savetxt's row loop
+                f.write((self.rowFormat * len(chunk)) % tuple(chunk.ravel().tolist()))
+                self.progress = min(start + self.chunkRows, len(data)) / len(data)
+        self.progress = 1.0
+
+    def WriteNPY(self):
+        np.save(self.fileName, self.GraphColumns())
+        self.progress = 1.0
+
+    def WriteNPZ(self):
+        names = [name for name, dtype, shape in SampleColumns]
+        rows = self.history.GetRange(names, *self.range)
+        labels = self.history.GetLabels()
+        for display in ["lower", "upper"]:
+            rows[display + "Label"] = np.array([labels[display]["source"], labels[display]["unit"]])
+        rows["unitNames"] = np.array(UnitNames)
+        rows["unitOrgNames"] = np.array(UnitOrgNames)
+        rows["sourceNames"] = np.array(SourceNames)
+        rows["stateNames"] = np.array(StateNames)
+        np.savez(self.fileName, **rows)
+        self.progress = 1.0
 
 
-        
-          
-#create an instance
-history = SampleHistory()
+#====================================================================================
+# Interned codes used by the batch decoder. Units, prefixed units, sources and state
+# flags are stored as small integers that index into these tables
+#====================================================================================
+UnitNames     = ["", "A", "V", "Ω", "Hz", "F", "S", "%", "dBm", "°F", "°C"]
+PrefixNames   = ["", "n", "µ", "m", "k", "M"]
+PrefixMults   = np.array([1.0, 1e-9, 1e-6, 1e-3, 1e3, 1e6])
+UnitOrgNames  = [prefix + unit for prefix in PrefixNames for unit in UnitNames]
+SourceBases   = ["", "DC+AC", "DC", "AC", "Capacitance", "Resistance", "Conductance", "Frequency", "Duty",
+                 "Temperature Diff", "Temperature 1", "Temperature 2"]
+SourceSuffixes = ["", " Current", " Voltage"]
+SourceNames   = [diode + base + suffix for diode in ["", "Diode"] for suffix in SourceSuffixes for base in SourceBases]
+StateNames    = ["Holding", "Relative", "Recording", "Crest", "Min", "Max", "Avg"]
+
+UnitCodes     = {name: code for code, name in enumerate(UnitNames)}
+UnitOrgCodes  = {name: code for code, name in enumerate(UnitOrgNames)}
+SourceCodes   = {name: code for code, name in enumerate(SourceNames)}
+
+#fixed size record of a stored sample: (name, dtype, shape)
+SampleColumns = [
+    ("timecode",      np.uint32,  ()),
+    ("pctimestamp",   np.float64, ()),
+    ("payload",       np.uint8,   (20,)), #raw packet bytes without the timecode
+    ("valueUpper",    np.float64, ()),
+    ("valueLower",    np.float64, ()),
+    ("valueOrgUpper", np.float64, ()),
+    ("valueOrgLower", np.float64, ()),
+    ("unitUpper",     np.uint8,   ()),
+    ("unitLower",     np.uint8,   ()),
+    ("unitOrgUpper",  np.uint8,   ()),
+    ("unitOrgLower",  np.uint8,   ()),
+    ("sourceUpper",   np.uint8,   ()),
+    ("sourceLower",   np.uint8,   ()),
+    ("state",         np.uint8,   ()),
+    ]
+
+StatsColumns = ["valueLower", "valueUpper", "unitLower", "unitUpper", "sourceLower", "sourceUpper"]
+
+def NewEpochs():
+    '''the epochs of an empty SampleHistory: (first absolute index, offset ms, continuous
+    time of the first row ms) arrays, sorted'''
+    return (np.zeros(1, dtype=np.int64), np.zeros(1), np.full(1, -math.inf))
+
+def EncodeSample(sample):
+    '''converts a sample dict to a SampleColumns row'''
+    row = {"timecode":sample["timecode"], "pctimestamp":sample["pctimestamp"], "payload":np.frombuffer(sample["inbytes"][:20], dtype=np.uint8)}
+    for name, measure in [("Upper", sample["measureUpper"]), ("Lower", sample["measureLower"])]:
+        row["value" + name] = measure["value"]
+        row["valueOrg" + name] = measure["valueOrg"]
+        row["unit" + name] = UnitCodes[measure["unit"]]
+        row["unitOrg" + name] = UnitOrgCodes[measure["unitOrg"]]
+        row["source" + name] = SourceCodes[measure["source"]]
+    row["state"] = sum(1 << i for i, name in enumerate(StateNames) if sample["state"][name])
+    return row
+
+def Freeze(value):
+    '''read-only copy of nested dicts and lists, shared safely between samples'''
+    if isinstance(value, dict):
+        return MappingProxyType({key: Freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(Freeze(item) for item in value)
+    return value
+
+DecimalFlags = tuple("Dec{}".format(pos) for pos in range(1, 9)) #decimal point flags of a display, left to right
+
+def BuildSegmentTables(segments, chars):
+    '''builds 256-entry lookup tables from the segment map: the index of each byte's
+    character in chars and its digit value (-1 for non-digits)'''
+    codeLUT  = np.full(256, chars.index('?'), dtype=np.uint8)
+    digitLUT = np.full(256, -1, dtype=np.int8)
+    for byte in range(256):
+        char = segments.get(byte & 0b11111110, '?')
+        codeLUT[byte] = chars.index(char)
+        if char.isdigit():
+            digitLUT[byte] = int(char)
+    return codeLUT, digitLUT
+
+def AsPacketArray(packets):
+    '''returns the packets as an Nx24 uint8 array. Accepts such an array or a raw
+    bytes buffer of back to back packets (a trailing partial packet is ignored)'''
+    if isinstance(packets, np.ndarray):
+        data = packets.astype(np.uint8, copy=False)
+    else:
+        data = np.frombuffer(packets, dtype=np.uint8)
+    if data.ndim == 1:
+        data = data[:len(data) - len(data) % Nread].reshape(-1, Nread)
+    if data.ndim != 2 or data.shape[1] != Nread:
+        raise ValueError("packets must be an Nx{} array".format(Nread))
+    return data
 
 
 class BrymenDecoder:
@@ -242,30 +1111,71 @@ class BrymenDecoder:
     bit and also decode those bits to meaningful DMM state and measurement values
     ====================================================================================
     '''
-    #Segment data to character map (7 MSB only)
-    segments ={
-        0b10111110:"0",
-        0b10100000:"1",
-        0b11011010:"2",
-        0b11111000:"3",
-        0b11100100:"4",
-        0b01111100:"5",
-        0b01111110:"6",
-        0b10101000:"7",
-        0b11111110:"8",
-        0b11111100:"9",
-        0b00000000:" ",
-        0b01000000:"-",
-        0b01001110:"F",
-        0b00011110:"C",
-        0b00010110:"L",
-        0b11110010:"d",
-        0b00100000:"i",
-        0b01110010:"o",
-        0b01011110:"E",
-        0b01000010:"r",
-        0b01100010:"n",
-        }
+    #Segment data to character map (7 MSB only) and the layout of the default model, for
+    #code that builds frames without a decoder (BryCorpus)
+    segments = BryLayout.Segments
+    batchLayout, batchStateBits = BryLayout.BatchLayout(MeterModel)
+
+    #Lookup tables for the batch decoder: segment byte -> character code / digit value
+    segmentChars = "0123456789 -FCLdioErn?"
+    segmentCodes, segmentDigits = BuildSegmentTables(segments, segmentChars)
+
+    def __init__(self, cacheSize=DecodeCacheSize, model=None):
+        #the meter's bit layout (see BryLayout), MeterModel by default. DecodePacket uses
+        #it compiled, UnpackBytes and the batch decoder read it as data
+        self.model = model if model is not None else MeterModel
+        self.layout = BryLayout.GetModel(self.model)
+        self.rules = self.layout["rules"]
+        self.sourceRules = [(frozenset(flags), name) for flags, name in self.rules["sources"]]
+        self.batchLayout, self.batchStateBits = BryLayout.BatchLayout(self.layout)
+        self.segments = self.layout["segments"]
+        self.segmentCodes, self.segmentDigits = BuildSegmentTables(self.segments, self.segmentChars)
+        self.compiled = BryLayout.CompileDecoder(self.layout)
+        #LRU cache of DecodePacket: payload bytes -> read-only decoded records
+        self.cache = OrderedDict()
+        self.cacheSize = cacheSize
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.cacheEvictions = 0
+
+    def DecodePacket(self, inbytes):
+        '''UnpackBytes and DecodeUnpackedData of a packet, by the compiled layout, cached on
+        its 20 payload bytes. In steady measurements consecutive packets differ only in the
+        timecode, so most calls are a dict lookup. Returns (timecode, state, measureUpper, measureLower, unpackedData),
+        all but the timecode are read-only records shared by the packets with this payload.
+        unpackedData["timecode"] is the one of the first of them'''
+        timecode = int.from_bytes(inbytes[20:24], 'little')
+        payload = bytes(inbytes[:20])
+        cache = self.cache
+        entry = cache.get(payload)
+        if entry is not None:
+            self.cacheHits += 1
+            cache.move_to_end(payload)
+            return (timecode,) + entry
+
+        self.cacheMisses += 1
+        if metrics.enabled:
+            t = time.perf_counter()
+            decoded = self.compiled(inbytes)
+            metrics.Lap("DecodeCompiled", t)
+        else:
+            decoded = self.compiled(inbytes)
+        entry = (Freeze(decoded[1]), Freeze(decoded[2]), Freeze(decoded[3]), Freeze(decoded[4]))
+        if self.cacheSize > 0:
+            cache[payload] = entry
+            if len(cache) > self.cacheSize:
+                cache.popitem(last=False)
+                self.cacheEvictions += 1
+        return (timecode,) + entry
+
+    def GetCacheStats(self):
+        lookups = self.cacheHits + self.cacheMisses
+        return {"size":len(self.cache), "capacity":self.cacheSize, "hits":self.cacheHits, "misses":self.cacheMisses,
+                "evictions":self.cacheEvictions, "hitRate":self.cacheHits / lookups if lookups else 0.0}
+
+    def ClearCache(self):
+        self.cache.clear()
+        self.cacheHits = self.cacheMisses = self.cacheEvictions = 0
 
     def GetLitItems(self, pack):
         '''retuns a list of items whose bits are set to 1'''
@@ -275,7 +1185,7 @@ class BrymenDecoder:
     def DecodeDigit(self, char):
         '''some bytes have 7-segment bit field in the most significant bits. this function 
         decodes the most significant 7 bits to corresponding characters'''
-        digit = char & 0b11111110
+        digit = char & self.layout["segmentMask"]
         if digit in self.segments:
             return self.segments[digit]
         return '?'
@@ -286,35 +1196,29 @@ class BrymenDecoder:
         in the units as measured by the DMM. (i.e. 0.00123V and 1.23 mV)
         '''
         measure = {}
+        rules = self.rules
 
         if "Segs" not in unpackedDisplay:
             return None
 
-        lit = self.GetLitItems(unpackedDisplay)
+        lit = set(self.GetLitItems(unpackedDisplay))
 
         unit = ""
         #convert to string
         s = ''.join(unpackedDisplay["Segs"])
 
-        #insert decimal point    
+        #insert decimal point, the last lit one wins
         dotPos = None
-        if "Dec1" in lit: dotPos=1
-        if "Dec2" in lit: dotPos=2
-        if "Dec3" in lit: dotPos=3
-        if "Dec4" in lit: dotPos=4
+        for pos, flag in enumerate(DecimalFlags[:len(s)], 1):
+            if flag in lit: dotPos=pos
         if dotPos!=None:
             s = s[:dotPos] + '.' + s[dotPos:]
 
-
         #determine Unit
-        if   "A"   in lit: unit = "A"
-        elif "V"   in lit: unit = "V"
-        elif "Ohm" in lit: unit = "Ω"
-        elif "Hz"  in lit: unit = "Hz"
-        elif "F"   in lit: unit = "F"
-        elif "S"   in lit: unit = "S"
-        elif "Duty" in lit: unit = "%"
-        elif "dB"  in lit: unit = "dBm"
+        for flag, name in rules["units"]:
+            if flag in lit:
+                unit = name
+                break
 
         #remove F or C
         if s[-1:] in ["F", "C"]: 
@@ -329,22 +1233,11 @@ class BrymenDecoder:
 
         #determine multiplier
         mult = 1.0
-        if "dB" not in lit:
-            if "n" in lit: 
-                mult=1e-9
-                unitOrg = "n"+unit
-            if "µ" in lit: 
-                mult=1e-6
-                unitOrg = "µ"+unit
-            if "m" in lit: 
-                mult=1e-3
-                unitOrg = "m"+unit
-            if "k" in lit: 
-                mult=1e3
-                unitOrg = "k"+unit
-            if "M" in lit: 
-                mult=1e6
-                unitOrg = "M"+unit
+        if rules["noPrefix"] not in lit:
+            for prefix, prefixMult in rules["prefixes"]:
+                if prefix in lit: 
+                    mult=prefixMult
+                    unitOrg = prefix+unit
 
         #convert to float
         try:
@@ -354,26 +1247,23 @@ class BrymenDecoder:
 
         #Source
         source = ""
-        if "DC" in lit and "AC" in lit: source = "DC+AC"
-        elif "DC" in lit: source = "DC"
-        elif "AC" in lit: source = "AC"
-        elif "F" in lit: source = "Capacitance"
-        elif "Ohm" in lit: source = "Resistance"
-        elif "S" in lit: source = "Conductance"
-        elif "Hz" in lit: source = "Frequency"
-        elif "Duty" in lit: source = "Duty"
-    
-        if "TempDiff" in lit: source = "Temperature Diff"
-        elif "T1" in lit: source = "Temperature 1"
-        elif "T2" in lit: source = "Temperature 2"
-
-        if unit=="A": source += " Current"
-        if unit=="V": source += " Voltage"
+        for flags, name in self.sourceRules:
+            if flags <= lit:
+                source = name
+                break
+        for flag, name in rules["temperatureSources"]:
+            if flag in lit:
+                source = name
+                break
+
+        for unitName, suffix in rules["unitSources"]:
+            if unit==unitName: source += suffix
 
         valDerived = valf;
         if unitOrg=="nS":
             unit="Ω"
-            valDerived=1e9/valf
+            #0 nS is an open circuit
+            valDerived=1e9/valf if valf!=0 else math.copysign(float('inf'), valf)
         else:
             valDerived=mult*valf
 
@@ -390,19 +1280,14 @@ class BrymenDecoder:
     def DecodeUnpackedData(self, unpackedData):
         '''using the unpacked bits, determines the current state including the measurements
         '''
-        lit = self.GetLitItems(unpackedData) #get lit items in the common (non-value-specific) section
+        lit = set(self.GetLitItems(unpackedData)) #get lit items in the common (non-value-specific) section
 
         timecode = unpackedData["timecode"]
 
         state = {}
 
-        state["Holding"] = "Hold" in lit
-        state["Relative"]= "Delta" in lit
-        state["Recording"]= "Record" in lit
-        state["Crest"]= "Crest" in lit
-        state["Min"]= "Min" in lit and ("Max" not in lit)
-        state["Max"]= "Max" in lit and ("Min" not in lit)
-        state["Avg"]= "Avg" in lit and ("Min" not in lit)
+        for name, flag, unless in self.rules["state"]:
+            state[name] = flag in lit and (unless is None or unless not in lit)
 
         #decode the upper and lower measurements
         measureUpper = self.DecodeMeasurement(unpackedData["upper"])
@@ -419,328 +1304,216 @@ class BrymenDecoder:
         return (timecode, state, measureUpper, measureLower)
     
     def UnpackBytes(self, inbytes):
-        '''unpacks the bits in the bytearray to named flags and digit character array
+        '''unpacks the bits in the bytearray to named flags and digit character array, as the
+        model's layout places them. DecodePacket does the same with the compiled layout
         '''
         unpack = {"lower":{}, "upper":{}}
-        lower = unpack["lower"]
-        upper = unpack["upper"]
 
-        def UnpackBit(dic, byte, bit, key):
+        for byte, bit, section, key in self.layout["flags"]:
+            dic = unpack if section == "common" else unpack[section]
             dic[key] = (inbytes[byte]&(1<<bit))!=0
 
-        #Byte0
-        UnpackBit(unpack, 0, 0, "Auto")
-        UnpackBit(unpack, 0, 1, "Record")
-        UnpackBit(unpack, 0, 2, "Crest")
-        UnpackBit(unpack, 0, 3, "Hold")
-        UnpackBit(lower,  0, 4, "DC")
-        UnpackBit(unpack, 0, 5, "Max")
-        UnpackBit(unpack, 0, 6, "Min")
-        UnpackBit(unpack, 0, 7, "Avg")
-
-        #Byte1
-        UnpackBit(lower,  1, 0, "AC")
-        UnpackBit(lower,  1, 1, "T1")
-        UnpackBit(lower,  1, 2, "TempDiff")
-        UnpackBit(lower,  1, 3, "T2")
-        UnpackBit(unpack, 1, 4, "BarScale")
-        UnpackBit(unpack, 1, 5, "BarNeg")
-        UnpackBit(lower,  1, 6, "VFD")
-        UnpackBit(lower,  1, 7, "Neg")
-
-        #Byte2
-        UnpackBit(lower,  2, 0, "Delta")
-
-        #Byte7
-        UnpackBit(lower,  7, 0, "V")
-
-        #Byte8
-        UnpackBit(upper,  8, 0, "µ")
-        UnpackBit(upper,  8, 1, "m")
-        UnpackBit(upper,  8, 2, "A")
-        UnpackBit(upper,  8, 3, "system")
-        UnpackBit(upper,  8, 4, "Neg")
-        UnpackBit(upper,  8, 5, "AC")
-        UnpackBit(upper,  8, 6, "T2")
-        UnpackBit(unpack, 8, 7, "Batt")
-
-        #Byte9
-        UnpackBit(unpack,  9, 0, "Cont")
-
-        #Byte13
-        UnpackBit(upper, 13, 0, "M")
-        UnpackBit(upper, 13, 1, "k")
-        UnpackBit(upper, 13, 2, "Hz")
-        UnpackBit(upper, 13, 3, "V")
-        UnpackBit(lower, 13, 4, "S")
-        UnpackBit(lower, 13, 5, "F")
-        UnpackBit(lower, 13, 6, "n")
-        UnpackBit(lower, 13, 7, "A")
-
-        #Byte14
-        UnpackBit(lower, 14, 0, "Hz")
-        UnpackBit(lower, 14, 1, "dB")
-        UnpackBit(lower, 14, 2, "m")
-        UnpackBit(lower, 14, 3, "µ")
-        UnpackBit(lower, 14, 4, "Ohm")
-        UnpackBit(lower, 14, 5, "M")
-        UnpackBit(lower, 14, 6, "k")
-        UnpackBit(lower, 14, 7, "Duty")
-
-        #Decimal Points
-        UnpackBit(lower, 3, 0, "Dec1")
-        UnpackBit(lower, 4, 0, "Dec2")
-        UnpackBit(lower, 5, 0, "Dec3")
-        UnpackBit(lower, 6, 0, "Dec4")
-    
-        UnpackBit(upper, 10, 0, "Dec1")
-        UnpackBit(upper, 11, 0, "Dec2")
-        UnpackBit(upper, 12, 0, "Dec3")
-
-        #upper segs
-        upper["Segs"]=[]
-        for digit in range(0, 4):
-            upper["Segs"].append(self.DecodeDigit(inbytes[9+digit]))
-
-        #lower segs
-        lower["Segs"]=[]
-        for digit in range(0, 6):
-            lower["Segs"].append(self.DecodeDigit(inbytes[2+digit]))
+        #segs
+        for display, (first, count) in self.layout["digits"].items():
+            unpack[display]["Segs"] = [self.DecodeDigit(inbytes[first+digit]) for digit in range(count)]
 
         timecode = (inbytes[23]<<24) +  (inbytes[22]<<16) + (inbytes[21]<<8) + (inbytes[20]);
         unpack["timecode"] = timecode
-        
+
 
         return unpack
-    
+
+    def DecodeDisplayBatch(self, data, layout):
+        '''vectorized equivalent of UnpackBytes+DecodeMeasurement for one display over all
+        rows of an Nx24 packet array. Returns the columns before the cross-display fixes
+        '''
+        n = len(data)
+        flagBits = layout["flags"]
+
+        def Flag(name):
+            if name not in flagBits:
+                return np.zeros(n, dtype=bool)
+            byte, bit = flagBits[name]
+            return (data[:, byte] & (1 << bit)) != 0
+
+        first, count = layout["digits"]
+        segBytes = data[:, first:first+count]
+        chars  = self.segmentCodes[segBytes]
+        digits = self.segmentDigits[segBytes]
+
+        #decimal point position, the last lit one wins (0: no decimal point).
+        #it is never after the last character so the temperature check below is safe
+        dotPos = np.zeros(n, dtype=np.int64)
+        for pos, byte in enumerate(layout["dec"]):
+            dotPos[(data[:, byte] & 1) != 0] = pos + 1
+
+        #trailing F or C is the temperature unit, not a digit
+        charF = self.segmentChars.index('F')
+        charC = self.segmentChars.index('C')
+        lastChar = chars[:, -1]
+        isTemp = (lastChar == charF) | (lastChar == charC)
+        neg = Flag("Neg")
+
+        #fast path: leading blanks followed by digits, in a layout float() accepts
+        #(no blank after the sign and no decimal point among the blanks)
+        leading = np.logical_and.accumulate(chars == self.segmentChars.index(' '), axis=1)
+        nBlank = leading.sum(axis=1)
+        usedLen = count - isTemp
+        isDigit = (digits >= 0) | leading
+        isNumber = np.all(isDigit[:, :-1], axis=1) & (isTemp | isDigit[:, -1]) & (nBlank < usedLen)
+        isNumber &= (~neg | (nBlank == 0)) & ((dotPos == 0) | (dotPos >= nBlank))
+        prefixVal = np.zeros(n, dtype=np.int64)
+        for col in range(count - 1):
+            prefixVal = prefixVal*10 + np.maximum(digits[:, col], 0)
+        intVal = np.where(isTemp, prefixVal, prefixVal*10 + np.maximum(digits[:, -1], 0))
+        exponent = np.where(dotPos > 0, usedLen - dotPos, 0)
+        #exact integers divided by exact powers of ten round the same way as float(text)
+        valOrg = intVal / (10.0 ** exponent)
+        valOrg = np.where(neg, -valOrg, valOrg)
+
+        #everything else (dashes, OL, diod, ...) is parsed once per distinct display
+        slowRows = np.flatnonzero(~isNumber)
+        if len(slowRows):
+            keys = (dotPos[slowRows] << 1) | neg[slowRows]
+            for col in range(count):
+                keys = (keys << 5) | chars[slowRows, col]
+            uniqueKeys, inverse = np.unique(keys, return_inverse=True)
+            uniqueVals = np.empty(len(uniqueKeys))
+            for i, key in enumerate(uniqueKeys.tolist()):
+                s = ''.join(self.segmentChars[(key >> 5*(count-1-col)) & 31] for col in range(count))
+                key >>= 5*count
+                if key >> 1:
+                    s = s[:key >> 1] + '.' + s[key >> 1:]
+                if s[-1:] in ["F", "C"]:
+                    s = s[:-1]
+                if key & 1:
+                    s = "-" + s
+                try:
+                    uniqueVals[i] = float(s)
+                except ValueError:
+                    uniqueVals[i] = float('nan')
+            valOrg[slowRows] = uniqueVals[inverse]
+
+        #unit
+        rules = self.rules
+        unit = np.select([Flag(flag) for flag, name in rules["units"]], [UnitNames.index(name) for flag, name in rules["units"]], 0)
+        unit = np.where(isTemp & (lastChar == charF), UnitNames.index("°F"), unit)
+        unit = np.where(isTemp & (lastChar == charC), UnitNames.index("°C"), unit)
+
+        #multiplier, the last lit one wins
+        prefix = np.zeros(n, dtype=np.int64)
+        for name, mult in rules["prefixes"]:
+            prefix[Flag(name)] = PrefixNames.index(name)
+        prefix[Flag(rules["noPrefix"])] = 0
+        unitOrg = prefix*len(UnitNames) + unit
+
+        #source
+        source = np.select([np.logical_and.reduce([Flag(flag) for flag in flags]) for flags, name in rules["sources"]],
+                           [SourceBases.index(name) for flags, name in rules["sources"]], 0)
+        source = np.select([Flag(flag) for flag, name in rules["temperatureSources"]],
+                           [SourceBases.index(name) for flag, name in rules["temperatureSources"]], source)
+        suffix = np.select([unit == UnitNames.index(name) for name, ending in rules["unitSources"]],
+                           [SourceSuffixes.index(ending) for name, ending in rules["unitSources"]], 0)
+        source = source + len(SourceBases)*suffix
+
+        #conductance in nS is converted to resistance
+        isNS = unitOrg == UnitOrgNames.index("nS")
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            value = np.where(isNS, 1e9/valOrg, PrefixMults[prefix]*valOrg)
+        unit = np.where(isNS, UnitNames.index("Ω"), unit)
+
+        #"diod" text on the display
+        diod = [self.segmentChars.index(c) for c in "diod"]
+        if count == len(diod):
+            isDiod = np.all(chars == diod, axis=1) & (dotPos == 0) & ~neg
+        else:
+            isDiod = np.zeros(n, dtype=bool)
+
+        return {"value":value, "valueOrg":valOrg, "unit":unit.astype(np.uint8), "unitOrg":unitOrg.astype(np.uint8),
+                "source":source.astype(np.uint8), "diod":isDiod}
+
+    def DecodeBatch(self, packets):
+        '''decodes a block of packets at once. packets is an Nx24 uint8 array or a raw
+        bytes buffer. Returns a dict of columns (numpy arrays of length N):
+            timecode, valueUpper, valueLower (base units), valueOrgUpper, valueOrgLower (as displayed),
+            unitUpper, unitLower (UnitNames), unitOrgUpper, unitOrgLower (UnitOrgNames),
+            sourceUpper, sourceLower (SourceNames), state (bit i = StateNames[i]),
+            payload (Nx20 raw bytes without the timecode)
+        Results are the same as DecodeUnpackedData(UnpackBytes(packet)) for each packet.
+        '''
+        data = AsPacketArray(packets)
+        n = len(data)
+        upper = self.DecodeDisplayBatch(data, self.batchLayout["upper"])
+        lower = self.DecodeDisplayBatch(data, self.batchLayout["lower"])
+
+        #cross-display fixes
+        lower["source"] = np.where(upper["diod"], lower["source"] + len(SourceNames)//2, lower["source"]).astype(np.uint8)
+        isTemperature = np.isin(upper["source"] % len(SourceBases), [SourceBases.index(s) for s in SourceBases if "Temperature" in s])
+        upper["unit"]    = np.where(isTemperature, lower["unit"], upper["unit"]).astype(np.uint8)
+        upper["unitOrg"] = np.where(isTemperature, lower["unitOrg"], upper["unitOrg"]).astype(np.uint8)
+
+        #state. Delta is unpacked into the lower display, so like DecodeUnpackedData
+        #the Relative bit is never set here
+        def Bit(name):
+            if name not in self.batchStateBits:
+                return np.zeros(n, dtype=bool)
+            byte, bit = self.batchStateBits[name]
+            return (data[:, byte] & (1 << bit)) != 0
+        state = np.zeros(n, dtype=np.uint8)
+        for name, flag, unless in self.rules["state"]:
+            bit = Bit(flag) if unless is None else Bit(flag) & ~Bit(unless)
+            state |= bit.astype(np.uint8) << StateNames.index(name)
+
+        columns = {"timecode": np.ascontiguousarray(data[:, 20:24]).view('<u4').ravel()}
+        for name, display in [("Upper", upper), ("Lower", lower)]:
+            for key in ["value", "valueOrg", "unit", "unitOrg", "source"]:
+                columns[key + name] = display[key]
+        columns["state"] = state
+        columns["payload"] = data[:, :20]
+        return columns
+
+    def FormatMeasurement(self, meas):
+        return "{:.6g} {} = {:.6f} {} ({}) ".format( meas["value"],  meas["unit"], meas["valueOrg"],  meas["unitOrg"],  meas["source"])
+
     def PrintMeasurement(self, meas):
-        print("{:.6g} {} = {:.6f} {} ({}) ".format( meas["value"],  meas["unit"], meas["valueOrg"],  meas["unitOrg"],  meas["source"]), end="")
+        print(self.FormatMeasurement(meas), end="")
 
-    def PrintSample(self, sample, decoder, unpackedData):
+    def FormatSample(self, sample, unpackedData, debug=None):
+        '''the text PrintSample prints, with the raw bytes, segments and lit items if debug
+        (DebugOn by default)'''
+        debug = DebugOn if debug is None else debug
         inbytes = sample["inbytes"]
     
         UnpackLower   = unpackedData["lower"]
         UnpackUpper   = unpackedData["upper"]
-        hexs = ":".join("{:02x}".format(c) for c in inbytes)
+        text = []
     
         #raw data
-        if DebugOn:
-            print("{} --> {} {}".format(hexs, ''.join(UnpackLower["Segs"]), ''.join(UnpackUpper["Segs"])))
+        if debug:
+            hexs = ":".join("{:02x}".format(c) for c in inbytes)
+            text.append("{} --> {} {}\n".format(hexs, ''.join(UnpackLower["Segs"]), ''.join(UnpackUpper["Segs"])))
 
         #time
-        print("{} - {}".format(sample["timecode"],sample["pctimestamp"]))
+        text.append("{} - {}\n".format(sample["timecode"],sample["pctimestamp"]))
         #upper measurement
-        self.PrintMeasurement(sample["measureUpper"])
-        if DebugOn:
-            print(decoder.GetLitItems(UnpackUpper))
+        text.append(self.FormatMeasurement(sample["measureUpper"]))
+        if debug:
+            text.append("{}\n".format(self.GetLitItems(UnpackUpper)))
     
         #lower measurement
-        self.PrintMeasurement(sample["measureLower"])
-        if DebugOn:
-            print(decoder.GetLitItems(UnpackLower))
+        text.append(self.FormatMeasurement(sample["measureLower"]))
+        if debug:
+            text.append("{}\n".format(self.GetLitItems(UnpackLower)))
             #common state
-            print(decoder.GetLitItems(unpackedData))
+            text.append("{}\n".format(self.GetLitItems(unpackedData)))
  
-        print("") #newline
+        text.append("\n") #newline
+        return ''.join(text)
 
-class TimeAxisItem(pg.AxisItem):
-    XAxisTime = True
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-    def tickStrings(self, values, scale, spacing):
-        #print("*")
-        if self.XAxisTime:
-            #return [time.strftime("%H:%M:%S", time.localtime(max(value,0))) for value in values]
-            return [str(timedelta(milliseconds=value)) for value in values]
-            
-        return super().tickStrings(values, scale, spacing)
-
-
-class BrymenUI:
-    '''
-    '''
-    def __init__(self):
-        self.lastFileName = ''
-
-    def ToggleXAxis(self):
-        TimeAxisItem.XAxisTime = not TimeAxisItem.XAxisTime
-        ##TOOD: force update in case data is invisible
-        
-
-    def UpdateValueLabels(self):
-        global history
-
-        if len(history.logSamples)>0:
-            with history.dataLock:
-                sample = history.logSamples[-1]
-                self.labelUp.setText(sample["measureUpper"]["text"] + sample["measureUpper"]["unitOrg"])
-                self.labelMain.setText(sample["measureLower"]["text"] + sample["measureLower"]["unitOrg"])
-
-            self.labelUp.repaint()
-            self.labelMain.repaint()
-    
-
-    def UpdateGraph(self):
-        global history
-    
-        size = len(history.logSamples)
-
-        if size>0:
-            with history.dataLock:
-                self.curveL.setData(x=history.logGraphData[0, :size] if TimeAxisItem.XAxisTime else None, y=history.logGraphData[2, :size])
-                label = history.labels["lower"]["source"]
-                unit =  history.labels["lower"]["unit"]
-                self.plL.getAxis('left').setLabel(label, unit)
-                self.plL.setTitle(label)
-
-                self.curveU.setData(x=history.logGraphData[0, :size] if TimeAxisItem.XAxisTime else None, y=history.logGraphData[3, :size])
-                label = history.labels["upper"]["source"]
-                unit =  history.labels["upper"]["unit"]
-                self.plU.getAxis('left').setLabel(label, unit)
-                self.plU.setTitle(label)
-       
-    def PickFile(self):
-        global history
-        options = QFileDialog.Options()
-        #options |= QFileDialog.DontUseNativeDialog
-        self.lastFileName, _ = QFileDialog.getSaveFileName(None, "Save output CSV file", self.lastFileName, "All Files (*);;Comma Separated Values (*.csv)", options=options)
-        #fileName = "d:/temp/aa.csv"
-        try:
-            history.exportCSV(self.lastFileName)
-        except Exception as ex:
-            msg = QtGui.QMessageBox(QtGui.QMessageBox.Critical, "Save Failed", str(ex), buttons=QtGui.QMessageBox.Ok)
-            msg.exec_();
-            
-
-    def InitGraph(self, conn):
-        global win
-        global app
-        #global history
-
-        #create the window
-        #win = pg.GraphicsWindow()
-        app = QtGui.QApplication([])
-        win = QtGui.QMainWindow()
-        win.setWindowTitle('PyBry')
-
-        #create the docking area
-        area = DockArea()
-        win.setCentralWidget(area)
-        win.resize(1000,500)
-
-        #create docks
-        dDis = Dock("Display", size=(100,100))
-        dSet = Dock("Settings", size=(50,1))
-        dGr1 = Dock("Upper Display", size=(900,250))
-        dGr2 = Dock("Main Display", size=(900,250))
-
-        #place the docks in the area
-        area.addDock(dDis, 'left')
-        area.addDock(dSet, 'bottom', dDis)
-        area.addDock(dGr1, 'right')
-        area.addDock(dGr2, 'bottom', dGr1) #share the bottom edge of d1
-
-        #Display Widget
-        font1=QtGui.QFont("SansSerif", 16, QtGui.QFont.Bold)     
-        font2=QtGui.QFont("SansSerif", 20, QtGui.QFont.Bold)     
-        self.labelUp   = QtGui.QLabel("0.000V")
-        self.labelMain = QtGui.QLabel("0.00000V")
-        self.labelUp.setFont(font1)
-        self.labelMain.setFont(font2)
-        wL1 = pg.LayoutWidget()
-        wL1.addWidget(self.labelUp, row=0, col=0)
-        wL1.addWidget(self.labelMain, row=1, col=0)
-        dDis.addWidget(wL1)
-        
-        #setting widgets
-        wL2 = pg.LayoutWidget()
-        clearBt = QtGui.QPushButton('Clear History')
-        saveBt  = QtGui.QPushButton('Save to CSV')
-        xAxisBt = QtGui.QPushButton('Toggle X Axis')
-
-        portTxt = QtGui.QLineEdit(PORTNAME)
-        startBt = QtGui.QPushButton('Start')
-        stopBt  = QtGui.QPushButton('Stop')
-        setPerBt= QtGui.QPushButton('Set Period')
-        perTxt = QtGui.QLineEdit('200')
-
-        #saveBt.setEnabled(False)
-
-        wL2.addWidget(clearBt, row=0, col=0)
-        wL2.addWidget(saveBt,row=1, col=0)
-        wL2.addWidget(xAxisBt,row=2, col=0)
-        wL2.addWidget(portTxt, row=3, col=0)
-        wL2.addWidget(startBt,row=4, col=0)
-        wL2.addWidget(stopBt,row=5, col=0)
-        wL2.addWidget(setPerBt,row=6, col=0)
-        wL2.addWidget(perTxt,row=6, col=1)
-
-        clearBt.clicked.connect(history.clearSampleHistory)
-        saveBt.clicked.connect(self.PickFile)
-        xAxisBt.clicked.connect(self.ToggleXAxis)
-        startBt.clicked.connect(lambda: conn.Start(portTxt))
-        stopBt.clicked.connect(conn.Stop)
-        setPerBt.clicked.connect(lambda: conn.SetPeriod(perTxt))
-
-        dSet.addWidget(wL2)
-
-        #graph widgets
-        wgU = pg.PlotWidget(axisItems={'bottom': TimeAxisItem(orientation='bottom')})
-        wgL = pg.PlotWidget(axisItems={'bottom': TimeAxisItem(orientation='bottom')})
-        #wgU = pg.PlotWidget()
-        #wgL = pg.PlotWidget()
-
-        self.plU = wgU.getPlotItem()
-        self.plL = wgL.getPlotItem()
-
-        self.plU.setDownsampling(mode='mean')
-        self.plU.getAxis('left').setGrid(128)
-        self.plU.getAxis('left').enableAutoSIPrefix(True)
-        self.plU.getAxis('bottom').setGrid(128)
-        self.plU.setClipToView(True)
-        self.curveU = self.plU.plot()
-
-        self.plL.setDownsampling(mode='mean')
-        self.plL.getAxis('left').setGrid(128)
-        self.plL.getAxis('left').enableAutoSIPrefix(True)
-        self.plL.getAxis('bottom').setGrid(128)
-        self.plL.setClipToView(True)
-        self.curveL = self.plL.plot()
-
-        #link the x axis
-        if LinkAxes:
-            self.plL.setXLink(self.plU)
-            self.plU.setXLink(slef.plL)
-
-        #place graph widgets in the docks
-        dGr1.addWidget(wgU)
-        dGr2.addWidget(wgL)
-        win.show()
-
-    def Update(self):
-        self.UpdateValueLabels()
-        self.UpdateGraph()
+    def PrintSample(self, sample, decoder, unpackedData):
+        print(decoder.FormatSample(sample, unpackedData), end="")
 
 
 if __name__ == "__main__":
-    import sys
-   
-    conn = Connection()
-    bryui = BrymenUI()
-
-    #init graph
-    bryui.InitGraph(conn)
-
-    #setup update timer as gui updates need to done via the main thread
-    timer = QtCore.QTimer()
-    timer.timeout.connect(bryui.Update)
-    timer.start(50)
-
-    #run the background sampling thread 
-    #conn.Start()
-
-    #run the application
-    if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
-        QtGui.QApplication.instance().exec_()
+    import BryUI
+    BryUI.Main()